@@ -4,8 +4,10 @@ import sys
 from pathlib import Path
 
 import _version
-from api import (get_current_scanid, check_inputs, xrf_loop, autoroi_xrf, loop_sleep)
+from api import (get_current_scanid, check_inputs, xrf_loop, xrf_listen, autoroi_xrf, loop_sleep,
+                 make_pipeline)
 from new_makehdf import new_makehdf
+from ledger import ScanLedger, ScanCursor
 from PyQt5 import QtWidgets
 from PyQt5 import uic
 from PyQt5.QtCore import Qt, QThread, pyqtSignal
@@ -34,6 +36,16 @@ class MainWindow(QtWidgets.QMainWindow):
             ver_str = f"version: {ver['version'][:3]}"
         self.label_version.setProperty("text", ver_str)
 
+        # Optional document source (see docstream.py) for event-driven mode
+        self.doc_source = None
+        # Parallel conversion of the backlog, memory cap in GB
+        self.num_workers = 1
+        self.max_memory = None
+        # Workers per pipeline stage, e.g. {'hdf5': 4}, None to disable the pipeline
+        self.stage_workers = None
+        # Write live maps of running fly scans (event-driven mode only)
+        self.live = False
+
         self.pushButton_stop.setProperty("enabled", False)
         self.setContentsMargins(20, 0, 20, 20)
 
@@ -184,18 +196,35 @@ class Tloop(QThread):
 
     def run(self):
         self.isRunning = True
+        ledger = ScanLedger()
+        cursor = ScanCursor(self.form.start_id, self.form.N, ledger=ledger)
+        pipeline = None
+        if self.form.stage_workers is not None:
+            pipeline = make_pipeline(ledger=ledger, stage_workers=self.form.stage_workers)
+            pipeline.start()
 
         try:
+            if self.form.doc_source is not None:
+                xrf_listen(self.form.doc_source, self.form.start_id, self.form.N,
+                           self.form.dt, gui=self, ledger=ledger, cursor=cursor,
+                           num_workers=self.form.num_workers, max_memory=self.form.max_memory,
+                           pipeline=pipeline, live=self.form.live)
             while self.isRunning:
-                xrf_loop(self.form.start_id, self.form.N, gui=self)
+                xrf_loop(self.form.start_id, self.form.N, gui=self, ledger=ledger, cursor=cursor,
+                         num_workers=self.form.num_workers, max_memory=self.form.max_memory,
+                         pipeline=pipeline)
                 loop_sleep(self.form.dt, gui=self)
         except KeyboardInterrupt:
             print("\n\nStopping SRX Autosave loop.")
             pass
+        finally:
+            if pipeline is not None:
+                pipeline.stop()
 
 
 # %% Main loop for XRF maps -> HDF5
-def autosave_xrf(start_id, wd="", N=1000, dt=60):
+def autosave_xrf(start_id, wd="", N=0, dt=60, source=None, num_workers=1, max_memory=None,
+                 stage_workers=None, live=False):
     """
     SRX Autosave
 
@@ -208,9 +237,25 @@ def autosave_xrf(start_id, wd="", N=1000, dt=60):
     wd : string
         Path to write the HDF5 files
     N : int
-        Number of scan IDs to search for, start_id + N
+        Number of scan IDs to search for, start_id + N. Use 0 to follow
+        the current scan ID with no limit.
     dt : int
         Time, in seconds, to wait before trying to make more files
+    source : DocumentSource, optional
+        Source of RunEngine documents (see docstream.py). When given, scans
+        are converted as soon as their stop document arrives and polling
+        every dt seconds is only used as a fallback.
+    num_workers : int
+        Number of worker processes converting finished scans at once
+    max_memory : float, optional
+        Memory cap, in GB, shared by the worker processes
+    stage_workers : dict, optional
+        Number of workers per stage, e.g. {'hdf5': 4, 'roi': 2}. When given,
+        scans go through the fetch -> HDF5 -> ROI -> report pipeline and
+        the stages of different scans overlap.
+    live : bool
+        With a document source, write the HDF5 of fly scans row by row
+        while they are running
 
     Returns
     -------
@@ -221,20 +266,43 @@ def autosave_xrf(start_id, wd="", N=1000, dt=60):
     Start downloading and creating HDF5 files and saving them into the user's directory
     >>> autosave_xrf(1234, wd='/home/xf05id1/current_user_data/, N=1000, dt=60)
 
+    React to stop documents from the 0MQ proxy instead of waiting dt seconds
+    >>> autosave_xrf(1234, source=ZMQDocumentSource('xf05id-ws1:5578'))
+
+    Convert up to 8 scans at once, using at most 200 GB of memory
+    >>> autosave_xrf(1234, num_workers=8, max_memory=200)
+
+    Write HDF5 files with 4 workers while ROIs and reports run alongside
+    >>> autosave_xrf(1234, source=ZMQDocumentSource('xf05id-ws1:5578'), stage_workers={'hdf5': 4})
+
     """
     # Check the input parameters
     (start_id, wd, N, dt) = check_inputs(start_id, wd, N, dt)
     os.chdir(wd)
+    ledger = ScanLedger()
+    cursor = ScanCursor(start_id, N, ledger=ledger)
+    pipeline = None
+    if stage_workers is not None:
+        pipeline = make_pipeline(ledger=ledger, stage_workers=stage_workers)
+        pipeline.start()
 
     print("--------------------------------------------------")
 
     try:
+        if source is not None:
+            xrf_listen(source, start_id, N, dt, ledger=ledger, cursor=cursor,
+                       num_workers=num_workers, max_memory=max_memory, pipeline=pipeline,
+                       live=live)
         while True:
-            xrf_loop(start_id, N)
+            xrf_loop(start_id, N, ledger=ledger, cursor=cursor,
+                     num_workers=num_workers, max_memory=max_memory, pipeline=pipeline)
             loop_sleep(dt)
     except KeyboardInterrupt:
         print("\n\nExiting SRX AutoSave.")
         pass
+    finally:
+        if pipeline is not None:
+            pipeline.stop()
 
 
 def run_autosave():
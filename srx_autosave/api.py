@@ -7,6 +7,10 @@ import glob
 import h5py
 import traceback
 import logging
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from reportlab.platypus import SimpleDocTemplate, Image, Paragraph, Table, Spacer
 import reportlab.lib.pagesizes
 from reportlab.lib.styles import ParagraphStyle
@@ -24,7 +28,13 @@ from databroker import Broker
 
 import logging
 from pyxrf.api import *
-#from new_makehdf import new_makehdf
+from new_makehdf import new_makehdf
+from docstream import ScanStopWatcher
+from pipeline import Stage, ScanPipeline
+from live_makehdf import follow_scan
+from scan_reader import read_columns, FETCH_THREADS
+from roi import read_roi_maps, take_maps, load_roi_table, ROI_CONFIG_FNAME
+from ledger import ScanCursor, NON_XRF, CONVERTED, MISSING
 
 try:
    from pyxrf.api_dev import db
@@ -54,6 +64,51 @@ logger.setLevel(logging.WARNING)
 
 #FLAG for auto_roi and create_pdf
 auto_roi_flag = True
+
+# Convert with new_makehdf instead of pyxrf's make_hdf. The ROI maps are then
+#   computed from the detector sum in memory and autoroi_xrf does not read
+#   the file back.
+use_new_makehdf = False
+
+# ROI table of the automatic ROIs, windows in keV, see roi.py
+roi_config = ROI_CONFIG_FNAME
+
+# Threads writing the ROI images of a scan. With roi_stack_tiff the maps
+#   go to one stacked TIFF per scan instead of two TIFFs per element.
+roi_export_threads = 4
+roi_stack_tiff = False
+
+# Options of new_makehdf for the files of this run, see new_makehdf for
+#   the values. E.g. hdf_write_profile = 'fast-lzf' and
+#   hdf_archive_profile = 'gzip-4' for the two-phase write.
+hdf_write_profile = 'default'
+hdf_archive_profile = None
+hdf_chunk_layout = None
+hdf_dtype_policy = 'native'
+hdf_each_det = False
+hdf_virtual_det = False
+hdf_direct_read = False
+hdf_fetch_threads = FETCH_THREADS
+
+# Settings copied to the worker processes of parallel conversions
+WORKER_SETTINGS = ('auto_roi_flag', 'use_new_makehdf', 'roi_config', 'roi_export_threads',
+                   'roi_stack_tiff', 'hdf_write_profile', 'hdf_archive_profile',
+                   'hdf_chunk_layout', 'hdf_dtype_policy', 'hdf_each_det', 'hdf_virtual_det',
+                   'hdf_direct_read', 'hdf_fetch_threads')
+
+# Retries of scans whose stop document arrived before the databroker had
+#   the whole scan. The delay doubles after each try, then the scan is
+#   left to the polling fallback.
+STOP_RETRY_DELAY = 0.25
+STOP_RETRIES = 6
+
+# Time, in seconds, to wait for a live map to be finished after the stop
+#   document arrives. The scan is then converted the usual way instead.
+LIVE_FINISH_TIMEOUT = 60
+
+# Rough peak memory per map pixel when converting a scan: 8 detector
+#   channels x 4096 bins x 8 bytes. Used for the parallel memory cap.
+SCAN_MEMORY_PER_PIXEL = 8 * 4096 * 8
 """
 SRX Autosave APIs
 
@@ -166,9 +221,9 @@ def check_inputs(start_id, wd, N, dt):
         print(f"Using current directory.\n{wd}")
 
     if N < 1:
-        # Add logic later that if N < 1, then always use current scan ID
-        print("Warning: N changed to 100.")
-        N = 100
+        # No upper limit, follow the current scan ID
+        print("No limit on the number of scan IDs.")
+        N = 0
 
     if dt < 1:
         print("Warning: dt changed to 1 second.")
@@ -177,6 +232,72 @@ def check_inputs(start_id, wd, N, dt):
     return (start_id, wd, N, dt)
 
 
+def _scaled_png(roi_norm):
+    """
+    Scale a normalized ROI map to uint8 between its 0.5 and 99.5 percentiles
+    """
+    percentiles = np.percentile(roi_norm, (0.5, 99.5))
+    scaled = exposure.rescale_intensity(roi_norm,in_range=tuple(percentiles))
+    min=np.min(scaled)
+    max=np.max(scaled)
+    roi_scaled = ((scaled-min)/(max-min))*255
+    return roi_scaled.astype("uint8")
+
+
+def _export_roi_images(roi_dir, scanid, rois, sclr_I0, stack=False, num_threads=1):
+    """
+    Write the TIFF and PNG images of the ROI maps of a scan
+
+    Parameters
+    ----------
+    roi_dir : string
+        Output folder
+    scanid : int
+        Scan ID
+    rois : dict
+        ROI map of each element
+    sclr_I0 : ndarray
+        I0 scaler, the maps are also written divided by I0
+    stack : bool
+        Write one ImageJ TIFF, roi_{scanid}_stack.tif, with I0, each map
+        and each normalized map as labeled pages, instead of a raw and a
+        normalized TIFF per element. The PNGs of the report are always
+        written.
+    num_threads : int
+        Number of images written at the same time
+    """
+
+    norms = {x: rois[x] / sclr_I0 for x in rois}
+    tasks = []
+    if stack:
+        labels = ['I0'] + list(rois) + [f'{x}_norm' for x in rois]
+        pages = np.stack([sclr_I0] + [rois[x] for x in rois] + [norms[x] for x in rois])
+        tasks.append(lambda: imsave(os.path.join(roi_dir, f'roi_{scanid}_stack.tif'),
+                                    pages.astype("float32"), imagej=True,
+                                    metadata={'Labels': labels}))
+    else:
+        tasks.append(lambda: imsave(os.path.join(roi_dir, f'{scanid}_I0.tif'),
+                                    sclr_I0.astype("float32"), dtype=np.float32))
+        for x in rois:
+            tasks.append(lambda x=x: imsave(os.path.join(roi_dir, f'roi_{scanid}_{x}.tif'),
+                                            rois[x].astype("float32"), dtype=np.float32))
+            tasks.append(lambda x=x: imsave(os.path.join(roi_dir, f'roi_{scanid}_{x}_norm.tif'),
+                                            norms[x].astype("float32"), dtype=np.float32))
+    # The percentiles and scaling run in the threads as well
+    for x in rois:
+        tasks.append(lambda x=x: imsave(os.path.join(roi_dir, f'roi_{scanid}_{x}_norm.png'),
+                                        _scaled_png(norms[x]), dtype=np.uint8))
+
+    if num_threads is None or num_threads <= 1:
+        for task in tasks:
+            task()
+        return
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        futures = [pool.submit(task) for task in tasks]
+    for fut in futures:
+        fut.result()
+
+
 def autoroi_xrf(scanid, auto_dir):
     """
     SRX auto_roi
@@ -200,63 +321,32 @@ def autoroi_xrf(scanid, auto_dir):
     >>> autoroi_xrf(1234)
 
     """
-    # Load h5 file (autosaved)
-    element_roi = {"K_k" : [316, 346],
-                   "Mn_k" : [215, 245],
-                   "Ni_k" : [730, 770],
-                   "Cu_k" : [780, 820],
-                   "Bi_l" : [1069, 1099]}
-##     element_roi = {"Si_k" : [159, 189],
-##                    "S_k" : [215, 245],
-##                    "P_k" : [186, 206],
-##                    "Al_k" : [134, 164],
-##                    "Mn_k" : [575, 605],
-##                    "Cu_k" : [790, 820],
-##                    "Cl_k" : [247, 277], 
-##                    "Ca_k" : [350, 390],
-##                    "Fe_k" : [620, 660],
-##                    "Zn_k" : [780, 820],
-##                    "Au_l" : [950, 990]}
-##     
     print("Start exporting ROIs")
-    h5file = glob.glob(f"scan2D_{scanid}_*.h5")
+
+    # Maps left in memory by new_makehdf, otherwise load h5 file (autosaved)
+    rois, sclr_I0 = take_maps(scanid)
+    if rois is None:
+        h5file = glob.glob(f"scan2D_{scanid}_*.h5")
+        if len(h5file) != 0:
+            with h5py.File(h5file[0], 'r') as f:
+                md = f.get('xrfmap/scan_metadata')
+                energy = None if md is None else md.attrs.get('instrument_mono_incident_energy')
+            element_roi = load_roi_table(roi_config).bins(energy)
+            # All ROIs and I0 in one pass over the file, in bounded memory
+            rois, sclr_I0 = read_roi_maps(h5file[0], element_roi)
 
     #save the tif and png in local home dir to avoid the eviction
     save_dir = '/home/xf05id1/auto_rois/'
-    if not len(h5file) == 0:
-        f = h5py.File(h5file[0])
-
+    if rois is not None:
         try:
             os.makedirs(os.path.join(save_dir, f"scan_{scanid}_rois"), exist_ok=True)
         except Exception as e:
             print(e)
             raise OSError(f'Cannot create scan_{scanid} directory')
 
-        sclr_I0 = f['xrfmap/scalers/val'][:, :, 0]
-        sclr_IM = f['xrfmap/scalers/val'][:, :, 3]
-        imsave(os.path.join(save_dir, f'scan_{scanid}_rois', f'{scanid}_I0.tif'),
-               sclr_I0.astype("float32"),
-               dtype=np.float32)
- 
-        for x in element_roi:
-            roi = np.sum(f['xrfmap/detsum/counts'][:, :, element_roi[x][0]:element_roi[x][1]], axis=2)
-            roi_norm = roi / sclr_I0
-            imsave(os.path.join(save_dir, f'scan_{scanid}_rois', f'roi_{scanid}_{x}.tif'),
-                   roi.astype("float32"),
-                   dtype=np.float32)
-            imsave(os.path.join(save_dir, f'scan_{scanid}_rois', f'roi_{scanid}_{x}_norm.tif'),
-                   roi_norm.astype("float32"),
-                   dtype=np.float32)
-            # imsave(f'scan_{scanid}_rois/roi_{scanid}_{x}.tiff', roi_norm.astype("float32"), dtype=np.float32)
-            percentiles = np.percentile(roi_norm, (0.5, 99.5))
-            scaled = exposure.rescale_intensity(roi_norm,in_range=tuple(percentiles))
-            min=np.min(scaled)    
-            max=np.max(scaled)    
-            roi_scaled = ((scaled-min)/(max-min))*255
-            imsave(os.path.join(save_dir, f'scan_{scanid}_rois', f'roi_{scanid}_{x}_norm.png'),
-                   roi_scaled.astype("uint8"),
-                   dtype=np.uint8)
-            # imsave(f'{auto_dir}scan_{scanid}_rois/roi_{scanid}_{x}.png', roi_scaled.astype("uint8"), dtype=np.uint8)
+        roi_dir = os.path.join(save_dir, f'scan_{scanid}_rois')
+        _export_roi_images(roi_dir, scanid, rois, sclr_I0, stack=roi_stack_tiff,
+                           num_threads=roi_export_threads)
         print("Finished exporting ROIs")
     else:
         print(f"scan2D_{scanid} can not be found!")
@@ -355,8 +445,7 @@ def add_encoder_data(scanid):
     start_doc = h.start
     
     # Get position data from scan
-    y_pos = h.data('enc2', stream_name='stream0', fill=True)
-    y_pos = np.array(list(y_pos))
+    y_pos = read_columns(h, ['enc2'], stream_name='stream0')['enc2']
 
     # Write to file
     try:
@@ -373,15 +462,425 @@ def add_encoder_data(scanid):
         print(f'Error writing to file: {fn}')
 
 
-def xrf_loop(start_id, N, gui=None):
-    auto_dir = "auto_rois/"
-    num = np.arange(start_id, start_id + N, 1)
-    for i in range(N):
-        # Check if the scan ID exists
-        # We could make a function to check if current scan ID
-        # >= this value. Or same thing but return True/False
-        scanid = int(num[i])
+def _check_scan(scanid, ledger=None):
+    """
+    Check if a scan needs to be converted
+
+    Returns
+    -------
+    status : string
+        'ready' if the scan should be converted, 'waiting' if it failed
+        and is not due to be tried again, otherwise the final status
+    h : Header or None
+        Scan header
+    """
+
+    if ledger is not None:
+        row = ledger.get(scanid)
+        if row is not None and ledger.is_finished(scanid):
+            return row[0], None
+        t_next = ledger.next_try(scanid)
+        if t_next is not None and t_next > ttime.time():
+            return 'waiting', None
+
+    try:
+        h = db[scanid]
+    except (KeyError, ValueError):
+        print(f"{scanid} does not exist!")
+        return 'missing', None
+    except Exception as ex:
+        # Timeouts or connection errors, the scan may well exist
+        print(f"Cannot look up {scanid} in the databroker ({ex!r}), trying again later.")
+        return 'incomplete', None
+
+    # Output to command line that we are on a given scan
+    print(scanid, end="\t", flush=True)
+    try:
+        print(h.start['scan']['type'], end="\t\t", flush=True)  # This might change
+    except:
+        print('UNKNOWN SCAN TYPE. SKIPPING')
+        return 'unknown', h
+
+    # Check if fly scan
+    # Should be more generic, if XRF scan
+    if h.start['scan']['type'] != 'XRF_FLY':
+        print()
+        return 'non-xrf', h
+
+    # fname = filelist_h5[i]
+    # Check if the file noes not exist
+    # if not os.path.isfile(fname):
+    if glob.glob(f"scan2D_{scanid}_*.h5") or os.path.isfile(f"scan2D_{scanid}.h5"):
+        print(f"XRF HDF5 already created.")
+        return 'exists', h
+
+    # Check if the scan is done
+    try:
+        h.stop['time']
+    except (KeyError, TypeError):
+        print('Scan not complete...')
+        return 'incomplete', h
+
+    return 'ready', h
+
+
+def _make_hdf(scanid):
+    """
+    Make the HDF5 file of a scan with the converter chosen by use_new_makehdf
+
+    new_makehdf gets the hdf_* settings of this module.
+
+    Returns
+    -------
+    bool
+        True if a file was written, both converters only print why they
+        skipped a scan
+    """
+    if use_new_makehdf:
+        rois = load_roi_table(roi_config) if auto_roi_flag is True else None
+        return len(new_makehdf(scanid, create_each_det=hdf_each_det,
+                               write_profile=hdf_write_profile, chunk_layout=hdf_chunk_layout,
+                               archive_profile=hdf_archive_profile,
+                               dtype_policy=hdf_dtype_policy, virtual_det=hdf_virtual_det,
+                               direct_read=hdf_direct_read, fetch_threads=hdf_fetch_threads,
+                               rois=rois)) > 0
+    make_hdf(scanid, completed_scans_only=True)
+    return len(glob.glob(f"scan2D_{scanid}_*.h5")) > 0
+
+
+def _convert_scan(scanid, auto_dir, report=True):
+    """
+    Make the HDF5 and export the ROIs for a finished scan
+
+    This is also the worker function for parallel conversion, in which
+    case report is False and the PDF log is updated by the main process.
+
+    Returns
+    -------
+    status : string
+        'converted' or 'failed'
+    """
+
+    status = 'failed'
+    try:
+        if not _make_hdf(scanid):
+            return status
+        status = 'converted'
+        if auto_roi_flag is True:
+            autoroi_xrf(scanid, auto_dir=auto_dir)
+            if report:
+                create_pdf(scanid, auto_dir=auto_dir)
+    except Exception:
+        # A failure in the ROI export still leaves a good HDF5
+        traceback.print_exc()
+    return status
+
+
+def _record_scan(scanid, status, ledger):
+    if ledger is None or status in ('missing', 'ready', 'waiting'):
+        return
+    state, fname = status, None
+    if status == 'unknown':
+        state = NON_XRF
+    elif status in ('converted', 'exists'):
+        h5file = glob.glob(f"scan2D_{scanid}_*.h5")
+        fname = h5file[0] if h5file else None
+        state = CONVERTED
+    ledger.record(scanid, state, fname)
+
+
+def _scan_done(scanid, status, ledger):
+    """
+    Check if the cursor can move past a scan
+    """
+    if status == 'failed':
+        # Tried again until the ledger gives up on the scan
+        return ledger is not None and ledger.is_finished(scanid)
+    return status not in ('incomplete', 'waiting')
+
+
+def process_scan(scanid, auto_dir="auto_rois/", ledger=None):
+    """
+    Check a single scan and make the HDF5 (and ROIs) if needed
+
+    Parameters
+    ----------
+    scanid : int
+        Scan ID
+    auto_dir : string
+        Folder to save the automatic processing
+    ledger : ScanLedger, optional
+        Record of processed scans. Finished scans are skipped without
+        touching the databroker and the outcome is recorded.
+
+    Returns
+    -------
+    status : string
+        One of 'missing', 'unknown', 'non-xrf', 'exists', 'incomplete',
+        'waiting', 'failed' or 'converted'
+    """
+
+    status, h = _check_scan(scanid, ledger=ledger)
+    if h is None:
+        return status
+
+    if status == 'ready':
+        status = _convert_scan(scanid, auto_dir)
+    _record_scan(scanid, status, ledger)
+
+    # Clear the db cache then return
+    db._catalog._entries.cache_clear()
+
+    return status
+
+
+def _settings():
+    """
+    Return the module settings that worker processes need
+    """
+    return {k: globals()[k] for k in WORKER_SETTINGS}
+
+
+def _apply_settings(settings):
+    globals().update(settings)
+
+
+def _process_pool(num_workers):
+    """
+    Pool of spawned worker processes
+
+    Spawned workers import this module again and would only see the
+    default settings, so the current ones are installed when each worker
+    starts.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx,
+                               initializer=_apply_settings, initargs=(_settings(),))
+
+
+def _estimate_scan_memory(h):
+    """
+    Rough peak memory, in bytes, needed to convert a scan
+    """
+    try:
+        c, r = h.start['scan']['shape']
+    except (KeyError, TypeError, ValueError):
+        return 0
+    return int(c * r * SCAN_MEMORY_PER_PIXEL)
 
+
+def convert_scans_parallel(scans, auto_dir="auto_rois/", num_workers=4, max_memory=None,
+                           ledger=None, gui=None):
+    """
+    Convert several finished scans at once in a pool of worker processes
+
+    Each scan goes through the same steps as in process_scan. The PDF log
+    is shared between scans, so it is updated by the calling process in
+    scan ID order once the conversions are done. The workers get the
+    current values of the settings in WORKER_SETTINGS, e.g. auto_roi_flag.
+
+    Parameters
+    ----------
+    scans : list
+        List of (scanid, header) for scans that are ready to be converted
+    auto_dir : string
+        Folder to save the automatic processing
+    num_workers : int
+        Number of worker processes
+    max_memory : float, optional
+        Memory cap in GB. New conversions are only started while the
+        estimated memory of the running conversions stays below the cap.
+        One conversion is always allowed to run.
+    ledger : ScanLedger, optional
+        Record of processed scans
+    gui : Tloop, optional
+        GUI thread to report status to
+
+    Returns
+    -------
+    results : dict
+        Status for each scan ID
+    """
+
+    if max_memory is None:
+        mem_cap = None
+    else:
+        mem_cap = max_memory * 1024**3
+    todo = [(scanid, _estimate_scan_memory(h)) for scanid, h in scans]
+    results = {}
+    running = {}
+    mem_used = 0
+
+    with _process_pool(num_workers) as pool:
+        while todo or running:
+            # Start as many conversions as the worker count and memory cap allow
+            while todo and len(running) < num_workers:
+                scanid, mem = todo[0]
+                if running and mem_cap is not None and mem_used + mem > mem_cap:
+                    break
+                todo.pop(0)
+                fut = pool.submit(_convert_scan, scanid, auto_dir, False)
+                running[fut] = (scanid, mem)
+                mem_used += mem
+                print(f"Converting {scanid} ({len(running)} running)...")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                scanid, mem = running.pop(fut)
+                mem_used -= mem
+                try:
+                    status = fut.result()
+                except Exception:
+                    traceback.print_exc()
+                    status = 'failed'
+                results[scanid] = status
+                _record_scan(scanid, status, ledger)
+                print(f"{scanid}\t{status}")
+                if gui is not None:
+                    gui.signal_update_progressBar.emit(100 * len(results) / len(scans))
+
+    if auto_roi_flag is True:
+        for scanid in sorted(results):
+            if results[scanid] == 'converted':
+                create_pdf(scanid, auto_dir=auto_dir)
+
+    return results
+
+
+def _hdf_stage(scanid):
+    try:
+        if not _make_hdf(scanid):
+            return 'failed'
+    except Exception:
+        traceback.print_exc()
+        return 'failed'
+    if auto_roi_flag is not True:
+        return 'converted'
+    return None
+
+
+def _roi_stage(scanid):
+    try:
+        autoroi_xrf(scanid, auto_dir="auto_rois/")
+    except Exception:
+        # A failure in the ROI export still leaves a good HDF5
+        traceback.print_exc()
+        return 'converted'
+    return None
+
+
+def _hdf_roi_stage(scanid):
+    # HDF5 and ROIs in the same worker process, so autoroi_xrf gets the
+    #   maps left in memory by new_makehdf
+    status = _hdf_stage(scanid)
+    if status is not None:
+        return status
+    return _roi_stage(scanid)
+
+
+def _report_stage(scanid):
+    try:
+        create_pdf(scanid, auto_dir="auto_rois/")
+    except Exception:
+        traceback.print_exc()
+    return None
+
+
+def make_pipeline(ledger=None, stage_workers=None):
+    """
+    Build the fetch -> HDF5 -> ROI -> report pipeline
+
+    Parameters
+    ----------
+    ledger : ScanLedger, optional
+        Record of processed scans, used by the fetch stage
+    stage_workers : dict, optional
+        Number of workers for each stage, e.g. {'hdf5': 4, 'roi': 2}.
+        Stages not in the dictionary get one worker. With more than one
+        HDF5 worker the HDF5 stage runs in worker processes, with the
+        settings of this process (WORKER_SETTINGS), and also makes the
+        ROIs of its scans so the ROI maps can be handed over in memory.
+        The report stage always has a single worker since all scans
+        share one PDF.
+
+    Returns
+    -------
+    pipeline : ScanPipeline
+        Pipeline, not yet started
+    """
+
+    if stage_workers is None:
+        stage_workers = {}
+
+    def fetch(scanid):
+        status, h = _check_scan(scanid, ledger=ledger)
+        if h is not None:
+            db._catalog._entries.cache_clear()
+        if status == 'ready':
+            return None
+        return status
+
+    N_hdf = stage_workers.get('hdf5', 1)
+    stages = [Stage('fetch', fetch, stage_workers.get('fetch', 1))]
+    if N_hdf > 1:
+        stages.append(Stage('hdf5', _hdf_roi_stage, N_hdf, use_processes=True,
+                            initializer=_apply_settings, initargs=(_settings(),)))
+    else:
+        stages.append(Stage('hdf5', _hdf_stage, 1))
+        if auto_roi_flag is True:
+            stages.append(Stage('roi', _roi_stage, stage_workers.get('roi', 1)))
+    if auto_roi_flag is True:
+        stages.append(Stage('report', _report_stage, 1))
+    return ScanPipeline(stages)
+
+
+def _drain_pipeline(pipeline, ledger=None, cursor=None):
+    """
+    Record the scans that came out of the pipeline
+
+    Returns
+    -------
+    done : dict
+        Status of each scan that came out
+    """
+    done = {}
+    while True:
+        try:
+            scanid, status = pipeline.results.get_nowait()
+        except queue.Empty:
+            return done
+        done[scanid] = status
+        if status in ('converted', 'failed'):
+            print(f"{scanid}\t{status}")
+        _record_scan(scanid, status, ledger)
+        if status == 'missing' and ledger is not None:
+            ledger.record(scanid, MISSING)
+        if cursor is not None and _scan_done(scanid, status, ledger):
+            cursor.mark_finished(scanid)
+
+
+def xrf_loop(start_id, N, gui=None, ledger=None, cursor=None, num_workers=1, max_memory=None,
+             pipeline=None):
+    auto_dir = "auto_rois/"
+    if cursor is None:
+        cursor = ScanCursor(start_id, N, ledger=ledger)
+
+    # Only look at the unfinished scans up to the newest scan ID
+    cursor.update(get_current_scanid())
+
+    if pipeline is not None:
+        # Hand the scans to the pipeline and return, the results are
+        #   collected on the next cycle. The statuses drained here are
+        #   returned for callers that follow their own scans, e.g. xrf_listen.
+        done = _drain_pipeline(pipeline, ledger=ledger, cursor=cursor)
+        in_flight = pipeline.in_flight()
+        for scanid in cursor.pending():
+            if scanid not in in_flight:
+                pipeline.submit(scanid)
+        return done
+
+    ready = []
+    for scanid in cursor.pending():
         if gui is not None:
             gui.signal_update_status.emit(f"Making {scanid}...")
 
@@ -390,56 +889,260 @@ def xrf_loop(start_id, N, gui=None):
                 gui.signal_update_progressBar.emit(0)
                 return
 
-        try:
-            h = db[scanid]
-        except Exception:
-            print(f"{scanid} does not exist!")
-            break
-
-        # Output to command line that we are on a given scan
-        print(scanid, end="\t", flush=True)
-        try:
-            print(h.start['scan']['type'], end="\t\t", flush=True)  # This might change
-        except:
-            print('UNKNOWN SCAN TYPE. SKIPPING')
-            continue
-
-        # Check if fly scan
-        # Should be more generic, if XRF scan
-        if h.start['scan']['type'] == 'XRF_FLY':
-            # fname = filelist_h5[i]
-            # Check if the file noes not exist
-            # if not os.path.isfile(fname):
-            if not glob.glob(f"scan2D_{scanid}_*.h5") and not os.path.isfile(
-                f"scan2D_{scanid}.h5"
-            ):
-                # Check if the scan is done
-                try:
-                    db[scanid].stop['time']
-                    make_hdf(scanid, completed_scans_only=True)
-                    ttime.sleep(1)
-                    if auto_roi_flag is True:
-                        autoroi_xrf(scanid, auto_dir=auto_dir)
-                        ttime.sleep(1)
-                        create_pdf(scanid, auto_dir=auto_dir)
-                except KeyError:
-                    print('Scan not complete...')
-                    pass
-                except Exception:
-                    traceback.print_exc()
-                    pass
-            else:   
-                print(f"XRF HDF5 already created.")
-
+        if num_workers > 1:
+            # Collect the finished scans and convert them together below
+            status, h = _check_scan(scanid, ledger=ledger)
+            if status == 'ready':
+                ready.append((scanid, h))
+                continue
+            _record_scan(scanid, status, ledger)
         else:
-            print()
+            status = process_scan(scanid, auto_dir=auto_dir, ledger=ledger)
 
-        # Clear the db cache then return
+        if status == 'missing' and ledger is not None:
+            # A newer scan exists, so this scan ID was skipped for good
+            ledger.record(scanid, MISSING)
+        if _scan_done(scanid, status, ledger):
+            cursor.mark_finished(scanid)
+
+    if ready:
+        if gui is not None:
+            gui.signal_update_status.emit(f"Converting {len(ready)} scans...")
+        results = convert_scans_parallel(ready, auto_dir=auto_dir, num_workers=num_workers,
+                                         max_memory=max_memory, ledger=ledger, gui=gui)
+        for scanid, status in results.items():
+            if _scan_done(scanid, status, ledger):
+                cursor.mark_finished(scanid)
         db._catalog._entries.cache_clear()
 
     return
 
 
+def _follow_scan(scanid, docs, abort, done):
+    # Live map thread, reports the finished file (or None) to the listener
+    fn = None
+    try:
+        fn = follow_scan(scanid, docs=docs, stop_event=abort)
+    except Exception:
+        print(f"Live map of {scanid} failed:")
+        traceback.print_exc()
+    finally:
+        done.put((scanid, fn))
+
+
+def xrf_listen(source, start_id, N, dt, gui=None, ledger=None, cursor=None,
+               num_workers=1, max_memory=None, pipeline=None, live=False):
+    """
+    Event-driven autosave loop
+
+    Scans are converted as soon as their stop document is received from
+    the document source. Polling with xrf_loop every dt seconds is kept
+    as a fallback for scans whose documents were missed (e.g. while the
+    service was down or the proxy was restarted). A stop document can
+    arrive before the databroker has it, those scans are tried again
+    after a short delay (STOP_RETRY_DELAY, doubled after each try).
+
+    Parameters
+    ----------
+    source : DocumentSource
+        Source of RunEngine documents, see docstream.py
+    start_id : int
+        Starting scan ID
+    N : int
+        Number of scan IDs to search for when polling, 0 for no limit
+    dt : int
+        Time, in seconds, between fallback polling cycles
+    gui : Tloop, optional
+        GUI thread to report status to
+    ledger : ScanLedger, optional
+        Record of processed scans
+    cursor : ScanCursor, optional
+        Window of unfinished scan IDs used when polling
+    num_workers : int
+        Number of worker processes used to convert the backlog when polling
+    max_memory : float, optional
+        Memory cap, in GB, for the worker processes
+    pipeline : ScanPipeline, optional
+        Started pipeline (see make_pipeline). Scans are submitted to it as
+        soon as their stop document arrives.
+    live : bool
+        Write the HDF5 of fly scans while they are running (see
+        live_makehdf.py). The ROIs and report are made once the stop
+        document arrives and the live map is done, by the pipeline if
+        there is one. Live maps that are not finished LIVE_FINISH_TIMEOUT
+        seconds after the stop document are stopped and the scan is
+        converted the usual way once their thread is done.
+
+    Returns
+    -------
+    None
+    """
+    auto_dir = "auto_rois/"
+    if cursor is None:
+        cursor = ScanCursor(start_id, N, ledger=ledger)
+    scan_queue = queue.Queue()
+    start_queue = queue.Queue() if live else None
+    watcher = ScanStopWatcher(scan_queue, min_id=start_id, start_queue=start_queue)
+    # Threads writing live maps, {scanid: (thread, abort event)}. Finished
+    #   threads put (scanid, file name or None) in live_done, the maps done
+    #   before their stop document arrived wait in live_maps, {scanid: fname}.
+    #   Stop documents of scans with a running live map wait in live_stops,
+    #   {scanid: [time to give up on the live map, time of the stop document]}.
+    live_threads = {}
+    live_done = queue.Queue()
+    live_maps = {}
+    live_stops = {}
+    # Scans from stop documents that were not complete in the databroker yet,
+    #   or that the pipeline did not take,
+    #   {scanid: [time of the next try, number of tries, time of the stop document]}
+    retries = {}
+    # Scans from stop documents that are in the pipeline, {scanid: time of the stop document}
+    submitted = {}
+
+    def _retry(scanid, t_stop):
+        n = retries[scanid][1] + 1 if scanid in retries else 0
+        if n >= STOP_RETRIES:
+            print(f"{scanid} still cannot be converted, leaving it to polling.")
+            retries.pop(scanid, None)
+            live_maps.pop(scanid, None)
+            return
+        retries[scanid] = [ttime.monotonic() + STOP_RETRY_DELAY * 2**n, n, t_stop]
+
+    def _check_submitted(done):
+        # Statuses of the scans that came out of the pipeline
+        for scanid, status in done.items():
+            if scanid not in submitted:
+                continue
+            t_stop = submitted.pop(scanid)
+            if status == 'incomplete':
+                _retry(scanid, t_stop)
+            else:
+                retries.pop(scanid, None)
+
+    def _poll():
+        done = xrf_loop(start_id, N, gui=gui, ledger=ledger, cursor=cursor,
+                        num_workers=num_workers, max_memory=max_memory, pipeline=pipeline)
+        if pipeline is not None:
+            _check_submitted(done)
+
+    def _convert(scanid, t_stop):
+        if pipeline is not None:
+            if pipeline.submit(scanid):
+                submitted[scanid] = t_stop
+            else:
+                # Already in the pipeline, e.g. from polling, or stopping
+                _retry(scanid, t_stop)
+            return
+        status = process_scan(scanid, auto_dir=auto_dir, ledger=ledger)
+        if status == 'incomplete':
+            # The stop document can arrive before it is in the databroker
+            _retry(scanid, t_stop)
+            return
+        retries.pop(scanid, None)
+        if status != 'missing' and _scan_done(scanid, status, ledger):
+            cursor.mark_finished(scanid)
+
+    def _finish_live(scanid, fn, t_stop):
+        if fn is None or not os.path.isfile(fn):
+            print(f"No live map of {scanid}, converting the scan instead.")
+            _convert(scanid, t_stop)
+            return
+        # Only the ROIs and report are left
+        if pipeline is not None and auto_roi_flag is True:
+            # The report worker of the pipeline owns the PDF log
+            if 'roi' in pipeline.stage_names():
+                ok = pipeline.submit(scanid, stage='roi')
+            else:
+                _roi_stage(scanid)
+                ok = pipeline.submit(scanid, stage='report')
+            if ok:
+                submitted[scanid] = t_stop
+            else:
+                # Kept for the next try, which submits it again
+                live_maps[scanid] = fn
+                _retry(scanid, t_stop)
+            return
+        if auto_roi_flag is True:
+            _roi_stage(scanid)
+            _report_stage(scanid)
+        _record_scan(scanid, 'converted', ledger)
+        cursor.mark_finished(scanid)
+
+    if gui is not None:
+        DT = gui.DT
+    else:
+        DT = 0.5
+
+    source.subscribe(watcher)
+    source.start()
+    try:
+        # Catch up on anything that finished before we subscribed
+        _poll()
+        t_poll = ttime.monotonic()
+        while gui is None or gui.isRunning:
+            if pipeline is not None:
+                _check_submitted(_drain_pipeline(pipeline, ledger=ledger, cursor=cursor))
+            while live and not start_queue.empty():
+                scanid, _ = start_queue.get()
+                print(f"\nWriting live map for {scanid}...")
+                abort = threading.Event()
+                th = threading.Thread(target=_follow_scan, daemon=True,
+                                      args=(scanid, watcher.run_docs.pop(scanid, None), abort,
+                                            live_done))
+                th.start()
+                live_threads[scanid] = (th, abort)
+            while not live_done.empty():
+                scanid, fn = live_done.get()
+                th, abort = live_threads.pop(scanid)
+                th.join()
+                if scanid in live_stops:
+                    _finish_live(scanid, fn, live_stops.pop(scanid)[1])
+                else:
+                    live_maps[scanid] = fn
+            # Try again the scans that are due, stop the live maps that take too long
+            now = ttime.monotonic()
+            for scanid, r in retries.items():
+                if r[0] <= now:
+                    r[0] = float('inf')
+                    scan_queue.put((scanid, r[2]))
+            for scanid, r in live_stops.items():
+                if r[0] <= now:
+                    r[0] = float('inf')
+                    print(f"Live map of {scanid} is not finished, converting the scan instead.")
+                    live_threads[scanid][1].set()
+            timeout = min([DT] + [max(0, r[0] - now) for r in retries.values()]
+                          + [max(0, r[0] - now) for r in live_stops.values()])
+            try:
+                scanid, t_stop = scan_queue.get(timeout=timeout)
+            except queue.Empty:
+                if ttime.monotonic() - t_poll > dt:
+                    _poll()
+                    t_poll = ttime.monotonic()
+                elif gui is not None:
+                    gui.signal_update_status.emit("Waiting for scans...")
+                continue
+
+            print(f"\nStop document for {scanid} received "
+                  f"{1000 * (ttime.time() - t_stop):.0f} ms ago.")
+            if gui is not None:
+                gui.signal_update_status.emit(f"Making {scanid}...")
+            if scanid in live_maps:
+                _finish_live(scanid, live_maps.pop(scanid), t_stop)
+            elif scanid in live_threads:
+                # Only the last rows are left to write, finished when the thread is done
+                live_stops[scanid] = [ttime.monotonic() + LIVE_FINISH_TIMEOUT, t_stop]
+            else:
+                _convert(scanid, t_stop)
+    finally:
+        source.unsubscribe(watcher)
+        source.stop()
+
+    if gui is not None:
+        gui.signal_update_status.emit("SRX Autosave stopped.")
+        gui.signal_update_progressBar.emit(0)
+    return
+
+
 def loop_sleep(dt, gui=None):
     if gui is not None:
         DT = gui.DT
@@ -0,0 +1,522 @@
+"""
+SRX Autosave benchmarks
+
+Synthetic benchmarks for the conversion steps. They do not need the
+databroker, rows are generated in memory the way h.data(..., fill=True)
+returns them.
+
+Run from the srx_autosave directory with
+    python benchmarks.py
+
+Andy Kiss
+"""
+import os
+import tempfile
+import time as ttime
+import tracemalloc
+import h5py
+import numpy as np
+
+from scan_reader import (fill_rows, DTYPE_POLICIES, policy_dtype, cast_checked, read_columns,
+                         fetch_concurrent)
+from hdf_writer import WRITE_PROFILES, dataset_options, write_chunks, create_map_dataset, write_map
+from resource_reader import ResourceReader
+from roi import roi_maps, read_roi_maps, iter_row_blocks
+from vds import XSP3_DATA_PATH
+
+
+def _fake_rows(num_rows, row_shape, dtype=np.uint32):
+    # One new array per row, like filled databroker events
+    for i in range(num_rows):
+        yield np.full(row_shape, i, dtype=dtype)
+
+
+def _measure(func):
+    tracemalloc.start()
+    t0 = ttime.perf_counter()
+    result = func()
+    dt = ttime.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, dt, peak
+
+
+def bench_bulk_read(rows=100, cols=100, N_ch=4, N_bins=4096):
+    """
+    Compare the peak memory of np.array(list(...)) and fill_rows
+
+    Returns
+    -------
+    results : dict
+        (time in s, peak memory in bytes) for each method
+    """
+
+    row_shape = (cols, N_ch, N_bins)
+    size = rows * np.prod(row_shape) * np.dtype(np.uint32).itemsize
+    print(f"Bulk read of a {rows}x{cols}x{N_ch}x{N_bins} map ({size / 1024**2:.0f} MB)")
+
+    results = {}
+    _, dt, peak = _measure(lambda: np.array(list(_fake_rows(rows, row_shape))))
+    results['np.array(list(...))'] = (dt, peak)
+    _, dt, peak = _measure(lambda: fill_rows(_fake_rows(rows, row_shape), rows))
+    results['fill_rows'] = (dt, peak)
+
+    for name, (dt, peak) in results.items():
+        print(f"  {name:24s} {dt:8.3f} s   peak {peak / 1024**2:8.0f} MB   ({peak / size:.2f}x data)")
+    return results
+
+
+def bench_sum_read(rows=100, cols=100, N_ch=4, N_bins=4096):
+    """
+    Compare reading all channels and summing with summing row by row
+
+    Returns
+    -------
+    results : dict
+        (time in s, peak memory in bytes) for each method
+    """
+
+    row_shape = (cols, N_ch, N_bins)
+    size = rows * np.prod(row_shape) * np.dtype(np.uint32).itemsize
+    print(f"Channel sum of a {rows}x{cols}x{N_ch}x{N_bins} map ({size / 1024**2:.0f} MB)")
+
+    results = {}
+    _, dt, peak = _measure(lambda: np.sum(fill_rows(_fake_rows(rows, row_shape), rows), axis=2))
+    results['fill_rows + np.sum'] = (dt, peak)
+    _, dt, peak = _measure(lambda: fill_rows(_fake_rows(rows, row_shape), rows, sum_axis=1))
+    results['fill_rows(sum_axis=1)'] = (dt, peak)
+
+    for name, (dt, peak) in results.items():
+        print(f"  {name:24s} {dt:8.3f} s   peak {peak / 1024**2:8.0f} MB   ({peak / size:.2f}x data)")
+    return results
+
+
+def _fake_spectra(rows, cols, N_bins=4096, dtype=np.uint64, seed=0):
+    # A few fluorescence peaks on a low background, with counting noise
+    rng = np.random.default_rng(seed)
+    e = np.arange(N_bins)
+    spectrum = 2 + sum(a * np.exp(-0.5 * ((e - c) / 12)**2)
+                       for a, c in [(200, 330), (80, 640), (150, 800), (40, 1080)])
+    scale = rng.uniform(0.2, 1.0, (rows, cols, 1))
+    return rng.poisson(spectrum * scale).astype(dtype)
+
+
+def bench_write_profiles(rows=64, cols=64, N_bins=4096, profiles=None, layout=None):
+    """
+    Write and read throughput of the HDF5 write profiles
+
+    Returns
+    -------
+    results : dict
+        (file size, write, ROI read and spectrum read throughput in bytes/s)
+        for each profile
+    """
+
+    if profiles is None:
+        profiles = list(WRITE_PROFILES)
+    data = _fake_spectra(rows, cols, N_bins)
+    print(f"Write profiles for a {rows}x{cols}x{N_bins} map ({data.nbytes / 1024**2:.0f} MB)")
+
+    rng = np.random.default_rng(1)
+    pixels = [(rng.integers(rows), rng.integers(cols)) for i in range(200)]
+    rois = [(316, 346), (215, 245), (730, 770), (780, 820), (1069, 1099)]
+    results = {}
+    with tempfile.TemporaryDirectory() as wd:
+        for profile in profiles:
+            fn = os.path.join(wd, f'{profile}.h5')
+            kw = dataset_options(profile, data.shape, data.dtype, spectra=True, layout=layout)
+            t0 = ttime.perf_counter()
+            with h5py.File(fn, 'w') as f:
+                f.create_dataset('counts', data=data, **kw)
+            t_write = ttime.perf_counter() - t0
+
+            with h5py.File(fn, 'r') as f:
+                ds = f['counts']
+                t0 = ttime.perf_counter()
+                nbytes = 0
+                for lo, hi in rois:
+                    nbytes += ds[:, :, lo:hi].nbytes
+                t_roi = ttime.perf_counter() - t0
+                roi_rate = nbytes / t_roi
+
+                t0 = ttime.perf_counter()
+                for i, j in pixels:
+                    ds[i, j, :]
+                t_pix = ttime.perf_counter() - t0
+                pix_rate = len(pixels) * N_bins * data.itemsize / t_pix
+
+            size = os.path.getsize(fn)
+            results[profile] = (size, data.nbytes / t_write, roi_rate, pix_rate)
+
+    print(f"  {'profile':14s} {'size':>6s} {'write':>10s} {'ROI read':>10s} {'spectrum':>10s}")
+    for profile, (size, w, roi, pix) in results.items():
+        print(f"  {profile:14s} {100 * size / data.nbytes:5.1f}% {w / 1e6:7.0f} MB/s "
+              f"{roi / 1e6:7.0f} MB/s {pix / 1e6:7.0f} MB/s")
+    return results
+
+
+def bench_parallel_compression(rows=64, cols=64, N_bins=4096, profile='gzip-1',
+                               threads=(1, 2, 4, 8)):
+    """
+    Write throughput of write_chunks against compression inside HDF5
+
+    Returns
+    -------
+    results : dict
+        Write throughput in bytes/s for HDF5 and for each number of threads
+    """
+
+    data = _fake_spectra(rows, cols, N_bins)
+    kw = dataset_options(profile, data.shape, data.dtype, spectra=True)
+    print(f"Parallel {profile} compression of a {rows}x{cols}x{N_bins} map "
+          f"({data.nbytes / 1024**2:.0f} MB, {os.cpu_count()} cores)")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as wd:
+        fn = os.path.join(wd, 'hdf5.h5')
+        t0 = ttime.perf_counter()
+        with h5py.File(fn, 'w') as f:
+            f.create_dataset('counts', data=data, **kw)
+        results['HDF5'] = data.nbytes / (ttime.perf_counter() - t0)
+        size = os.path.getsize(fn)
+
+        for n in threads:
+            fn = os.path.join(wd, f'{n}.h5')
+            t0 = ttime.perf_counter()
+            with h5py.File(fn, 'w') as f:
+                ds = f.create_dataset('counts', shape=data.shape, dtype=data.dtype, **kw)
+                write_chunks(ds, data, num_threads=n)
+            results[f'{n} threads'] = data.nbytes / (ttime.perf_counter() - t0)
+            with h5py.File(fn, 'r') as f:
+                assert np.array_equal(f['counts'][()], data)
+            if os.path.getsize(fn) != size:
+                print(f"  Warning: file size {os.path.getsize(fn)} != {size}")
+
+    for name, rate in results.items():
+        print(f"  {name:12s} {rate / 1e6:7.0f} MB/s  {rate / results['HDF5']:5.2f}x")
+    return results
+
+
+def bench_snake_write(rows=128, cols=128, N_bins=4096, profile='uncompressed'):
+    """
+    Peak memory and time of writing a transposed snake map
+
+    Compares flipping and transposing the whole map in memory before the
+    write with write_map, which reorders one block at a time.
+
+    Returns
+    -------
+    results : dict
+        (time in s, peak memory in bytes) for each method
+    """
+
+    data = _fake_spectra(rows, cols, N_bins, dtype=np.uint32)
+    print(f"Snake and transpose write of a {rows}x{cols}x{N_bins} map "
+          f"({data.nbytes / 1024**2:.0f} MB, {profile})")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as wd:
+        def _in_memory():
+            d = data.copy()  # the flip is in place on the original data
+            d[1::2] = d[1::2, ::-1]
+            d = np.swapaxes(d, 0, 1)
+            kw = dataset_options(profile, d.shape, d.dtype, spectra=True)
+            with h5py.File(os.path.join(wd, 'a.h5'), 'w') as f:
+                f.create_dataset('counts', data=d, **kw)
+
+        def _write_map():
+            with h5py.File(os.path.join(wd, 'b.h5'), 'w') as f:
+                ds = create_map_dataset(f, 'counts', data.shape, data.dtype, transpose=True,
+                                        write_profile=profile)
+                write_map(ds, data, snake=True, transpose=True)
+
+        _, dt, peak = _measure(_in_memory)
+        # The copy of the data is not part of the old method
+        results['in memory'] = (dt, peak - data.nbytes)
+        _, dt, peak = _measure(_write_map)
+        results['write_map'] = (dt, peak)
+        with h5py.File(os.path.join(wd, 'a.h5'), 'r') as a, \
+                h5py.File(os.path.join(wd, 'b.h5'), 'r') as b:
+            assert np.array_equal(a['counts'][()], b['counts'][()])
+
+    for name, (dt, peak) in results.items():
+        print(f"  {name:12s} {dt:6.2f} s  peak {peak / 1024**2:7.1f} MB "
+              f"({peak / data.nbytes:.2f}x the map)")
+    return results
+
+
+def bench_dtype_policy(rows=64, cols=64, N_bins=4096, profile='gzip-1'):
+    """
+    File size and write time of the detector sum for each dtype policy
+
+    Returns
+    -------
+    results : dict
+        (file size in bytes, write time in s) for each policy
+    """
+
+    # Sum of 4 channels of uint32 counts, numpy makes it uint64
+    data = np.sum([_fake_spectra(rows, cols, N_bins, dtype=np.uint32, seed=i) for i in range(4)],
+                  axis=0)
+    print(f"dtype policies for a {rows}x{cols}x{N_bins} sum ({profile})")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as wd:
+        for policy in DTYPE_POLICIES:
+            d = cast_checked(data, policy_dtype(policy))
+            fn = os.path.join(wd, f'{policy}.h5')
+            t0 = ttime.perf_counter()
+            with h5py.File(fn, 'w') as f:
+                ds = create_map_dataset(f, 'counts', d.shape, d.dtype, write_profile=profile)
+                write_map(ds, d)
+            results[policy] = (os.path.getsize(fn), ttime.perf_counter() - t0, d.nbytes)
+
+    for policy, (size, dt, nbytes) in results.items():
+        print(f"  {policy:8s} {nbytes / 1024**2:6.0f} MB in memory {size / 1024**2:6.1f} MB file "
+              f"{dt:6.2f} s")
+    return results
+
+
+class _FakeStepHeader(object):
+    # Step scan events holding one datum per channel and point
+    def __init__(self, keys, num_points):
+        self.keys = keys
+        self.num_points = num_points
+
+    def events(self, stream_name='primary', fields=None, fill=False):
+        for p in range(self.num_points):
+            yield {'seq_num': p + 1, 'data': {k: f'{k}/{p}' for k in fields}}
+
+
+class _FakeRegistry(object):
+    # All datums in one XSP3_STEP resource file
+    def __init__(self, fname, keys, num_points):
+        self.res = {'uid': 'res', 'spec': 'XSP3_STEP', 'root': '', 'resource_path': fname}
+        self.datums = [{'datum_id': f'{k}/{p}', 'datum_kwargs': {'frame': p, 'channel': i + 1}}
+                       for i, k in enumerate(keys) for p in range(num_points)]
+
+    def resource_given_datum_id(self, datum_id):
+        return self.res
+
+    def datum_gen_given_resource(self, res):
+        return iter(self.datums)
+
+
+def _handler_fill(h, reg, keys, fn, num_points):
+    # Per event filling like the databroker, one handler call per datum
+    datums = {d['datum_id']: d['datum_kwargs'] for d in reg.datum_gen_given_resource(reg.res)}
+    out = None
+    with h5py.File(fn, 'r') as f:
+        ds = f[XSP3_DATA_PATH]
+        for p, ev in enumerate(h.events(fields=keys, fill=False)):
+            for i, k in enumerate(keys):
+                kw = datums[ev['data'][k]]
+                spectrum = ds[kw['frame'], kw['channel'] - 1]
+                if out is None:
+                    out = np.empty((len(keys), num_points) + spectrum.shape, dtype=spectrum.dtype)
+                out[i, p] = spectrum
+    return out
+
+
+def bench_resource_read(rows=32, cols=32, N_ch=4, N_bins=4096, chunks=None, compression=None):
+    """
+    Compare per-datum filling of a step scan with ResourceReader
+
+    Both read the same synthetic Xspress3 resource file in process, so
+    only the reading is compared. The databroker queries and event
+    handling of real filling come on top of the per-datum time.
+
+    Returns
+    -------
+    results : dict
+        Time in s for each method
+    """
+
+    num_points = rows * cols
+    keys = [f'xs_channel{i+1}' for i in range(N_ch)]
+    data = _fake_spectra(num_points, N_ch, N_bins, dtype=np.uint32)
+    print(f"Resource read of a {rows}x{cols} step scan, {N_ch}x{N_bins} "
+          f"({data.nbytes / 1024**2:.0f} MB, chunks {chunks}, {compression})")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as wd:
+        fn = os.path.join(wd, 'xs_step.h5')
+        with h5py.File(fn, 'w') as f:
+            f.create_dataset(XSP3_DATA_PATH, data=data, chunks=chunks, compression=compression)
+        h = _FakeStepHeader(keys, num_points)
+        reg = _FakeRegistry(fn, keys, num_points)
+
+        methods = [('per datum', lambda: _handler_fill(h, reg, keys, fn, num_points)),
+                   ('ResourceReader', lambda: ResourceReader(h, reg).read_channels(keys))]
+        for name, func in methods:
+            t0 = ttime.perf_counter()
+            out = func()
+            results[name] = ttime.perf_counter() - t0
+            assert np.array_equal(out, np.moveaxis(data, 1, 0))
+
+    for name, dt in results.items():
+        print(f"  {name:16s} {dt:8.3f} s   {data.nbytes / 1024**2 / dt:8.0f} MB/s")
+    return results
+
+
+class _SlowHeader(object):
+    # Events of each stream arrive with a fixed wait per event, like a database
+    def __init__(self, num_rows, cols, wait):
+        self.num_rows = num_rows
+        self.cols = cols
+        self.wait = wait
+        self.stop = {'num_events': {'stream0': num_rows, 'primary': num_rows}}
+
+    def events(self, stream_name='primary', fields=None, fill=False):
+        for i in range(self.num_rows):
+            ttime.sleep(self.wait[fields[0]])
+            yield {'seq_num': i + 1, 'data': {k: np.full(self.cols, i, dtype=float)
+                                              for k in fields}}
+
+
+def bench_concurrent_fetch(rows=50, cols=100, num_threads=4):
+    """
+    Compare reading the streams of a fly scan one after another and at the same time
+
+    Each stream waits a few ms per event (positions and scalers 2 ms, slow
+    axis 1 ms, each detector 4 ms) to stand for the database and file
+    system latency.
+
+    Returns
+    -------
+    results : dict
+        Time in s for each method
+    """
+
+    wait = {'enc1': 0.002, 'y': 0.001, 'fluor': 0.004, 'fluor_xs2': 0.004}
+    h = _SlowHeader(rows, cols, wait)
+    tasks = {'cols': lambda: read_columns(h, ['enc1', 'i0', 'im', 'it'], stream_name='stream0'),
+             'slow': lambda: read_columns(h, ['y'], stream_name='primary'),
+             'xs': lambda: read_columns(h, ['fluor'], stream_name='stream0'),
+             'xs2': lambda: read_columns(h, ['fluor_xs2'], stream_name='stream0')}
+    print(f"Fetch of 4 streams of {rows} rows, slowest {rows * max(wait.values()):.1f} s, "
+          f"sum {rows * sum(wait.values()):.1f} s")
+
+    results = {}
+    for name, n in [('one after another', 1), (f'{num_threads} threads', num_threads)]:
+        t0 = ttime.perf_counter()
+        fetch_concurrent(tasks, num_threads=n)
+        results[name] = ttime.perf_counter() - t0
+
+    for name, dt in results.items():
+        print(f"  {name:18s} {dt:8.3f} s")
+    return results
+
+
+def _fake_rois(num, seed=0):
+    # Windows of 30 to 40 bins between 1 and 11 keV
+    rng = np.random.default_rng(seed)
+    lo = rng.integers(100, 1060, num)
+    return {f'el{i}': [int(l), int(l + rng.integers(30, 41))] for i, l in enumerate(lo)}
+
+
+def bench_roi_maps(rows=128, cols=128, N_bins=4096, profile='default', counts=(5, 30)):
+    """
+    Compare slicing the detector sum once per element with roi_maps
+
+    Returns
+    -------
+    results : dict
+        Time in s of each method for each number of elements
+    """
+
+    data = _fake_spectra(rows, cols, N_bins)
+    print(f"ROI maps of a {rows}x{cols}x{N_bins} detector sum ({profile})")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as wd:
+        fn = os.path.join(wd, 'detsum.h5')
+        with h5py.File(fn, 'w') as f:
+            ds = create_map_dataset(f, 'counts', data.shape, data.dtype, write_profile=profile)
+            write_map(ds, data)
+
+        for num in counts:
+            rois = _fake_rois(num)
+            with h5py.File(fn, 'r') as f:
+                ds = f['counts']
+                t0 = ttime.perf_counter()
+                slices = {x: np.sum(ds[:, :, lo:hi], axis=2) for x, (lo, hi) in rois.items()}
+                results[('per element', num)] = ttime.perf_counter() - t0
+                t0 = ttime.perf_counter()
+                maps = roi_maps(ds, rois)
+                results[('roi_maps', num)] = ttime.perf_counter() - t0
+            assert all(np.array_equal(slices[x], maps[x]) for x in rois)
+
+    for (name, num), dt in results.items():
+        print(f"  {name:12s} {num:3d} elements {dt:8.3f} s")
+    return results
+
+
+def bench_roi_stream(rows=256, cols=256, N_bins=4096, profile='gzip-1', layout=None, num=5):
+    """
+    Peak memory and time of the ROI maps of a large file
+
+    Compares reading the bins of the windows for the whole map at once,
+    read_roi_maps (blocks of chunk rows through a tuned chunk cache) and
+    reading the same blocks without computing anything.
+
+    Returns
+    -------
+    results : dict
+        (time in s, peak memory in bytes) for each method
+    """
+
+    rois = _fake_rois(num)
+    b0 = min(lo for lo, hi in rois.values())
+    b1 = max(hi for lo, hi in rois.values())
+    results = {}
+    with tempfile.TemporaryDirectory() as wd:
+        fn = os.path.join(wd, 'scan2D_1_xs_sum4ch.h5')
+        with h5py.File(fn, 'w') as f:
+            ds = create_map_dataset(f, 'xrfmap/detsum/counts', (rows, cols, N_bins), np.uint32,
+                                    write_profile=profile, chunk_layout=layout)
+            for i in range(0, rows, 16):
+                write_map(ds, _fake_spectra(min(16, rows - i), cols, N_bins, np.uint32, seed=i), i)
+            f['xrfmap/scalers/val'] = np.ones((rows, cols, 4))
+            chunks = ds.chunks
+        size = rows * cols * (b1 - b0) * 4
+        print(f"ROI maps of a {rows}x{cols}x{N_bins} uint32 file ({profile}, chunks {chunks}), "
+              f"{num} windows over {size / 1024**2:.0f} MB of bins")
+
+        def _whole():
+            with h5py.File(fn, 'r') as f:
+                i0 = f['xrfmap/scalers/val'][:, :, 0]
+                return roi_maps(f['xrfmap/detsum/counts'][:, :, b0:b1],
+                                {x: [lo - b0, hi - b0] for x, (lo, hi) in rois.items()},
+                                block_bytes=2**40), i0
+
+        def _read_only():
+            with h5py.File(fn, 'r') as f:
+                for _ in iter_row_blocks(f['xrfmap/detsum/counts'], (b0, b1)):
+                    pass
+
+        for name, func in [('whole slab', _whole), ('read_roi_maps', lambda: read_roi_maps(fn, rois)),
+                           ('read blocks only', _read_only)]:
+            _, dt, peak = _measure(func)
+            results[name] = (dt, peak)
+
+    for name, (dt, peak) in results.items():
+        print(f"  {name:16s} {dt:8.3f} s {size / 1024**2 / dt:8.0f} MB/s   peak {peak / 1024**2:8.0f} MB")
+    return results
+
+
+if __name__ == "__main__":
+    bench_bulk_read()
+    bench_sum_read()
+    bench_write_profiles()
+    bench_write_profiles(profiles=['fast-lzf', 'gzip-1', 'gzip-4'], layout='roi')
+    bench_parallel_compression()
+    bench_parallel_compression(profile='default')
+    bench_snake_write()
+    bench_dtype_policy()
+    bench_resource_read()
+    bench_resource_read(chunks=(1, 4, 4096), compression='gzip')
+    bench_concurrent_fetch()
+    bench_roi_maps()
+    bench_roi_stream()
+    bench_roi_stream(layout='roi')
@@ -0,0 +1,275 @@
+"""
+SRX Autosave document sources
+
+Event-driven scan discovery. A document source delivers the (name, doc)
+pairs emitted by the RunEngine to subscribed callbacks, so finished scans
+can be queued for conversion as soon as their stop document arrives
+instead of waiting for the next polling cycle.
+
+Andy Kiss
+"""
+import json
+import os
+import queue
+import threading
+import time as ttime
+
+try:
+    from bluesky.callbacks.zmq import RemoteDispatcher
+except ImportError:
+    RemoteDispatcher = None
+
+
+class DocumentSource(object):
+    """
+    Base class for document sources
+
+    Subclasses implement `_run`, which must call `self.emit(name, doc)` for
+    every received document and return once `self._stop_event` is set.
+    """
+
+    def __init__(self):
+        self._callbacks = []
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def subscribe(self, func):
+        """
+        Register a callback with signature func(name, doc)
+        """
+        self._callbacks.append(func)
+
+    def unsubscribe(self, func):
+        """
+        Remove a callback registered with subscribe
+        """
+        if func in self._callbacks:
+            self._callbacks.remove(func)
+
+    def emit(self, name, doc):
+        for func in list(self._callbacks):
+            try:
+                func(name, doc)
+            except Exception as ex:
+                print(f"Error in document callback: {ex}")
+
+    def start(self):
+        """
+        Start listening for documents in a background thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop listening and wait for the background thread to finish
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class ZMQDocumentSource(DocumentSource):
+    """
+    Document source for the beamline 0MQ proxy
+
+    Parameters
+    ----------
+    address : string or tuple
+        Address of the 0MQ proxy output, e.g. 'xf05id-ws1:5578'
+    prefix : bytes
+        Optional 0MQ topic prefix
+    """
+
+    def __init__(self, address, prefix=b''):
+        super().__init__()
+        if RemoteDispatcher is None:
+            raise ImportError("bluesky is required to subscribe to the 0MQ proxy.")
+        self.address = address
+        self.prefix = prefix
+        self._dispatcher = None
+
+    def _run(self):
+        import asyncio
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self._dispatcher = RemoteDispatcher(self.address, prefix=self.prefix)
+        self._dispatcher.subscribe(self.emit)
+        self._dispatcher.start()
+
+    def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.loop.call_soon_threadsafe(self._dispatcher.stop)
+        super().stop()
+        self._dispatcher = None
+
+
+class FileDocumentSource(DocumentSource):
+    """
+    Document source that follows a JSON-lines file
+
+    This is the local stand-in for the 0MQ proxy used for testing. Each
+    line of the file is a JSON list [name, doc], as written by
+    FileDocumentPublisher.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the document file
+    poll_interval : float
+        Time, in seconds, to wait for new lines at the end of the file
+    from_start : bool
+        If False, documents already in the file are skipped
+    """
+
+    def __init__(self, fname, poll_interval=0.005, from_start=False):
+        super().__init__()
+        self.fname = fname
+        self.poll_interval = poll_interval
+        self.from_start = from_start
+
+    def _run(self):
+        # Wait for the publisher to create the file. Everything in a file
+        #   created after we started listening is new.
+        skip_existing = not self.from_start
+        while not os.path.isfile(self.fname):
+            skip_existing = False
+            if self._stop_event.wait(self.poll_interval):
+                return
+
+        with open(self.fname, 'r') as f:
+            if skip_existing:
+                f.seek(0, os.SEEK_END)
+            buf = ''
+            while not self._stop_event.is_set():
+                line = f.readline()
+                if not line:
+                    self._stop_event.wait(self.poll_interval)
+                    continue
+                buf += line
+                if not buf.endswith('\n'):
+                    # Partially written line, wait for the rest
+                    continue
+                try:
+                    name, doc = json.loads(buf)
+                except ValueError:
+                    print(f"Skipping malformed document line: {buf[:80]}")
+                else:
+                    self.emit(name, doc)
+                buf = ''
+
+
+class FileDocumentPublisher(object):
+    """
+    Append documents to a JSON-lines file read by FileDocumentSource
+
+    Can be subscribed directly to a RunEngine, RE.subscribe(publisher),
+    or called by hand to replay documents for testing.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the document file
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __call__(self, name, doc):
+        line = json.dumps([name, doc], default=str)
+        with open(self.fname, 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+
+
+def unpack_event_page(page):
+    """
+    Return the events of an event page
+    """
+    events = []
+    for i, seq_num in enumerate(page['seq_num']):
+        events.append({'descriptor': page['descriptor'],
+                       'uid': page['uid'][i],
+                       'seq_num': seq_num,
+                       'time': page['time'][i],
+                       'data': {k: v[i] for k, v in page['data'].items()},
+                       'timestamps': {k: v[i] for k, v in page['timestamps'].items()},
+                       'filled': {k: v[i] for k, v in page.get('filled', {}).items()}})
+    return events
+
+
+class ScanStopWatcher(object):
+    """
+    Document callback that queues XRF scans when their stop document arrives
+
+    Parameters
+    ----------
+    scan_queue : queue.Queue
+        Queue receiving (scanid, time) for every finished scan
+    scan_types : list
+        Scan types to queue, all others are ignored
+    min_id : int
+        Scans with a lower scan ID are ignored
+    start_queue : queue.Queue, optional
+        Queue receiving (scanid, time) when the start document arrives.
+        The descriptors and events of those scans are then also put in
+        run_docs[scanid], a queue of (name, doc), for following the scan
+        while it runs.
+    """
+
+    def __init__(self, scan_queue, scan_types=('XRF_FLY',), min_id=0, start_queue=None):
+        self.scan_queue = scan_queue
+        self.start_queue = start_queue
+        self.scan_types = scan_types
+        self.min_id = min_id
+        self.run_docs = {}
+        self._starts = {}
+        # Queue of the documents of each followed run and descriptor, by uid
+        self._followed = {}
+
+    def __call__(self, name, doc):
+        if name == 'start':
+            try:
+                scan_type = doc['scan']['type']
+            except (KeyError, TypeError):
+                scan_type = None
+            scanid = doc.get('scan_id')
+            self._starts[doc['uid']] = (scanid, scan_type)
+            if (self.start_queue is not None and scan_type in self.scan_types
+                    and scanid is not None and scanid >= self.min_id):
+                docs = queue.Queue()
+                self.run_docs[int(scanid)] = docs
+                self._followed[doc['uid']] = docs
+                self.start_queue.put((int(scanid), ttime.time()))
+        elif name == 'descriptor':
+            docs = self._followed.get(doc.get('run_start'))
+            if docs is not None:
+                self._followed[doc['uid']] = docs
+                docs.put((name, doc))
+        elif name == 'event':
+            docs = self._followed.get(doc.get('descriptor'))
+            if docs is not None:
+                docs.put((name, doc))
+        elif name == 'event_page':
+            docs = self._followed.get(doc.get('descriptor'))
+            if docs is not None:
+                for event in unpack_event_page(doc):
+                    docs.put(('event', event))
+        elif name == 'stop':
+            docs = self._followed.pop(doc.get('run_start'), None)
+            if docs is not None:
+                for uid in [k for k, v in self._followed.items() if v is docs]:
+                    del self._followed[uid]
+            scanid, scan_type = self._starts.pop(doc.get('run_start'), (None, None))
+            if scanid is None:
+                # Start document was emitted before we subscribed.
+                # The polling fallback will pick this scan up.
+                return
+            if scan_type in self.scan_types and scanid >= self.min_id:
+                self.scan_queue.put((int(scanid), ttime.time()))
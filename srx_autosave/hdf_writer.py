@@ -0,0 +1,379 @@
+"""
+SRX Autosave HDF5 write profiles
+
+Named compression and chunking settings for the datasets written by
+new_makehdf. The chunk layout decides which reads are fast later on:
+
+    'spectrum'  one chunk holds full spectra of a few pixels of one row,
+                fast for per-pixel spectrum reads (pyxrf fitting, viewer)
+    'roi'       one chunk holds a narrow energy window over many pixels,
+                fast for ROI maps, f['xrfmap/detsum/counts'][:, :, lo:hi]
+    None        h5py chooses the chunk shape (previous behavior)
+
+Profiles, 64x64x4096 synthetic uint64 map (128 MB) written from memory,
+see benchmarks.bench_write_profiles (single core, throughput of the
+uncompressed data):
+
+    profile        layout     size   write      ROI read   spectrum read
+    default        h5py       8.7%    96 MB/s    17 MB/s     22 MB/s
+    uncompressed   spectrum   100%  1399 MB/s    31 MB/s    719 MB/s
+    fast-lzf       spectrum   8.8%   215 MB/s     2 MB/s     73 MB/s
+    gzip-1         spectrum   5.9%   170 MB/s     4 MB/s    106 MB/s
+    gzip-4         spectrum   5.3%   112 MB/s     3 MB/s     93 MB/s
+    uncompressed   roi        100%  1498 MB/s   828 MB/s      3 MB/s
+    fast-lzf       roi        8.7%   215 MB/s   115 MB/s     <1 MB/s
+    gzip-1         roi        5.4%   176 MB/s   145 MB/s     <1 MB/s
+    gzip-4         roi        4.9%   120 MB/s   146 MB/s     <1 MB/s
+
+Run python benchmarks.py on the analysis machine for numbers that match
+real data, the ratios between profiles are what matters here.
+
+Compression inside HDF5 runs on a single core. write_chunks compresses
+the chunks of gzip datasets in a thread pool instead (zlib releases the
+GIL) and stores them with direct chunk writes. The chunks are the same
+bytes HDF5 would have written, so the files read normally in h5py and
+pyxrf. Other filters (lzf) are written the normal way.
+
+Andy Kiss
+"""
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import numpy as np
+
+
+# Target size of one chunk, in bytes. Spectrum chunks are kept small so a
+#   single pixel read only decompresses the spectra of a few pixels.
+ROI_CHUNK_BYTES = 2**20
+SPECTRUM_CHUNK_BYTES = 2**17
+
+# Size of the reordered row blocks written by write_map, in bytes
+WRITE_BLOCK_BYTES = 2**26
+
+WRITE_PROFILES = {
+    # gzip level 4 with the h5py chunk shape, as written before profiles existed
+    'default': {'compression': 'gzip', 'layout': None},
+    'uncompressed': {'layout': 'spectrum'},
+    'fast-lzf': {'compression': 'lzf', 'shuffle': True, 'layout': 'spectrum'},
+    'gzip-1': {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True, 'layout': 'spectrum'},
+    'gzip-4': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True, 'layout': 'spectrum'},
+}
+
+
+def _get_profile(profile):
+    if profile in WRITE_PROFILES:
+        return dict(WRITE_PROFILES[profile])
+    # Any other gzip level, e.g. 'gzip-6'
+    if profile.startswith('gzip-'):
+        try:
+            level = int(profile[5:])
+        except ValueError:
+            level = -1
+        if 0 <= level <= 9:
+            return {'compression': 'gzip', 'compression_opts': level, 'shuffle': True,
+                    'layout': 'spectrum'}
+    raise ValueError(f"Unknown write profile '{profile}'. "
+                     f"Use one of {list(WRITE_PROFILES)} or 'gzip-N'.")
+
+
+def spectrum_chunks(shape, dtype, layout='spectrum'):
+    """
+    Chunk shape for a spectra dataset (..., bins)
+
+    Parameters
+    ----------
+    shape : tuple
+        Dataset shape, the last axis are the energy bins
+    dtype : numpy dtype
+        Dataset type
+    layout : string
+        'spectrum' or 'roi'
+
+    Returns
+    -------
+    chunks : tuple
+    """
+
+    itemsize = np.dtype(dtype).itemsize
+    shape = tuple(max(1, n) for n in shape)
+    if len(shape) != 3:
+        return None
+    rows, cols, N_bins = shape
+    if layout == 'roi':
+        # Narrow energy window over whole rows
+        n_e = min(N_bins, 64)
+        n_c = min(cols, max(1, ROI_CHUNK_BYTES // (n_e * itemsize)))
+        n_r = min(rows, max(1, ROI_CHUNK_BYTES // (n_c * n_e * itemsize)))
+        return (n_r, n_c, n_e)
+    # Full spectra of a few pixels in one row
+    n_c = min(cols, max(1, SPECTRUM_CHUNK_BYTES // (N_bins * itemsize)))
+    return (1, n_c, N_bins)
+
+
+def dataset_options(profile='default', shape=None, dtype=None, spectra=False, layout=None):
+    """
+    Keyword arguments for h5py create_dataset for a write profile
+
+    Parameters
+    ----------
+    profile : string
+        Name of the write profile, see WRITE_PROFILES
+    shape : tuple, optional
+        Dataset shape, needed for the chunk shape of spectra
+    dtype : numpy dtype, optional
+        Dataset type, needed for the chunk shape of spectra
+    spectra : bool
+        True for detector spectra, (rows, columns, bins). Positions and
+        scalers get the compression of the profile with automatic chunks.
+    layout : string, optional
+        Override the chunk layout of the profile, 'spectrum' or 'roi'
+
+    Returns
+    -------
+    kwargs : dict
+
+    Examples
+    --------
+    >>> kw = dataset_options('fast-lzf', d.shape, d.dtype, spectra=True)
+    >>> grp.create_dataset('counts', data=d, **kw)
+    """
+
+    opts = _get_profile(profile)
+    profile_layout = opts.pop('layout')
+    if not spectra:
+        if profile == 'default':
+            # Positions and scalers were always written uncompressed
+            return {}
+        return opts
+    if layout is None:
+        layout = profile_layout
+    if layout is not None and shape is not None:
+        chunks = spectrum_chunks(shape, dtype, layout=layout)
+        if chunks is not None:
+            opts['chunks'] = chunks
+    return opts
+
+
+def _compress_chunk(chunk, level, shuffle):
+    """
+    Apply the HDF5 shuffle and deflate filters to one chunk
+    """
+    data = np.ascontiguousarray(chunk)
+    if shuffle and data.itemsize > 1:
+        # Byte 0 of every element, then byte 1, ...
+        data = np.ascontiguousarray(data.view(np.uint8).reshape(-1, data.itemsize).T)
+    return zlib.compress(data.tobytes(), level)
+
+
+def _chunk_slices(ds, offset, shape):
+    """
+    Chunks of ds that intersect the region offset:offset+shape
+
+    Yields (chunk offset, selection in ds, selection in the data, full),
+    full is True if the region covers the whole chunk.
+    """
+    ranges = []
+    for o, n, c, size in zip(offset, shape, ds.chunks, ds.shape):
+        ranges.append(range((o // c) * c, o + n, c))
+    for start in itertools.product(*ranges):
+        sel_ds, sel_data, full = [], [], True
+        for s, o, n, c, size in zip(start, offset, shape, ds.chunks, ds.shape):
+            lo, hi = max(s, o), min(s + c, o + n, size)
+            full = full and lo == s and hi == min(s + c, size)
+            sel_ds.append(slice(lo, hi))
+            sel_data.append(slice(lo - o, hi - o))
+        yield start, tuple(sel_ds), tuple(sel_data), full
+
+
+def write_chunks(ds, data, offset=None, num_threads=None):
+    """
+    Write data into a chunked dataset, compressing the chunks in parallel
+
+    Parameters
+    ----------
+    ds : h5py.Dataset
+        Chunked dataset. Only gzip datasets (with or without shuffle) are
+        compressed in parallel, anything else is written with ds[...] = data.
+    data : ndarray
+        Data to write
+    offset : tuple, optional
+        Position of data[0, 0, ...] in ds, defaults to the origin
+    num_threads : int, optional
+        Number of compression threads, defaults to the number of cores
+
+    Examples
+    --------
+    >>> ds = grp.create_dataset('counts', shape=d.shape, dtype=d.dtype, compression='gzip')
+    >>> write_chunks(ds, d)
+    """
+
+    if offset is None:
+        offset = (0,) * data.ndim
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    region = tuple(slice(o, o + n) for o, n in zip(offset, data.shape))
+    if ds.chunks is None or ds.compression != 'gzip' or num_threads < 2 \
+            or ds.fletcher32 or ds.scaleoffset is not None:
+        ds[region] = data
+        return
+
+    level = ds.compression_opts
+    shuffle = ds.shuffle
+    dtype = ds.dtype
+    chunk_shape = ds.chunks
+
+    def _compress(item):
+        start, sel_ds, sel_data, full = item
+        if not full:
+            return None
+        chunk = np.asarray(data[sel_data], dtype=dtype)
+        if chunk.shape != chunk_shape:
+            # Edge chunks are stored at full size
+            tmp = np.zeros(chunk_shape, dtype=dtype)
+            tmp[tuple(slice(0, n) for n in chunk.shape)] = chunk
+            chunk = tmp
+        return _compress_chunk(chunk, level, shuffle)
+
+    items = list(_chunk_slices(ds, offset, data.shape))
+    with ThreadPoolExecutor(max_workers=num_threads) as ex:
+        for item, buf in zip(items, ex.map(_compress, items)):
+            start, sel_ds, sel_data, full = item
+            if buf is None:
+                # Chunk only partly covered, let HDF5 merge it
+                ds[sel_ds] = data[sel_data]
+            else:
+                ds.id.write_direct_chunk(start, buf)
+
+
+def create_dataset(grp, name, data, profile='default', spectra=False, layout=None,
+                   num_threads=None):
+    """
+    Create a dataset for a write profile and fill it with write_chunks
+
+    Same result as grp.create_dataset(name, data=data, **dataset_options(...)),
+    with the compression spread over num_threads cores.
+
+    Returns
+    -------
+    ds : h5py.Dataset
+    """
+
+    data = np.asarray(data)
+    kw = dataset_options(profile, data.shape, data.dtype, spectra=spectra, layout=layout)
+    if data.ndim == 0 or 'compression' not in kw:
+        return grp.create_dataset(name, data=data, **kw)
+    ds = grp.create_dataset(name, shape=data.shape, dtype=data.dtype, **kw)
+    write_chunks(ds, data, num_threads=num_threads)
+    return ds
+
+
+def reorder_rows(block, i0=0, snake=False, transpose=False):
+    """
+    Copy a block of map rows into the order of the file
+
+    Snake rows are reversed and y scans transposed in the same copy, so
+    no other temporary arrays are made.
+
+    Parameters
+    ----------
+    block : ndarray
+        Rows in the order they were measured, (rows, columns, ...)
+    i0 : int
+        Map row of block[0], decides which rows are reversed
+    snake : bool
+        Reverse the odd rows of the map
+    transpose : bool
+        Return (columns, rows, ...)
+
+    Returns
+    -------
+    out : ndarray
+        Contiguous array, or block itself if there is nothing to do
+    """
+
+    if not snake and not transpose:
+        return block
+    if transpose:
+        out = np.empty((block.shape[1], block.shape[0]) + block.shape[2:], dtype=block.dtype)
+        dst = np.swapaxes(out, 0, 1)
+    else:
+        out = np.empty_like(block)
+        dst = out
+    if snake:
+        even, odd = i0 % 2, (i0 + 1) % 2
+        dst[even::2] = block[even::2]
+        dst[odd::2] = block[odd::2, ::-1]
+    else:
+        dst[...] = block
+    return out
+
+
+def write_map(ds, data, i0=0, snake=False, transpose=False, num_threads=None):
+    """
+    Write map rows into a dataset, correcting snake and transposed scans
+
+    The rows are reordered one block at a time while they are written, so
+    the map in memory is never flipped or transposed as a whole.
+
+    Parameters
+    ----------
+    ds : h5py.Dataset
+        Destination, (rows, columns, ...) or (columns, rows, ...) if transposed
+    data : ndarray
+        Rows in the order they were measured, (rows, columns, ...)
+    i0 : int
+        Map row of data[0]
+    snake : bool
+        Reverse the odd rows of the map
+    transpose : bool
+        Swap rows and columns (y fly scans)
+    num_threads : int, optional
+        Number of compression threads, defaults to the number of cores
+    """
+
+    num_rows = data.shape[0]
+    row_bytes = max(1, data[:1].nbytes)
+    step = int(max(1, WRITE_BLOCK_BYTES // row_bytes))
+    if ds.chunks is not None:
+        # Whole chunks per block, so the chunks can be compressed in parallel
+        chunk_rows = ds.chunks[1 if transpose else 0]
+        step = max(chunk_rows, step - step % chunk_rows)
+    for j in range(0, num_rows, step):
+        block = reorder_rows(data[j:j+step], i0 + j, snake=snake, transpose=transpose)
+        offset = [0] * ds.ndim
+        offset[1 if transpose else 0] = i0 + j
+        write_chunks(ds, block, offset=tuple(offset), num_threads=num_threads)
+
+
+def create_map_dataset(grp, name, data_shape, dtype, transpose=False, write_profile='default',
+                       chunk_layout=None):
+    """
+    Create the spectra dataset of a map for write_map
+
+    Parameters
+    ----------
+    grp : h5py.Group
+        Parent group
+    name : string
+        Dataset name
+    data_shape : tuple
+        Shape of the data in the order it was measured, (rows, columns, bins)
+    dtype : numpy dtype
+        Dataset type
+    transpose : bool
+        Create the dataset as (columns, rows, bins)
+    write_profile : string
+        Write profile, see WRITE_PROFILES
+    chunk_layout : string, optional
+        Override the chunk layout of the profile
+
+    Returns
+    -------
+    ds : h5py.Dataset
+    """
+    shape = tuple(data_shape)
+    if transpose:
+        shape = (shape[1], shape[0]) + shape[2:]
+    kw = dataset_options(write_profile, shape, dtype, spectra=True, layout=chunk_layout)
+    return grp.create_dataset(name, shape=shape, dtype=dtype, **kw)
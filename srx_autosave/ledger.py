@@ -0,0 +1,220 @@
+"""
+SRX Autosave ledger
+
+Small SQLite database in the working directory that records what has
+already been done for each scan ID, so finished scans are not looked up
+in the databroker again on every cycle and a restart resumes immediately.
+
+Andy Kiss
+"""
+import sqlite3
+import threading
+import time as ttime
+
+
+LEDGER_FNAME = "srx_autosave_ledger.db"
+
+# Scan states
+NON_XRF = 'non-xrf'
+CONVERTED = 'converted'
+FAILED = 'failed'
+INCOMPLETE = 'incomplete'
+MISSING = 'missing'  # Scan ID was skipped, a newer scan exists
+
+# Scans in these states are never examined again
+FINISHED_STATES = (NON_XRF, CONVERTED, MISSING)
+
+# Failed conversions are tried again, e.g. the resource files of a scan
+#   converted right after its stop document may not be flushed yet. The
+#   delay, in seconds, doubles after each failure and the scan is finished
+#   after FAILED_ATTEMPTS failures.
+FAILED_ATTEMPTS = 3
+FAILED_RETRY_DELAY = 30
+
+
+class ScanLedger(object):
+    """
+    Persistent record of processed scans
+
+    Parameters
+    ----------
+    fname : string
+        Path to the SQLite file, created if it does not exist
+    max_attempts : int
+        Number of failed conversions after which a scan is finished
+    retry_delay : float
+        Time, in seconds, before a failed scan is tried again, doubled
+        after each failure
+
+    Examples
+    --------
+    >>> ledger = ScanLedger()
+    >>> ledger.record(1234, 'converted', 'scan2D_1234_xs_sum8ch.h5')
+    >>> ledger.is_finished(1234)
+    True
+    """
+
+    def __init__(self, fname=LEDGER_FNAME, max_attempts=FAILED_ATTEMPTS,
+                 retry_delay=FAILED_RETRY_DELAY):
+        self.fname = fname
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(fname, check_same_thread=False)
+        with self._con:
+            self._con.execute("CREATE TABLE IF NOT EXISTS scans ("
+                              "scan_id INTEGER PRIMARY KEY, "
+                              "state TEXT NOT NULL, "
+                              "fname TEXT, "
+                              "updated REAL, "
+                              "failures INTEGER NOT NULL DEFAULT 0, "
+                              "retry_at REAL)")
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def record(self, scanid, state, fname=None):
+        """
+        Set the state (and output file) of a scan
+
+        The failures of a scan are counted, each 'failed' state sets the
+        time of the next try.
+
+        Parameters
+        ----------
+        scanid : int
+            Scan ID
+        state : string
+            One of 'non-xrf', 'converted', 'failed', 'incomplete' or 'missing'
+        fname : string, optional
+            Output HDF5 file
+        """
+        t = ttime.time()
+        with self._lock, self._con:
+            row = self._con.execute("SELECT failures FROM scans WHERE scan_id = ?",
+                                    (int(scanid),)).fetchone()
+            failures = 0 if row is None else row[0]
+            retry_at = None
+            if state == FAILED:
+                failures += 1
+                retry_at = t + self.retry_delay * 2**(failures - 1)
+            self._con.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?)",
+                              (int(scanid), state, fname, t, failures, retry_at))
+
+    def get(self, scanid):
+        """
+        Return (state, fname) for a scan, or None if it was never recorded
+        """
+        with self._lock:
+            row = self._con.execute("SELECT state, fname FROM scans WHERE scan_id = ?",
+                                    (int(scanid),)).fetchone()
+        return row
+
+    def _row(self, scanid):
+        with self._lock:
+            return self._con.execute("SELECT state, failures, retry_at FROM scans "
+                                     "WHERE scan_id = ?", (int(scanid),)).fetchone()
+
+    def is_finished(self, scanid):
+        row = self._row(scanid)
+        if row is None:
+            return False
+        return row[0] in FINISHED_STATES or (row[0] == FAILED and row[1] >= self.max_attempts)
+
+    def next_try(self, scanid):
+        """
+        Return the time of the next try of a failed scan, or None
+        """
+        row = self._row(scanid)
+        if row is None or row[0] != FAILED:
+            return None
+        return row[2]
+
+    def finished_ids(self, start_id, stop_id=None):
+        """
+        Return the set of finished scan IDs in [start_id, stop_id)
+        """
+        if stop_id is None:
+            stop_id = 2**62
+        with self._lock:
+            rows = self._con.execute("SELECT scan_id FROM scans "
+                                     "WHERE scan_id >= ? AND scan_id < ? "
+                                     f"AND (state IN ({','.join('?' * len(FINISHED_STATES))}) "
+                                     "OR (state = ? AND failures >= ?))",
+                                     (int(start_id), int(stop_id)) + FINISHED_STATES
+                                     + (FAILED, self.max_attempts)).fetchall()
+        return set(r[0] for r in rows)
+
+    def forget(self, scanid):
+        """
+        Remove a scan from the ledger, e.g. to retry a scan that failed
+        max_attempts times
+        """
+        with self._lock, self._con:
+            self._con.execute("DELETE FROM scans WHERE scan_id = ?", (int(scanid),))
+
+
+class ScanCursor(object):
+    """
+    Moving window of scan IDs that still need to be looked at
+
+    The cursor keeps the lowest unfinished scan ID and the newest known
+    scan ID. Each cycle only the unfinished IDs between the two are
+    examined, so the cost of a cycle depends on the new scans only and
+    not on how long the beamtime has been running.
+
+    Parameters
+    ----------
+    start_id : int
+        First scan ID of the beamtime
+    N : int
+        Maximum number of scan IDs, start_id + N. Values below 1 mean no limit.
+    ledger : ScanLedger, optional
+        Scans already finished in the ledger are skipped from the start
+
+    Examples
+    --------
+    >>> cursor = ScanCursor(1234)
+    >>> cursor.update(1236)
+    >>> cursor.pending()
+    [1234, 1235, 1236]
+    >>> cursor.mark_finished(1234)
+    >>> cursor.low
+    1235
+    """
+
+    def __init__(self, start_id, N=0, ledger=None):
+        self.low = int(start_id)
+        self.newest = self.low - 1
+        self.stop_id = self.low + N if N >= 1 else None
+        self._finished = set()
+        if ledger is not None:
+            self._finished = ledger.finished_ids(self.low, self.stop_id)
+            self._advance()
+
+    def update(self, newest_id):
+        """
+        Move the high-water mark to the newest known scan ID
+        """
+        self.newest = max(self.newest, int(newest_id))
+
+    def pending(self):
+        """
+        Return the unfinished scan IDs between the two marks
+        """
+        stop = self.newest + 1
+        if self.stop_id is not None:
+            stop = min(stop, self.stop_id)
+        return [i for i in range(self.low, stop) if i not in self._finished]
+
+    def mark_finished(self, scanid):
+        if scanid < self.low:
+            return
+        self._finished.add(int(scanid))
+        self._advance()
+
+    def _advance(self):
+        while self.low in self._finished:
+            self._finished.remove(self.low)
+            self.low += 1
@@ -0,0 +1,395 @@
+"""
+SRX Autosave live maps
+
+Write the HDF5 file of a fly scan while the scan is running. Every row
+of 'stream0' is appended to resizable datasets as soon as it is in the
+databroker, and the metadata is finalized when the stop document
+arrives. Users can look at the partial map during the scan and only the
+last few rows are left to convert once the scan is done.
+
+The partial map is written to live_scan2D_*.h5 and renamed to the usual
+scan2D_*.h5 name once it is complete, so the autosave loop does not
+mistake a partial map for a finished one.
+
+Andy Kiss
+"""
+import os
+import queue
+import time as ttime
+import h5py
+import numpy as np
+
+from new_makehdf import (db, ENCODER_KEYS, _extract_metadata_from_header, _write_scan_metadata,
+                         helper_encode_list)
+from hdf_writer import dataset_options
+
+
+# Number of map columns per HDF5 chunk of the resizable datasets
+LIVE_CHUNK_COLS = 128
+
+# The start document can arrive before the databroker has the scan. The
+#   lookup is tried again after HEADER_RETRY_DELAY seconds, doubled after
+#   each try.
+HEADER_RETRY_DELAY = 0.25
+HEADER_RETRIES = 6
+
+
+def _get_header(scanid):
+    """
+    Return the header of a scan, trying again while the databroker does not have it
+    """
+    for n in range(HEADER_RETRIES):
+        try:
+            return db[int(scanid)]
+        except Exception as ex:
+            if n == HEADER_RETRIES - 1:
+                print(f'Cannot find scan {scanid} in the databroker ({ex!r}).')
+                raise
+            ttime.sleep(HEADER_RETRY_DELAY * 2**n)
+
+
+class LiveXRFMap(object):
+    """
+    Resizable HDF5 map of a running fly scan
+
+    Parameters
+    ----------
+    scanid : int
+        Scan ID of an XRF_FLY scan
+    create_each_det : bool
+        Also write the spectra of each detector channel
+    write_profile : string
+        Compression of the datasets, see hdf_writer.py. The chunks of live
+        maps are always one row, so rows can be appended.
+    docs : queue.Queue, optional
+        Descriptor and event documents of the scan as (name, doc), e.g.
+        ScanStopWatcher.run_docs[scanid]. Only these new events are read
+        on each update. Without them the streams are read from the
+        databroker on each update, which gets slower as the map grows.
+
+    Examples
+    --------
+    >>> live = LiveXRFMap(1234)
+    >>> live.update()  # append the rows taken so far
+    >>> live.finalize()  # once the stop document is in the databroker
+    """
+
+    interpath = 'xrfmap'
+
+    def __init__(self, scanid, create_each_det=False, write_profile='default', docs=None):
+        h = _get_header(scanid)
+        self.scanid = int(h.start['scan_id'])
+        self.uid = h.start['uid']
+        self.create_each_det = create_each_det
+        self.write_profile = write_profile
+
+        scan_doc = h.start['scan']
+        if scan_doc['type'] != 'XRF_FLY':
+            raise ValueError(f"Live maps are only made for fly scans, not {scan_doc['type']}.")
+        if 'xs' in scan_doc['detectors']:
+            self.det, self.det_key = 'xs', 'fluor'
+        elif 'xs2' in scan_doc['detectors']:
+            self.det, self.det_key = 'xs2', 'fluor_xs2'
+        else:
+            raise ValueError('No detectors found!')
+
+        fast_motor = scan_doc['fast_axis']['motor_name']
+        slow_motor = scan_doc['slow_axis']['motor_name']
+        if fast_motor not in ENCODER_KEYS:
+            raise ValueError(f'{fast_motor} not found!')
+        self.fast_key = ENCODER_KEYS[fast_motor]
+        self.slow_key = ENCODER_KEYS.get(slow_motor, slow_motor)
+        self.c, self.r = scan_doc['shape']
+        self.snake = scan_doc['snake'] == 1
+        # y scans are transposed, rows are appended along the second axis
+        self.transpose = fast_motor in ('nano_stage_sy', 'nano_stage_y')
+
+        self.sclr_name = None
+        self.N = None
+        self.rows_written = 0
+        self.fn = None
+        self.fn_live = None
+
+        self.docs = docs
+        # Stream name of each descriptor uid
+        self._streams = {}
+        # Events of 'stream0' not yet in the file and slow axis of each row, by seq_num
+        self._pending = {}
+        self._slow = {}
+
+    def _create_file(self, ev):
+        """
+        Create the file and the resizable datasets from the first event
+        """
+        data = ev['data']
+        self.sclr_name = [s for s in ['i0', 'i0_time', 'time', 'im', 'it'] if s in data]
+        fluor = np.asarray(data[self.det_key])
+        self.N = fluor.shape[1]
+        N_bins = fluor.shape[-1]
+        c = self.c
+        nc = min(c, LIVE_CHUNK_COLS)
+
+        if self.create_each_det:
+            self.fn = f'scan2D_{self.scanid}_{self.det}_{self.N}ch.h5'
+        else:
+            self.fn = f'scan2D_{self.scanid}_{self.det}_sum{self.N}ch.h5'
+        self.fn_live = 'live_' + self.fn
+
+        if self.transpose:
+            shape, maxshape, chunks = (c, 0, N_bins), (c, None, N_bins), (nc, 1, N_bins)
+            pos_shape, pos_maxshape, pos_chunks = (2, c, 0), (2, c, None), (2, nc, 1)
+            sclr_shape, sclr_maxshape = (c, 0, len(self.sclr_name)), (c, None, len(self.sclr_name))
+            sclr_chunks = (nc, 1, len(self.sclr_name))
+        else:
+            shape, maxshape, chunks = (0, c, N_bins), (None, c, N_bins), (1, nc, N_bins)
+            pos_shape, pos_maxshape, pos_chunks = (2, 0, c), (2, None, c), (2, 1, nc)
+            sclr_shape, sclr_maxshape = (0, c, len(self.sclr_name)), (None, c, len(self.sclr_name))
+            sclr_chunks = (1, nc, len(self.sclr_name))
+
+        pos_name = ['x_pos', 'y_pos']
+        if self.transpose:
+            pos_name = pos_name[::-1]
+
+        # Only the compression of the profile, the chunks are set here
+        kw = dataset_options(self.write_profile, spectra=True)
+        kw_small = dataset_options(self.write_profile)
+
+        interpath = self.interpath
+        with h5py.File(self.fn_live, 'w') as f:
+            mdata = _extract_metadata_from_header(db[self.uid])
+            _write_scan_metadata(f, mdata, interpath=interpath)
+            if self.create_each_det:
+                for i in range(self.N):
+                    grp = f.create_group(interpath + f'/det{i+1}')
+                    grp.create_dataset('counts', shape=shape, maxshape=maxshape, chunks=chunks,
+                                       dtype=fluor.dtype, **kw)
+            grp = f.create_group(interpath + '/detsum')
+            grp.create_dataset('counts', shape=shape, maxshape=maxshape, chunks=chunks,
+                               dtype=np.sum(fluor[:1], axis=1).dtype, **kw)
+            grp = f.create_group(interpath + '/positions')
+            grp.create_dataset('name', data=helper_encode_list(pos_name))
+            grp.create_dataset('pos', shape=pos_shape, maxshape=pos_maxshape, chunks=pos_chunks,
+                               dtype='float64', **kw_small)
+            grp = f.create_group(interpath + '/scalers')
+            grp.create_dataset('name', data=helper_encode_list(self.sclr_name))
+            grp.create_dataset('val', shape=sclr_shape, maxshape=sclr_maxshape, chunks=sclr_chunks,
+                               dtype='float64', **kw_small)
+
+    def _add_event(self, stream_name, ev):
+        seq_num = ev['seq_num']
+        if seq_num <= self.rows_written:
+            return
+        if stream_name == 'stream0':
+            self._pending[seq_num] = ev
+        elif stream_name == 'primary' and 'enc' not in self.slow_key:
+            self._slow[seq_num] = ev['data'][self.slow_key]
+
+    def _read_docs(self):
+        while True:
+            try:
+                name, doc = self.docs.get_nowait()
+            except queue.Empty:
+                return
+            if name == 'descriptor':
+                self._streams[doc['uid']] = doc.get('name')
+            elif name == 'event':
+                self._add_event(self._streams.get(doc['descriptor']), doc)
+
+    def _read_streams(self, h):
+        for ev in h.events(stream_name='stream0', fill=False):
+            if ev['seq_num'] not in self._pending:
+                self._add_event('stream0', ev)
+        if 'enc' not in self.slow_key:
+            # The slow axis comes from the 'primary' stream, one event per row
+            for ev in h.events(stream_name='primary', fields=[self.slow_key], fill=False):
+                self._add_event('primary', ev)
+
+    def _new_rows(self, h):
+        """
+        Return the filled 'stream0' events that are not yet in the file
+        """
+        if self.docs is not None:
+            self._read_docs()
+        else:
+            self._read_streams(h)
+
+        # Only append contiguous rows
+        rows = []
+        seq_num = self.rows_written + 1
+        while seq_num in self._pending:
+            ev = self._pending[seq_num]
+            if 'enc' not in self.slow_key:
+                if seq_num not in self._slow:
+                    break
+                ev['data'][self.slow_key] = np.full(self.c, self._slow[seq_num])
+            try:
+                db.fill_event(ev, inplace=True)
+            except Exception as ex:
+                # Its resources may not be in the databroker yet
+                print(f'Cannot fill row {seq_num} of scan {self.scanid} yet ({ex!r}).')
+                break
+            rows.append(ev)
+            seq_num += 1
+        return rows
+
+    def update(self, h=None):
+        """
+        Append all rows taken since the last update
+
+        Returns
+        -------
+        n : int
+            Number of rows appended
+        """
+        if h is None:
+            h = db[self.uid]
+        rows = self._new_rows(h)
+        if not rows:
+            return 0
+        if self.fn_live is None:
+            self._create_file(rows[0])
+
+        interpath = self.interpath
+        with h5py.File(self.fn_live, 'a') as f:
+            for ev in rows:
+                self._append_row(f, interpath, ev['data'])
+                self.rows_written += 1
+                self._pending.pop(ev['seq_num'], None)
+                self._slow.pop(ev['seq_num'], None)
+            f.flush()
+        return len(rows)
+
+    def _append_row(self, f, interpath, data):
+        i = self.rows_written
+        fluor = np.asarray(data[self.det_key])
+        fast_pos = np.asarray(data[self.fast_key])
+        slow_pos = np.asarray(data[self.slow_key])
+        sclr = np.stack([np.asarray(data[s]) for s in self.sclr_name], axis=-1)
+
+        # Consider snake
+        if self.snake and i % 2 == 1:
+            fluor = fluor[::-1]
+            fast_pos = fast_pos[::-1]
+            slow_pos = slow_pos[::-1]
+            sclr = sclr[::-1]
+
+        pos = np.zeros((2, self.c))
+        if 'x' in self.slow_key:
+            pos[1, :] = fast_pos
+            pos[0, :] = slow_pos
+        else:
+            pos[0, :] = fast_pos
+            pos[1, :] = slow_pos
+
+        def _append(ds, row, axis):
+            ds.resize(i + 1, axis=axis)
+            index = [slice(None)] * ds.ndim
+            index[axis] = i
+            ds[tuple(index)] = row
+
+        ax = 1 if self.transpose else 0
+        if self.create_each_det:
+            for n in range(self.N):
+                _append(f[interpath + f'/det{n+1}/counts'], fluor[:, n, :], ax)
+        _append(f[interpath + '/detsum/counts'], np.sum(fluor, axis=1), ax)
+        _append(f[interpath + '/positions/pos'], pos, ax + 1)
+        _append(f[interpath + '/scalers/val'], sclr, ax)
+
+    def discard(self):
+        """
+        Remove the partial map
+        """
+        if self.fn_live is not None and os.path.isfile(self.fn_live):
+            os.remove(self.fn_live)
+
+    def finalize(self, h=None, stop_event=None):
+        """
+        Append the remaining rows, write the final metadata and rename the file
+
+        Parameters
+        ----------
+        h : Header, optional
+            Header of the finished scan, looked up if not given
+        stop_event : threading.Event, optional
+            If it is set before the rename, the partial map is removed
+            instead, so it does not replace a file converted the usual way
+
+        Returns
+        -------
+        fn : string
+            Name of the finished HDF5 file, None if the scan had no data or
+            the map was stopped
+        """
+        if h is None:
+            h = db[self.uid]
+        self.update(h)
+        num_events = (h.stop.get('num_events') or {}).get('stream0', 0)
+        if self.docs is not None and self.rows_written < num_events:
+            # The last events are in the databroker but not in the documents yet
+            self._read_streams(h)
+            self.update(h)
+        if self.fn_live is None:
+            print(f'No data for scan {self.scanid}.')
+            return None
+
+        with h5py.File(self.fn_live, 'a') as f:
+            _write_scan_metadata(f, _extract_metadata_from_header(h), interpath=self.interpath)
+        if stop_event is not None and stop_event.is_set():
+            print(f'Stopped the live map of scan {self.scanid}.')
+            self.discard()
+            return None
+        os.replace(self.fn_live, self.fn)
+        return self.fn
+
+
+def follow_scan(scanid, poll_interval=1.0, create_each_det=False, timeout=None,
+                write_profile='default', docs=None, stop_event=None):
+    """
+    Write the HDF5 file of a fly scan while it is running
+
+    Blocks until the stop document is in the databroker and all rows are
+    written.
+
+    Parameters
+    ----------
+    scanid : int
+        Scan ID
+    poll_interval : float
+        Time, in seconds, between checks for new rows
+    create_each_det : bool
+        Also write the spectra of each detector channel
+    timeout : float, optional
+        Give up after this many seconds without new rows
+    write_profile : string
+        Compression of the datasets, see hdf_writer.py
+    docs : queue.Queue, optional
+        Documents of the scan, see LiveXRFMap
+    stop_event : threading.Event, optional
+        Give up and remove the partial map when it is set, e.g. when the
+        scan is converted the usual way instead
+
+    Returns
+    -------
+    fn : string
+        Name of the finished HDF5 file, None if the scan had no data
+    """
+
+    live = LiveXRFMap(scanid, create_each_det=create_each_det, write_profile=write_profile,
+                      docs=docs)
+    t_last = ttime.monotonic()
+    while True:
+        if stop_event is not None and stop_event.is_set():
+            print(f'Stopped the live map of scan {live.scanid}.')
+            live.discard()
+            return None
+        h = db[live.uid]
+        stop_doc = h.stop
+        if live.update(h) > 0:
+            t_last = ttime.monotonic()
+            print(f'{live.scanid}: {live.rows_written} rows written', flush=True)
+        if stop_doc:
+            return live.finalize(h, stop_event=stop_event)
+        if timeout is not None and ttime.monotonic() - t_last > timeout:
+            print(f'No new rows for scan {live.scanid} in {timeout} seconds.')
+            return None
+        ttime.sleep(poll_interval)
@@ -1,3 +1,6 @@
+import functools
+import itertools
+import time as ttime
 import h5py
 import numpy as np
 import pyxrf
@@ -5,6 +8,15 @@ from pyxrf.model.scan_metadata import *
 from pyxrf.core.utils import *
 from pyxrf.model.load_data_from_db import _get_fpath_not_existing, helper_encode_list
 
+from scan_reader import (read_data, read_sum, read_channels, read_columns, reshape_to_map,
+                         stream_keys, policy_dtype, cast_checked, fetch_concurrent,
+                         FETCH_THREADS)
+from hdf_writer import dataset_options, create_map_dataset, write_map
+from recompress import log_write, get_recompressor
+from vds import fly_row_files, write_virtual_det
+from resource_reader import ResourceReader
+from roi import roi_maps, store_maps, RoiAccumulator, RoiTable
+
 try:
     from databroker.v0 import Broker
 except ModuleNotFoundError:
@@ -26,6 +38,15 @@ if not db:
 
 pyxrf_version = pyxrf.__version__
 
+# Encoder keys in 'stream0' of fly scans for each nano stage motor
+ENCODER_KEYS = {
+    'nano_stage_sx': 'enc1',
+    'nano_stage_x': 'enc1',
+    'nano_stage_sy': 'enc2',
+    'nano_stage_y': 'enc2',
+    'nano_stage_sz': 'enc3',
+}
+
 
 def _extract_metadata_from_header(hdr):
     """
@@ -132,7 +153,226 @@ def _extract_metadata_from_header(hdr):
     return mdata
 
 
-def new_makehdf(scanid=-1, create_each_det=False):
+def _write_scan_metadata(f, mdata, interpath='xrfmap'):
+    """
+    Create the scan metadata group in an open HDF5 file
+    """
+    # Create metadata group
+    metadata_grp = f.require_group(f"{interpath}/scan_metadata")
+    # This group of attributes are always created. It doesn't matter if metadata
+    #   is provided to the function.
+    metadata_grp.attrs["file_type"] = "XRF-MAP"
+    metadata_grp.attrs["file_format"] = "NSLS2-XRF-MAP"
+    metadata_grp.attrs["file_format_version"] = "1.0"
+    metadata_grp.attrs["file_software"] = "PyXRF"
+    metadata_grp.attrs["file_software_version"] = pyxrf_version
+    # Present time in NEXUS format (should it be UTC time)?
+    metadata_grp.attrs["file_created_time"] = ttime.strftime("%Y-%m-%dT%H:%M:%S+00:00", ttime.localtime())
+
+    # Now save the rest of the scan metadata if metadata is provided
+    if mdata:
+        # We assume, that metadata does not contain repeated keys. Otherwise the
+        #   entry with the last occurrence of the key will override the previous ones.
+        for key, value in mdata.items():
+            metadata_grp.attrs[key] = value
+    return metadata_grp
+
+
+def _write_det_blocks(f, rows, num_rows, interpath='xrfmap', create_each_det=False,
+                      snake=False, transpose=False, max_memory=1.0, write_profile='default',
+                      chunk_layout=None, num_threads=None, dtype=None, rois=None):
+    """
+    Write the detector data of a fly scan in blocks of rows
+
+    Each block is read, corrected for snake and transposed scans and
+    written straight into the final datasets, so the memory use is set by
+    max_memory and not by the size of the map.
+
+    Parameters
+    ----------
+    f : h5py.File
+        Open output file
+    rows : iterable
+        Rows of detector data, shape (columns, channels, bins)
+    num_rows : int
+        Number of rows in the scan
+    interpath : string
+        Base group in the file
+    create_each_det : bool
+        Also write the spectra of each detector channel
+    snake : bool
+        Reverse every other row
+    transpose : bool
+        Swap rows and columns (y fly scans)
+    max_memory : float
+        Memory budget for one block, in GB
+    write_profile : string
+        HDF5 write profile, see hdf_writer.py
+    chunk_layout : string, optional
+        Override the chunk layout of the write profile
+    num_threads : int, optional
+        Number of compression threads, defaults to the number of cores
+    dtype : numpy dtype, optional
+        Type of the spectra and sums, see scan_reader.policy_dtype
+    rois : dict, optional
+        Energy windows, their maps are computed from each block of the sum
+
+    Returns
+    -------
+    N : int
+        Number of detector channels
+    maps : dict or None
+        Map of each window in rois, in the orientation of the file
+    """
+
+    rows = iter(rows)
+    first = np.asarray(next(rows))
+    c, N, N_bins = first.shape
+    det_dtype = first.dtype if dtype is None else dtype
+    sum_dtype = np.sum(first[:1], axis=1).dtype if dtype is None else dtype
+    bytes_per_row = c * N * N_bins * det_dtype.itemsize + c * N_bins * sum_dtype.itemsize
+    block_rows = int(max(1, min(num_rows, max_memory * 1024**3 // bytes_per_row)))
+
+    shape = (num_rows, c, N_bins)
+    kw = dict(transpose=transpose, write_profile=write_profile, chunk_layout=chunk_layout)
+    det_ds = []
+    if create_each_det:
+        for i in range(N):
+            grp = f.create_group(interpath+f'/det{i+1}')
+            det_ds.append(create_map_dataset(grp, 'counts', shape, det_dtype, **kw))
+    dataGrp = f.create_group(interpath+'/detsum')
+    sum_ds = create_map_dataset(dataGrp, 'counts', shape, sum_dtype, **kw)
+
+    # Whole chunks per block, so the chunks can be compressed in parallel
+    if sum_ds.chunks is not None:
+        chunk_rows = sum_ds.chunks[1 if transpose else 0]
+        if block_rows > chunk_rows:
+            block_rows -= block_rows % chunk_rows
+
+    def _write(ds, i0, data):
+        write_map(ds, data, i0, snake=snake, transpose=transpose, num_threads=num_threads)
+
+    acc = None
+    if rois is not None:
+        acc = RoiAccumulator(rois, num_rows, c, N_bins, sum_dtype)
+
+    block = np.empty((block_rows, c, N, N_bins), dtype=det_dtype)
+    i0, n = 0, 0
+    for row in itertools.chain([first], rows):
+        if i0 + n >= num_rows:
+            print(f'Warning: more than {num_rows} rows, ignoring the rest.')
+            break
+        block[n] = cast_checked(np.asarray(row), det_dtype)
+        n += 1
+        if n == block_rows or i0 + n == num_rows:
+            b = block[:n]
+            for i, ds in enumerate(det_ds):
+                _write(ds, i0, b[:, :, i, :])
+            b_sum = cast_checked(np.sum(b, axis=2), sum_dtype)
+            _write(sum_ds, i0, b_sum)
+            if acc is not None:
+                acc.add(i0, b_sum)
+            i0 += n
+            n = 0
+    if acc is None:
+        return N, None
+    return N, acc.maps(snake=snake, transpose=transpose)
+
+
+def _peek(rows):
+    """
+    Return the first row and an iterator over all rows
+    """
+    rows = iter(rows)
+    first = next(rows)
+    return first, itertools.chain([first], rows)
+
+
+def _read_fly_det(h, key, read_each_det, dtype, resources):
+    """
+    Read the spectra or the channel sum of a fly scan detector
+
+    Returns
+    -------
+    data : ndarray or None
+        (rows, columns, channels, bins), None if only the sum is read
+    data_sum : ndarray
+        Sum over the channels
+    N : int
+        Number of channels
+    """
+    if read_each_det:
+        data = read_data(h, key, stream_name='stream0', dtype=dtype, resources=resources)
+        return data, cast_checked(np.squeeze(np.sum(data, axis=2)), dtype), data.shape[2]
+    data_sum, row_shape = read_sum(h, key, 1, stream_name='stream0', dtype=dtype,
+                                   resources=resources)
+    return None, np.squeeze(data_sum), row_shape[1]
+
+
+def new_makehdf(scanid=-1, create_each_det=False, max_memory=None, write_profile='default',
+                chunk_layout=None, num_threads=None, archive_profile=None, dtype_policy='native',
+                virtual_det=False, direct_read=False, fetch_threads=FETCH_THREADS, rois=None):
+    """
+    Make the HDF5 file of an XRF map
+
+    Parameters
+    ----------
+    scanid : int
+        Scan ID, defaults to the last scan
+    create_each_det : bool
+        Also write the spectra of each detector channel
+    max_memory : float, optional
+        Memory budget, in GB, for the detector data of fly scans. When
+        given, the map is read and written in blocks of rows that fit the
+        budget instead of all at once, so maps larger than the available
+        memory can be converted.
+    write_profile : string
+        Compression and chunking of the datasets, e.g. 'fast-lzf', 'gzip-1'
+        or 'uncompressed'. See hdf_writer.py for the list and throughput.
+    chunk_layout : string, optional
+        Chunk shape of the spectra, 'spectrum' for fast per-pixel reads or
+        'roi' for fast ROI maps. Defaults to the layout of the profile.
+    num_threads : int, optional
+        Number of threads compressing the detector data, defaults to the
+        number of cores. Only used for gzip profiles.
+    archive_profile : string, optional
+        Two-phase write. The file is written with write_profile first, use
+        a fast one like 'uncompressed' or 'fast-lzf', and rewritten with
+        archive_profile by a background thread once it is idle. Both
+        steps are logged in srx_autosave_write_log.tsv.
+    dtype_policy : string
+        Type of the spectra and sums. 'native' keeps the detector type and
+        widens the sums (uint32 counts give uint64 sums). 'uint32' and
+        'float32' store both with that type, half the size of 64-bit sums.
+        Sums that do not fit in uint32 raise an OverflowError.
+    virtual_det : bool
+        With create_each_det, make det*/counts virtual datasets of the raw
+        Xspress3 resource files instead of copies (fly scans only, see
+        vds.py). Only the sum is read and written. The resource files must
+        stay in place for the output file to be readable.
+    direct_read : bool
+        Read the detector data straight from the Xspress3 resource files
+        instead of filling every event through the databroker (see
+        resource_reader.py). Falls back to the databroker for other
+        resource specs or if the files cannot be read.
+    fetch_threads : int
+        Number of streams (positions and scalers, slow axis, each
+        detector) read at the same time, 1 reads them one after another.
+    rois : dict or RoiTable, optional
+        Energy windows in bins, e.g. {'Cu_k': [780, 820]}, or a RoiTable
+        in keV converted at the incident energy of the scan. Their maps
+        are computed from the detector sum in memory, while it is
+        written, and left with the I0 scaler for autoroi_xrf (see
+        roi.py), which then does not read the file back.
+
+    Returns
+    -------
+    list of strings
+        HDF5 files written, empty if the scan could not be converted
+    """
+
+    # Type of the detector data, None keeps the type of the data
+    det_dtype = policy_dtype(dtype_policy)
 
     # Get scan header
     h = db[int(scanid)]
@@ -145,7 +385,7 @@ def new_makehdf(scanid=-1, create_each_det=False):
     # Check if new type of metadata
     if 'md_version' not in h.start:
         print('Please use old make_hdf.')
-        return
+        return []
 
     # Check for detectors
     dets = []
@@ -162,51 +402,79 @@ def new_makehdf(scanid=-1, create_each_det=False):
 
     if dets == []:
         print('No detectors found!')
-        return
+        return []
 
     # Get metadata
     mdata = _extract_metadata_from_header(h)
 
+    # ROI windows in bins at the incident energy of the scan
+    if isinstance(rois, RoiTable):
+        rois = rois.bins(scan_doc.get('energy'))
+
+    # Detector rows for the block writer, see max_memory
+    d_xs_rows, d_xs2_rows = None, None
+
+    # Resource files of the rows for virtual per-detector datasets
+    vds_files = {}
+    if virtual_det and create_each_det:
+        if scan_doc['type'] != 'XRF_FLY':
+            print('Virtual detector datasets are only made for fly scans, copying the spectra.')
+        else:
+            try:
+                for d, key in [('xs', 'fluor'), ('xs2', 'fluor_xs2')]:
+                    if d in dets:
+                        vds_files[d] = fly_row_files(h, key, db.reg)
+            except Exception as ex:
+                print(f'Cannot find the resource files ({ex}), copying the spectra.')
+                vds_files = {}
+    # Only the sum is computed if the spectra are virtual datasets
+    read_each_det = create_each_det and not vds_files
+
+    # Direct reads of the resource files, None uses the databroker handlers
+    res = None
+    if direct_read:
+        res = ResourceReader(h, db.reg)
+
+    # Measured points of the map, only for step scans
+    mask = None
+
     # Get position data from scan
     c, r = h.start['scan']['shape']
     if scan_doc['type'] == 'XRF_FLY':
         fast_motor = scan_doc['fast_axis']['motor_name']
-        if (fast_motor == 'nano_stage_sx'):
-            fast_key = 'enc1'
-        elif (fast_motor == 'nano_stage_x'):
-            fast_key = 'enc1'
-        elif (fast_motor == 'nano_stage_sy'):
-            fast_key = 'enc2'
-        elif (fast_motor == 'nano_stage_y'):
-            fast_key = 'enc2'
-        elif (fast_motor == 'nano_stage_sz'):
-            fast_key = 'enc3'
+        if fast_motor in ENCODER_KEYS:
+            fast_key = ENCODER_KEYS[fast_motor]
         else:
             print(f'{fast_motor} not found!')
-            return
+            return []
 
         slow_motor = scan_doc['slow_axis']['motor_name']
-        if (slow_motor == 'nano_stage_sx'):
-            slow_key = 'enc1'
-        elif (slow_motor == 'nano_stage_x'):
-            slow_key = 'enc1'
-        elif (slow_motor == 'nano_stage_sy'):
-            slow_key = 'enc2'
-        elif (slow_motor == 'nano_stage_y'):
-            slow_key = 'enc2'
-        elif (slow_motor == 'nano_stage_sz'):
-            slow_key = 'enc3'
-        else:
-            slow_key = slow_motor
-    
-        fast_pos = h.data(fast_key, stream_name='stream0', fill=True)
-        fast_pos = np.array(list(fast_pos))
+        slow_key = ENCODER_KEYS.get(slow_motor, slow_motor)
+
+        # Encoders and scalers are read together, without the detector data.
+        #   The detectors and the slow axis are read at the same time.
+        sclr_list = ['i0', 'i0_time', 'time', 'im', 'it']
+        stream0_keys = stream_keys(h, 'stream0')
+        sclr_name = [s for s in sclr_list if s in stream0_keys]
+        pos_keys = [fast_key, slow_key] if 'enc' in slow_key else [fast_key]
+        tasks = {'cols': lambda: read_columns(h, pos_keys + sclr_name, stream_name='stream0')}
+        if 'enc' not in slow_key:
+            tasks['slow'] = lambda: read_columns(h, [slow_key], stream_name='primary')[slow_key]
+        if max_memory is None:
+            # Without the individual detectors, the channels are summed while
+            # the rows are read and the full data is never in memory
+            for d, key in [('xs', 'fluor'), ('xs2', 'fluor_xs2')]:
+                if d in dets:
+                    tasks[d] = functools.partial(_read_fly_det, h, key, read_each_det,
+                                                 det_dtype, res)
+        fetched = fetch_concurrent(tasks, num_threads=fetch_threads)
+        cols = fetched['cols']
+
+        fast_pos = cols[fast_key]
         if 'enc' in slow_key:
-            slow_pos = h.data(slow_key, stream_name='stream0', fill=True)
-            slow_pos = np.array(list(slow_pos))
+            slow_pos = cols[slow_key]
         else:
-            slow_pos = h.data(slow_key, stream_name='primary', fill=True)
-            slow_pos = np.array(list(slow_pos))
+            slow_pos = fetched['slow']
             slow_pos = np.array([slow_pos,]*c).T
 
         num_events = stop_doc['num_events']['stream0']
@@ -221,27 +489,25 @@ def new_makehdf(scanid=-1, create_each_det=False):
         pos_name = ['x_pos', 'y_pos']
 
         # Get detector data
-        if 'xs' in dets:
-            d_xs = np.array(list(h.data('fluor', stream_name='stream0', fill=True)))
-            N_xs = d_xs.shape[2]
-            d_xs_sum = np.squeeze(np.sum(d_xs, axis=2))
-        if 'xs2' in dets:
-            d_xs2 = np.array(list(h.data('fluor_xs2', stream_name='stream0', fill=True)))
-            N_xs2 = d_xs2.shape[2]
-            d_xs2_sum = np.squeeze(np.sum(d_xs2, axis=2))
+        d_xs, d_xs2 = None, None
+        if max_memory is not None:
+            # Detector data is read and written in blocks of rows below
+            if 'xs' in dets:
+                first, d_xs_rows = _peek(h.data('fluor', stream_name='stream0', fill=True))
+                N_xs = np.shape(first)[1]
+                d_xs_sum = None
+            if 'xs2' in dets:
+                first, d_xs2_rows = _peek(h.data('fluor_xs2', stream_name='stream0', fill=True))
+                N_xs2 = np.shape(first)[1]
+                d_xs2_sum = None
+        else:
+            if 'xs' in dets:
+                d_xs, d_xs_sum, N_xs = fetched['xs']
+            if 'xs2' in dets:
+                d_xs2, d_xs2_sum, N_xs2 = fetched['xs2']
 
-        
-        # Scaler list
-        sclr_list = ['i0', 'i0_time', 'time', 'im', 'it']
-        sclr = []
-        sclr_name = []
-        for s in sclr_list:
-            if s in h.table('stream0').keys():
-                tmp = np.array(list(h.data(s, stream_name='stream0', fill=True)))
-                sclr.append(tmp)
-                sclr_name.append(s)
-        sclr = np.array(sclr)
-        sclr = np.moveaxis(sclr, 0, -1)
+        # Scalers, (rows, columns, scalers)
+        sclr = np.stack([cols[s] for s in sclr_name], axis=-1)
     if scan_doc['type'] == 'XRF_STEP':
         # Define keys for motor data
         fast_motor = scan_doc['fast_axis']['motor_name']
@@ -249,27 +515,41 @@ def new_makehdf(scanid=-1, create_each_det=False):
         slow_motor = scan_doc['slow_axis']['motor_name']
         slow_key = slow_motor + '_user_setpoint'
 
-        # Collect motor positions
-        fast_pos = h.data(fast_key, stream_name='primary', fill=True)
-        fast_pos = np.array(list(fast_pos))
-        slow_pos = h.data(slow_key, stream_name='primary', fill=True)
-        slow_pos = np.array(list(slow_pos))
+        # Collect motor positions and scalers in one pass
+        #   and the detector channels in another one at the same time
+        keys = stream_keys(h, 'primary')
+        sclr_list = ['sclr_i0', 'sclr_im', 'sclr_it']
+        sclr_name = [s for s in sclr_list if s in keys]
+        MAX_DET_ELEMENTS = 7
+        for i in np.arange(1, MAX_DET_ELEMENTS+1):
+            if f'xs_channel{i}' in keys:
+                N_xs = i
+            else:
+                break
+        xs_keys = [f'xs_channel{i+1}' for i in range(N_xs)]
+        tasks = {'cols': lambda: read_columns(h, [fast_key, slow_key] + sclr_name,
+                                              stream_name='primary')}
+        if 'xs' in dets:
+            # (N_pts, N_bins) sum or (N_xs, N_pts, N_bins)
+            tasks['xs'] = lambda: read_channels(h, xs_keys, stream_name='primary',
+                                                dtype=det_dtype,
+                                                sum_channels=not create_each_det,
+                                                resources=res)
+        fetched = fetch_concurrent(tasks, num_threads=fetch_threads)
+        cols = fetched['cols']
+        fast_pos = cols[fast_key]
+        slow_pos = cols[slow_key]
 
         # Reshape motor positions
+        #   Aborted scans are padded to whole rows, mask marks the measured points
         num_events = stop_doc['num_events']['primary']
         r, c = scan_doc['shape']
-        if num_events != (r * c):
-            num_rows = num_events // c  + 1  # number of rows
-            fast_pos = np.zeros((num_rows, c))
-            slow_pos = np.zeros((num_rows, c))
-            for i in range(num_rows):
-                for j in range(c):
-                    fast_pos[i, j] = fast_pos[i*c + j]
-                    slow_pos[i, j] = slow_pos[i*c + j]
-        else:
-            num_rows = r
-            fast_pos = np.reshape(fast_pos, (r, c))
-            slow_pos = np.reshape(slow_pos, (r, c))
+        num_rows = r if num_events == r * c else max(1, -(-num_events // c))
+        fast_pos, mask = reshape_to_map(fast_pos, c, num_rows)
+        slow_pos, _ = reshape_to_map(slow_pos, c, num_rows)
+        if not mask.all():
+            print(f'Scan {scanid} has {num_events} of {r * c} points, '
+                  f'padding {np.count_nonzero(~mask)} points.')
 
         # Put into one array for h5 file
         pos_pos = np.zeros((2, num_rows, c))
@@ -283,82 +563,56 @@ def new_makehdf(scanid=-1, create_each_det=False):
 
 
         # Get detector data
-        keys = h.table().keys()
-        MAX_DET_ELEMENTS = 7
-        for i in np.arange(1, MAX_DET_ELEMENTS+1):
-            if f'xs_channel{i}' in keys:
-                N_xs = i
-            else:
-                break
-        N_pts = num_events
-        N_bins= 4096
-        if 'xs' in dets:
-            d_xs = np.empty((N_xs, N_pts, N_bins))
-            for i in np.arange(0, N_xs):
-                d = h.data(f'xs_channel{i+1}', fill=True)
-                d = np.array(list(d))
-                d_xs[i, :, :] = np.copy(d)
-            del d
-            # Reshape data
-            if num_events != (r * c):
-                tmp = np.zeros((N_xs, num_rows, c, N_bins))
-                for i in range(num_rows):
-                    for j in range(c):
-                        tmp[:, i, j, :] = fast_pos[:, i*c + j, :]
-                d_xs = np.copy(tmp)
-                del tmp
-            else:
-                d_xs = np.reshape(d_xs, (N_xs, r, c, N_bins))
+        d_xs = None
+        if 'xs' in dets and not create_each_det:
+            d_xs_sum, _ = reshape_to_map(fetched['xs'], c, num_rows)
+        elif 'xs' in dets:
+            d_xs = fetched['xs']
+            # Reshape data, same layout as fly scans (rows, columns, channels, bins)
+            d_xs, _ = reshape_to_map(d_xs, c, num_rows, axis=1)
+            d_xs = np.moveaxis(d_xs, 0, 2)
             # Sum data
-            d_xs_sum = np.squeeze(np.sum(d_xs, axis=0))
+            d_xs_sum = cast_checked(np.sum(d_xs, axis=2), det_dtype)
 
-        # Scaler list
-        sclr_list = ['sclr_i0', 'sclr_im', 'sclr_it']
-        sclr_name = []
-        for s in sclr_list:
-            if s in keys:
-                sclr_name.append(s)
-        sclr = np.array(h.table()[sclr_name].values)
-        # Reshape data
-        if num_events != (r * c):
-            tmp = np.zeros((num_rows, c))
-            for i in range(num_rows):
-                for j in range(c):
-                    tmp[i, j] = fast_pos[i*c + j]
-            sclr = np.copy(tmp)
-            del tmp
-        else:
-            sclr = np.reshape(sclr, (r, c, len(sclr_name)))
+        # Scalers, (rows, columns, scalers)
+        sclr = np.stack([cols[s] for s in sclr_name], axis=-1)
+        sclr, _ = reshape_to_map(sclr, c, num_rows)
 
     # Consider snake
-    # pos_pos, d_xs, d_xs_sum, sclr
-    if scan_doc['snake'] == 1:
+    #   pos_pos and sclr are small and flipped here, the detector data is
+    #   flipped block by block while it is written
+    snake = scan_doc['snake'] == 1
+    if snake:
         pos_pos[:, 1::2, :] = pos_pos[:, 1::2, ::-1]
-        d_xs[:, 1::2, :, :] = d_xs[:, 1::2, ::-1, :]
-        d_xs_sum[1::2, :, :] = d_xs_sum[1::2, ::-1, :]
         sclr[1::2, :, :] = sclr[1::2, ::-1, :]
+        if mask is not None:
+            mask[1::2, :] = mask[1::2, ::-1]
 
     # Transpose map for y scans
+    #   Same for the detector data, it is transposed while it is written
+    transpose = False
     if scan_doc['type'] == 'XRF_FLY':
         if (fast_motor == 'nano_stage_sy' or
             fast_motor == 'nano_stage_y'):
-            # Need to swapaxes on pos_pos, d_xs, d_xs_sum, sclr
+            # Need to swapaxes on pos_pos, sclr
+            transpose = True
             pos_name = pos_name[::-1]
             pos_pos = np.swapaxes(pos_pos, 1, 2)
-            d_xs = np.swapaxes(d_xs, 1, 2)
-            d_xs_sum = np.swapaxes(d_xs_sum, 0, 1)
             sclr = np.swapaxes(sclr, 0, 1)
 
     # Write file
     interpath = 'xrfmap'
+    written = []
     for d in dets:
         if d == 'xs':
             tmp_data = d_xs
             tmp_data_sum = d_xs_sum
+            tmp_rows = d_xs_rows
             N = N_xs
         elif d == 'xs2':
             tmp_data = d_xs2
             tmp_data_sum = d_xs2_sum
+            tmp_rows = d_xs2_rows
             N = N_xs2
  
         if (create_each_det):
@@ -376,47 +630,68 @@ def new_makehdf(scanid=-1, create_each_det=False):
                 file_open_mode = 'w'
             else:
                 print('File already exists!')
-                return
+                return written
  
+        # ROI maps of the first detector, as autoroi_xrf uses the first file
+        d_rois = rois if d == dets[0] else None
+        roi_map = None
         with h5py.File(fn, file_open_mode) as f:
-             # Create metadata group
-            metadata_grp = f.create_group(f"{interpath}/scan_metadata")
-            # This group of attributes are always created. It doesn't matter if metadata
-            #   is provided to the function.
-            metadata_grp.attrs["file_type"] = "XRF-MAP"
-            metadata_grp.attrs["file_format"] = "NSLS2-XRF-MAP"
-            metadata_grp.attrs["file_format_version"] = "1.0"
-            metadata_grp.attrs["file_software"] = "PyXRF"
-            metadata_grp.attrs["file_software_version"] = pyxrf_version
-            # Present time in NEXUS format (should it be UTC time)?
-            metadata_grp.attrs["file_created_time"] = ttime.strftime("%Y-%m-%dT%H:%M:%S+00:00", ttime.localtime())
-    
-            # Now save the rest of the scan metadata if metadata is provided
-            if mdata:
-                # We assume, that metadata does not contain repeated keys. Otherwise the
-                #   entry with the last occurrence of the key will override the previous ones.
-                for key, value in mdata.items():
-                    metadata_grp.attrs[key] = value
-    
-            if create_each_det is True:
-                for i in range(N_xs):
-                    grp = f.create_group(interpath+f'/det{i+1}')
-                    grp.create_dataset('counts', data=np.squeeze(tmp_data[:, :, i, :]), compression='gzip')
- 
-            # summed data
-            dataGrp = f.create_group(interpath+'/detsum')
-            ds_data = dataGrp.create_dataset('counts', data=tmp_data_sum,
-                                                 compression='gzip')
-    
+            _write_scan_metadata(f, mdata, interpath=interpath)
+
+            if tmp_rows is not None:
+                _, roi_map = _write_det_blocks(f, tmp_rows, num_events, interpath=interpath,
+                                               create_each_det=read_each_det, snake=snake,
+                                               transpose=transpose, max_memory=max_memory,
+                                               write_profile=write_profile,
+                                               chunk_layout=chunk_layout,
+                                               num_threads=num_threads, dtype=det_dtype,
+                                               rois=d_rois)
+            else:
+                kw = dict(transpose=transpose, write_profile=write_profile,
+                          chunk_layout=chunk_layout)
+                if read_each_det is True:
+                    for i in range(N):
+                        tmp = tmp_data[:, :, i, :]
+                        grp = f.create_group(interpath+f'/det{i+1}')
+                        ds = create_map_dataset(grp, 'counts', tmp.shape, tmp.dtype, **kw)
+                        write_map(ds, tmp, snake=snake, transpose=transpose,
+                                  num_threads=num_threads)
+
+                # summed data
+                dataGrp = f.create_group(interpath+'/detsum')
+                ds_data = create_map_dataset(dataGrp, 'counts', tmp_data_sum.shape,
+                                             tmp_data_sum.dtype, **kw)
+                write_map(ds_data, tmp_data_sum, snake=snake, transpose=transpose,
+                          num_threads=num_threads)
+                if d_rois is not None:
+                    roi_map = roi_maps(tmp_data_sum.reshape((-1,) + tmp_data_sum.shape[-2:]),
+                                       d_rois, snake=snake, transpose=transpose)
+
+            # per-detector spectra as virtual datasets of the resource files
+            if d in vds_files:
+                write_virtual_det(f[interpath], vds_files[d], c, snake=snake, transpose=transpose)
+
             # add positions
             dataGrp = f.create_group(interpath+'/positions')
             dataGrp.create_dataset('name', data=helper_encode_list(pos_name))
-            dataGrp.create_dataset('pos', data=pos_pos)
-    
+            dataGrp.create_dataset('pos', data=pos_pos, **dataset_options(write_profile))
+            if mask is not None:
+                # False for the points missing from aborted step scans
+                dataGrp.create_dataset('mask', data=mask)
+
             # scaler data
             dataGrp = f.create_group(interpath+'/scalers')
             dataGrp.create_dataset('name', data=helper_encode_list(sclr_name))
-            dataGrp.create_dataset('val', data=sclr)
+            dataGrp.create_dataset('val', data=sclr, **dataset_options(write_profile))
+
+        written.append(fn)
+        if roi_map is not None:
+            store_maps(scanid, roi_map, sclr[:, :, 0])
+        if archive_profile is not None:
+            log_write(scanid, 'written', fn, write_profile, stop_time=stop_doc.get('time'))
+            get_recompressor(archive_profile, layout=chunk_layout).submit(
+                fn, scanid=scanid, stop_time=stop_doc.get('time'))
+    return written
 
 
 def add_ydata(fn):
@@ -432,8 +707,7 @@ def add_ydata(fn):
     start_doc = h.start
     
     # Get position data from scan
-    y_pos = h.data('enc2', stream_name='stream0', fill=True)
-    y_pos = np.array(list(y_pos))
+    y_pos = read_columns(h, ['enc2'], stream_name='stream0')['enc2']
 
     # Write to file
     with h5py.File(fn, 'a') as f:
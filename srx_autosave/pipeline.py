@@ -0,0 +1,179 @@
+"""
+SRX Autosave pipeline
+
+Staged processing of scans. Each stage has its own queue and workers,
+and a scan is handed to the next stage as soon as the previous one is
+done with it, so different scans can be in different stages at the same
+time (e.g. the HDF5 of one scan is written while the PDF report of the
+previous scan is being merged).
+
+Andy Kiss
+"""
+import multiprocessing
+import queue
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+
+class Stage(object):
+    """
+    One step of the pipeline
+
+    Parameters
+    ----------
+    name : string
+        Name of the stage, used in status messages
+    func : callable
+        func(scanid) returns None to pass the scan on to the next stage,
+        or a status string to stop processing that scan
+    num_workers : int
+        Number of scans processed by this stage at the same time
+    use_processes : bool
+        Run func in a pool of worker processes instead of threads. func
+        must then be a module-level function.
+    initializer : callable, optional
+        Called with initargs in each worker process when it starts, e.g.
+        to install settings that a spawned process would not see
+    initargs : tuple
+        Arguments of initializer
+    """
+
+    def __init__(self, name, func, num_workers=1, use_processes=False, initializer=None,
+                 initargs=()):
+        self.name = name
+        self.func = func
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.queue = queue.Queue()
+        self._executor = None
+        self._threads = []
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, num_workers={self.num_workers})"
+
+
+class ScanPipeline(object):
+    """
+    Pass scans through a list of stages
+
+    Parameters
+    ----------
+    stages : list
+        List of Stage, in order
+    final_status : string
+        Status of a scan that made it through all the stages
+
+    Examples
+    --------
+    >>> p = ScanPipeline([Stage('hdf5', make, 4), Stage('report', report)])
+    >>> p.start()
+    >>> p.submit(1234)
+    >>> p.results.get()
+    (1234, 'converted')
+    """
+
+    def __init__(self, stages, final_status='converted'):
+        self.stages = stages
+        self.final_status = final_status
+        self.results = queue.Queue()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def start(self):
+        self._stopping = False
+        for n, stage in enumerate(self.stages):
+            if stage.use_processes:
+                ctx = multiprocessing.get_context('spawn')
+                stage._executor = ProcessPoolExecutor(max_workers=stage.num_workers, mp_context=ctx,
+                                                      initializer=stage.initializer,
+                                                      initargs=stage.initargs)
+            for i in range(stage.num_workers):
+                th = threading.Thread(target=self._work, args=(n,), daemon=True,
+                                      name=f"{stage.name}-{i}")
+                th.start()
+                stage._threads.append(th)
+
+    def stop(self):
+        """
+        Stop all workers once the scans in the pipeline are done
+
+        The stages are stopped one at a time, from the first one, so the
+        scans an upstream stage is still working on are queued at the
+        next stage before its workers are told to stop.
+        """
+        with self._lock:
+            self._stopping = True
+        for stage in self.stages:
+            for th in stage._threads:
+                stage.queue.put(None)
+            for th in stage._threads:
+                th.join()
+            stage._threads = []
+            if stage._executor is not None:
+                stage._executor.shutdown()
+                stage._executor = None
+
+    def submit(self, scanid, stage=None):
+        """
+        Queue a scan at the first stage
+
+        Parameters
+        ----------
+        scanid : int
+            Scan ID
+        stage : string, optional
+            Name of the stage to start at instead, e.g. 'report' for a
+            scan whose HDF5 and ROIs are already made
+
+        Returns
+        -------
+        bool
+            False if the scan is already in the pipeline or the pipeline
+            is stopping
+        """
+        n = 0 if stage is None else self.stage_names().index(stage)
+        with self._lock:
+            if self._stopping or scanid in self._in_flight:
+                return False
+            self._in_flight.add(scanid)
+        self.stages[n].queue.put(scanid)
+        return True
+
+    def stage_names(self):
+        return [stage.name for stage in self.stages]
+
+    def in_flight(self):
+        with self._lock:
+            return set(self._in_flight)
+
+    def _finish(self, scanid, status):
+        with self._lock:
+            self._in_flight.discard(scanid)
+        self.results.put((scanid, status))
+
+    def _work(self, n):
+        stage = self.stages[n]
+        while True:
+            scanid = stage.queue.get()
+            if scanid is None:
+                return
+            try:
+                if stage._executor is not None:
+                    status = stage._executor.submit(stage.func, scanid).result()
+                else:
+                    status = stage.func(scanid)
+            except Exception:
+                print(f"Error in {stage.name} stage for scan {scanid}:")
+                traceback.print_exc()
+                status = 'failed'
+
+            if status is not None:
+                self._finish(scanid, status)
+            elif n + 1 < len(self.stages):
+                self.stages[n + 1].queue.put(scanid)
+            else:
+                self._finish(scanid, self.final_status)
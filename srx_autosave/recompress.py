@@ -0,0 +1,301 @@
+"""
+SRX Autosave recompression
+
+Two-phase writing of the HDF5 files. new_makehdf first writes the map
+with a fast profile ('uncompressed' or 'fast-lzf') so users have the
+file as soon as the scan stops. A background thread then rewrites it
+with the archival profile into a temporary file, and swaps it in with
+os.replace once the original has not been modified for a while. Readers
+that already have the file open keep the old copy until they close it.
+
+Both steps are appended to a tab-separated log in the working directory,
+with the time since the end of the scan, e.g.
+
+    scan_id  event         fname                      profile   size      time        latency
+    1234     written       scan2D_1234_xs_sum8ch.h5   fast-lzf  11534336  1700000012  4.1
+    1234     recompressed  scan2D_1234_xs_sum8ch.h5   gzip-4    6815744   1700000071  63.0
+
+Andy Kiss
+"""
+import atexit
+import multiprocessing.util
+import os
+import queue
+import threading
+import time as ttime
+import traceback
+import h5py
+import numpy as np
+
+from hdf_writer import dataset_options, write_chunks
+
+
+WRITE_LOG_FNAME = "srx_autosave_write_log.tsv"
+
+# Size of the row blocks of detector data copied at once, in bytes
+RECOMPRESS_BLOCK_BYTES = 2**28
+
+
+def log_write(scanid, event, fname, profile, stop_time=None, log_fname=WRITE_LOG_FNAME):
+    """
+    Append one line to the write log
+
+    Parameters
+    ----------
+    scanid : int
+        Scan ID
+    event : string
+        'written' or 'recompressed'
+    fname : string
+        HDF5 file
+    profile : string
+        Write profile of the file
+    stop_time : float, optional
+        Time of the stop document, for the latency column
+    log_fname : string
+        Log file, created with a header line if it does not exist
+    """
+
+    t = ttime.time()
+    latency = '' if stop_time is None else f'{t - stop_time:.1f}'
+    try:
+        size = os.path.getsize(fname)
+    except OSError:
+        size = ''
+    new = not os.path.exists(log_fname)
+    with open(log_fname, 'a') as f:
+        if new:
+            f.write('scan_id\tevent\tfname\tprofile\tsize\ttime\tlatency\n')
+        f.write(f'{scanid}\t{event}\t{os.path.basename(fname)}\t{profile}\t{size}\t{t:.1f}\t{latency}\n')
+
+
+def _is_spectra(ds):
+    return ds.name.endswith('/counts') and ds.ndim == 3
+
+
+def _copy_attrs(src, dst):
+    for k, v in src.attrs.items():
+        dst.attrs[k] = v
+
+
+def _copy_virtual(src, dst_grp, name):
+    # Same mappings onto the same source files, nothing is read
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    for vmap in src.virtual_sources():
+        dcpl.set_virtual(vmap.vspace, vmap.file_name.encode(), vmap.dset_name.encode(),
+                         vmap.src_space)
+    if src.fillvalue is not None:
+        dcpl.set_fill_value(np.array(src.fillvalue, dtype=src.dtype))
+    space = h5py.h5s.create_simple(src.shape, src.maxshape)
+    dsid = h5py.h5d.create(dst_grp.id, name.encode(), src.id.get_type(), space, dcpl=dcpl)
+    return h5py.Dataset(dsid)
+
+
+def _copy_dataset(src, dst_grp, name, profile, layout, num_threads):
+    if src.is_virtual:
+        # e.g. det*/counts of the raw resource files, see vds.py
+        ds = _copy_virtual(src, dst_grp, name)
+    elif _is_spectra(src):
+        kw = dataset_options(profile, src.shape, src.dtype, spectra=True, layout=layout)
+        ds = dst_grp.create_dataset(name, shape=src.shape, dtype=src.dtype, **kw)
+        # Copy in blocks of whole chunks along the first axis
+        row_bytes = max(1, src.nbytes // max(1, src.shape[0]))
+        step = max(1, RECOMPRESS_BLOCK_BYTES // row_bytes)
+        if ds.chunks is not None and step > ds.chunks[0]:
+            step -= step % ds.chunks[0]
+        for i in range(0, src.shape[0], step):
+            write_chunks(ds, src[i:i+step], offset=(i, 0, 0), num_threads=num_threads)
+    elif src.shape and src.dtype.kind in 'biuf':
+        ds = dst_grp.create_dataset(name, data=src[()], **dataset_options(profile))
+    else:
+        src.file.copy(src, dst_grp, name=name)
+        return
+    _copy_attrs(src, ds)
+
+
+def recompress_file(fname, profile='gzip-4', layout=None, num_threads=None):
+    """
+    Rewrite an HDF5 file with another write profile
+
+    The copy is written next to the file and replaces it with os.replace,
+    unless the file was modified during the copy.
+
+    Parameters
+    ----------
+    fname : string
+        HDF5 file written by new_makehdf
+    profile : string
+        Write profile of the new file, see hdf_writer.py
+    layout : string, optional
+        Override the chunk layout of the profile
+    num_threads : int, optional
+        Number of compression threads, defaults to the number of cores
+
+    Returns
+    -------
+    bool
+        True if the file was replaced
+    """
+
+    st = os.stat(fname)
+    head, tail = os.path.split(fname)
+    tmp_fname = os.path.join(head, f'.recompress_{tail}')
+    try:
+        with h5py.File(fname, 'r') as src, h5py.File(tmp_fname, 'w') as dst:
+            _copy_attrs(src, dst)
+
+            def _visit(name, obj):
+                if isinstance(obj, h5py.Group):
+                    _copy_attrs(obj, dst.require_group(name))
+                else:
+                    parent, _, base = name.rpartition('/')
+                    grp = dst.require_group(parent) if parent else dst
+                    _copy_dataset(obj, grp, base, profile, layout, num_threads)
+
+            src.visititems(_visit)
+
+        st_new = os.stat(fname)
+        if (st_new.st_mtime_ns, st_new.st_size) != (st.st_mtime_ns, st.st_size):
+            print(f'{fname} was modified during recompression, keeping it.')
+            os.remove(tmp_fname)
+            return False
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        # Also when interrupted, no partial copies are left behind
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+    return True
+
+
+class Recompressor(object):
+    """
+    Background thread recompressing finished HDF5 files
+
+    The files queued in the recompressors shared by get_recompressor
+    are finished before the interpreter, or a worker process, exits.
+
+    Parameters
+    ----------
+    profile : string
+        Archival write profile, see hdf_writer.py
+    layout : string, optional
+        Override the chunk layout of the profile
+    num_threads : int, optional
+        Number of compression threads, defaults to the number of cores
+    idle_time : float
+        A file is only recompressed once it has not been modified for this
+        many seconds
+    log_fname : string
+        Write log, see log_write
+
+    Examples
+    --------
+    >>> r = Recompressor('gzip-4')
+    >>> r.start()
+    >>> r.submit('scan2D_1234_xs_sum8ch.h5', scanid=1234)
+    >>> r.stop()  # waits for the queued files
+    """
+
+    def __init__(self, profile='gzip-4', layout=None, num_threads=None, idle_time=5.0,
+                 log_fname=WRITE_LOG_FNAME):
+        self.profile = profile
+        self.layout = layout
+        self.num_threads = num_threads
+        self.idle_time = idle_time
+        self.log_fname = os.path.abspath(log_fname)
+        self.queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True, name='recompress')
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the thread once all queued files are done
+        """
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, fname, scanid=None, stop_time=None):
+        """
+        Queue a file for recompression
+
+        Parameters
+        ----------
+        fname : string
+            HDF5 file
+        scanid : int, optional
+            Scan ID for the write log
+        stop_time : float, optional
+            Time of the stop document, for the latency in the write log
+        """
+        self.queue.put((os.path.abspath(fname), scanid, stop_time))
+
+    def _wait_idle(self, fname):
+        while True:
+            age = ttime.time() - os.path.getmtime(fname)
+            if age >= self.idle_time:
+                return
+            ttime.sleep(self.idle_time - age)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            fname, scanid, stop_time = item
+            try:
+                for i in range(3):
+                    self._wait_idle(fname)
+                    if recompress_file(fname, profile=self.profile, layout=self.layout,
+                                       num_threads=self.num_threads):
+                        break
+                else:
+                    print(f'Giving up recompressing {fname}.')
+                    continue
+                log_write(scanid, 'recompressed', fname, self.profile, stop_time=stop_time,
+                          log_fname=self.log_fname)
+                print(f'Recompressed {fname} with {self.profile}.')
+            except Exception:
+                print(f'Error recompressing {fname}:')
+                traceback.print_exc()
+
+
+_recompressors = {}
+_recompressors_lock = threading.Lock()
+
+
+def get_recompressor(profile='gzip-4', layout=None):
+    """
+    Return a started Recompressor shared by all conversions with this profile
+    """
+    with _recompressors_lock:
+        key = (profile, layout)
+        if key not in _recompressors:
+            r = Recompressor(profile, layout=layout)
+            r.start()
+            _recompressors[key] = r
+        return _recompressors[key]
+
+
+def stop_recompressors():
+    """
+    Wait for the files queued in the shared recompressors
+    """
+    with _recompressors_lock:
+        recompressors = list(_recompressors.values())
+        _recompressors.clear()
+    for r in recompressors:
+        r.stop()
+
+
+# The thread is a daemon and would be killed with the queued files half
+#   copied. atexit covers the main process, Finalize the worker processes
+#   of multiprocessing, which exit without running atexit.
+atexit.register(stop_recompressors)
+multiprocessing.util.Finalize(None, stop_recompressors, exitpriority=10)
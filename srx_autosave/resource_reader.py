@@ -0,0 +1,279 @@
+"""
+SRX Autosave resource reader
+
+Read detector data straight from the HDF5 resource files. h.data(key,
+fill=True) resolves and fills the events one datum at a time through
+the databroker handlers. Here the resource and datum documents of a scan
+are looked up once, the datums are grouped by file and consecutive
+frames are read with one h5py slice, directly into the destination
+array.
+
+Only the Xspress3 resource specs are known, anything else returns None
+and the caller falls back to the databroker.
+
+Andy Kiss
+"""
+import os
+import traceback
+import h5py
+import numpy as np
+
+from vds import XSP3_DATA_PATH
+from scan_reader import cast_checked
+
+
+# Resource specs that are read directly, and the dataset of the spectra
+BULK_SPECS = {
+    'XSP3': XSP3_DATA_PATH,
+    'XSP3_FLY': XSP3_DATA_PATH,
+    'XSP3_STEP': XSP3_DATA_PATH,
+}
+
+# Size of the blocks of frames read at once, in bytes
+READ_BLOCK_BYTES = 2**26
+
+
+class ResourceReader(object):
+    """
+    Direct reads of the detector data of one scan
+
+    Parameters
+    ----------
+    h : Header
+        Scan header
+    reg : Registry
+        Resource registry of the databroker, db.reg
+    specs : dict
+        Known resource specs and the dataset of the data in their files
+
+    Examples
+    --------
+    >>> res = ResourceReader(h, db.reg)
+    >>> d_xs = read_data(h, 'fluor', stream_name='stream0', resources=res)
+    """
+
+    def __init__(self, h, reg, specs=BULK_SPECS):
+        self.h = h
+        self.reg = reg
+        self.specs = specs
+        self._datums = {}
+        # Shape of one event of each key read, before any sum
+        self.event_shapes = {}
+
+    def _resolve_datum(self, datum_id):
+        if datum_id not in self._datums:
+            # One query for the resource and one for all of its datums
+            res = self.reg.resource_given_datum_id(datum_id)
+            if res['spec'] not in self.specs:
+                raise KeyError(res['spec'])
+            fn = os.path.join(res.get('root', '') or '', res['resource_path'])
+            path = self.specs[res['spec']]
+            for datum in self.reg.datum_gen_given_resource(res):
+                kwargs = datum.get('datum_kwargs', {})
+                channel = kwargs.get('channel')
+                self._datums[datum['datum_id']] = (fn, path, kwargs.get('frame'),
+                                                   None if channel is None else channel - 1)
+        return self._datums[datum_id]
+
+    def _locate(self, keys, stream_name):
+        """
+        Return (fname, data path, frame, channel) of each event for each key, or None
+        """
+        locs = [[] for key in keys]
+        try:
+            for ev in self.h.events(stream_name=stream_name, fields=list(keys), fill=False):
+                for loc, key in zip(locs, keys):
+                    loc.append(self._resolve_datum(ev['data'][key]))
+        except KeyError as ex:
+            print(f"Unknown resource spec {ex} for {keys}, using the databroker.")
+            return None
+        return locs
+
+    def _runs(self, locs):
+        """
+        Group events with consecutive frames of the same file and channel
+
+        Yields (fname, data path, channel, first frame, first event, number of events),
+        first frame is None for events holding the whole file.
+        """
+        run = None
+        for n, (fn, path, frame, channel) in enumerate(locs):
+            if (run is not None and frame is not None and run[0] == fn and run[2] == channel
+                    and run[3] is not None and frame == run[3] + run[5]):
+                run[5] += 1
+                continue
+            if run is not None:
+                yield tuple(run)
+            run = [fn, path, channel, frame, n, 1]
+        if run is not None:
+            yield tuple(run)
+
+    def read_data(self, key, stream_name='primary', dtype=None, out=None, sum_axis=None):
+        """
+        Read a data key into an array, see scan_reader.read_data
+
+        Parameters
+        ----------
+        key : string
+            Data key
+        stream_name : string
+            Event stream
+        dtype : numpy dtype, optional
+            Data type of the result
+        out : ndarray, optional
+            Destination array
+        sum_axis : int, optional
+            Sum each event over this axis (of the event) while reading
+
+        Returns
+        -------
+        data : ndarray or None
+            None if the data cannot be read directly
+        """
+
+        try:
+            locs = self._locate([key], stream_name)
+            if not locs or not locs[0]:
+                return None
+            out, self.event_shapes[key] = self._read(locs[0], dtype, out, sum_axis)
+            return out
+        except Exception:
+            print(f'Cannot read {key} from the resource files, using the databroker.')
+            traceback.print_exc()
+            return None
+
+    def read_channels(self, keys, stream_name='primary', dtype=None, sum_channels=False):
+        """
+        Read the channels of a step scan, see scan_reader.read_channels
+
+        Each block of frames is read once for all channels.
+
+        Returns
+        -------
+        data : ndarray or None
+            None if the data cannot be read directly
+        """
+
+        try:
+            locs = self._locate(keys, stream_name)
+            if not locs or not all(locs):
+                return None
+            frames = [loc[:3] for loc in locs[0]]
+            chans = [loc[0][3] for loc in locs]
+            if (any(c is None for c in chans)
+                    or any([ev[:3] for ev in loc] != frames for loc in locs)
+                    or any(ev[3] != c for loc, c in zip(locs, chans) for ev in loc)):
+                # Not one frame per event with one channel per key
+                return self._read_each(keys, stream_name, dtype, sum_channels)
+            out, shape = self._read(locs[0], dtype, None, None, channels=chans,
+                                    sum_channels=sum_channels)
+            self.event_shapes.update({key: shape for key in keys})
+            return out
+        except Exception:
+            print(f'Cannot read {keys} from the resource files, using the databroker.')
+            traceback.print_exc()
+            return None
+
+    def _read_each(self, keys, stream_name, dtype, sum_channels):
+        out = None
+        for i, key in enumerate(keys):
+            if sum_channels:
+                data = self.read_data(key, stream_name=stream_name)
+                if data is None:
+                    return None
+                if out is None:
+                    out = data.astype(np.sum(data[:1]).dtype)
+                else:
+                    out += data
+            elif out is None:
+                data = self.read_data(key, stream_name=stream_name, dtype=dtype)
+                if data is None:
+                    return None
+                out = np.empty((len(keys),) + data.shape, dtype=data.dtype)
+                out[0] = data
+            elif self.read_data(key, stream_name=stream_name, out=out[i]) is None:
+                return None
+        if sum_channels:
+            out = cast_checked(out, dtype)
+        return out
+
+    def _read(self, locs, dtype, out, sum_axis, channels=None, sum_channels=False):
+        files = {}
+        event_shape = None
+        try:
+            for fn, path, channel, frame, n0, n in self._runs(locs):
+                if fn not in files:
+                    files[fn] = h5py.File(fn, 'r')
+                ds = files[fn][path]
+                if channels is not None:
+                    channel = channels
+                # Shape of one frame, without the channel axis for channel datums
+                frame_shape = ds.shape[1:] if channel is None else ds.shape[2:]
+                if frame is None:
+                    # The event is the whole file, e.g. one row of a fly scan
+                    event_shape = (ds.shape[0],) + frame_shape
+                else:
+                    event_shape = frame_shape
+
+                if out is None:
+                    out = self._allocate(len(locs), event_shape, ds.dtype, dtype, sum_axis,
+                                         channels, sum_channels)
+
+                if frame is None:
+                    for i in range(n0, n0 + n):
+                        self._read_event(ds, channel, event_shape, out, i, sum_axis)
+                    continue
+
+                # Blocks of consecutive frames. Channels are picked in memory,
+                # HDF5 is very slow at strided selections of chunked datasets.
+                step = max(1, READ_BLOCK_BYTES // max(1, ds.dtype.itemsize * int(np.prod(ds.shape[1:]))))
+                for k in range(0, n, step):
+                    m = min(step, n - k)
+                    i0 = n0 + k
+                    sel = np.s_[frame + k:frame + k + m]
+                    if channel is None and sum_axis is None and out.flags.c_contiguous:
+                        ds.read_direct(out, source_sel=sel, dest_sel=np.s_[i0:i0 + m])
+                        continue
+                    block = ds[sel]
+                    if channel is not None:
+                        block = block[:, channel]
+                    if channels is not None and sum_channels:
+                        out[i0:i0 + m] = cast_checked(np.sum(block, axis=1), out.dtype)
+                    elif channels is not None:
+                        out[:, i0:i0 + m] = cast_checked(np.moveaxis(block, 1, 0), out.dtype)
+                    elif sum_axis is not None:
+                        out[i0:i0 + m] = cast_checked(np.sum(block, axis=sum_axis + 1), out.dtype)
+                    else:
+                        out[i0:i0 + m] = cast_checked(block, out.dtype)
+        finally:
+            for f in files.values():
+                f.close()
+        return out, event_shape
+
+    @staticmethod
+    def _allocate(num_events, event_shape, file_dtype, dtype, sum_axis, channels, sum_channels):
+        # Sums are widened like np.sum unless a type is given
+        sum_dtype = dtype or np.sum(np.zeros(1, file_dtype)).dtype
+        if channels is not None and sum_channels:
+            return np.zeros((num_events,) + event_shape, dtype=sum_dtype)
+        if channels is not None:
+            return np.zeros((len(channels), num_events) + event_shape, dtype=dtype or file_dtype)
+        if sum_axis is not None:
+            shape = event_shape[:sum_axis] + event_shape[sum_axis+1:]
+            return np.zeros((num_events,) + shape, dtype=sum_dtype)
+        return np.zeros((num_events,) + event_shape, dtype=dtype or file_dtype)
+
+    @staticmethod
+    def _read_event(ds, channel, event_shape, out, i, sum_axis):
+        if (channel is None and sum_axis is None and out.flags.c_contiguous
+                and out.shape[1:] == event_shape):
+            ds.read_direct(out, dest_sel=np.s_[i])
+            return
+        event = ds[()]
+        if channel is not None:
+            event = event[:, channel]
+        if sum_axis is not None:
+            event = np.sum(event, axis=sum_axis)
+        # Files with more or fewer frames than the row
+        m = min(event.shape[0], out.shape[1])
+        out[i, :m] = cast_checked(event[:m], out.dtype)
@@ -0,0 +1,423 @@
+"""
+SRX Autosave ROI maps
+
+Compute the maps of many energy windows of the summed spectra at once.
+Slicing f['xrfmap/detsum/counts'][:, :, lo:hi] for each element reads
+and decompresses every chunk of the file once per element. Here the map
+is read once, in blocks of rows covering only the bins from the lowest
+to the highest window. The cumulative sum of each block along the energy
+axis gives every window as the difference of two bins, so the time
+hardly depends on the number of elements.
+
+new_makehdf can compute the maps from the detector sum it already has
+in memory, and leave them here with store_maps for autoroi_xrf. The HDF5
+file is then only read back when the ROIs are made in another process
+or for reprocessing.
+
+The windows are set in keV in a JSON file, element_roi.json by default,
+with the energy calibration of the detector (the e_offset, e_linear and
+e_quadratic of the PyXRF parameters):
+
+    {"calibration": {"e_offset": 0.0, "e_linear": 0.01, "e_quadratic": 0.0},
+     "rois": {"K_k": [3.16, 3.46], "Cu_k": [7.80, 8.20]}}
+
+They are converted to bins once for each calibration and incident energy,
+and lines above the incident energy are left out.
+
+Andy Kiss
+"""
+import functools
+import json
+import os
+import threading
+import h5py
+import numpy as np
+
+from hdf_writer import reorder_rows
+
+
+# Size of the blocks of rows read at once, in bytes
+ROI_BLOCK_BYTES = 2**26
+
+# Number of scans whose maps are kept for autoroi_xrf, oldest dropped first
+ROI_HANDOFF_SCANS = 8
+
+_handoff = {}
+_handoff_lock = threading.Lock()
+
+# Default ROI table, see RoiTable
+ROI_CONFIG_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'element_roi.json')
+
+# (e_offset, e_linear, e_quadratic), bin i is at e_offset + e_linear*i + e_quadratic*i**2 keV
+DEFAULT_CALIBRATION = (0.0, 0.01, 0.0)
+
+
+def _windows(rois, num_bins):
+    # Clip the windows to the spectrum, empty windows give zero maps
+    names = list(rois)
+    lo = np.array([min(max(int(rois[x][0]), 0), num_bins) for x in names])
+    hi = np.array([min(max(int(rois[x][1]), 0), num_bins) for x in names])
+    return names, lo, np.maximum(hi, lo)
+
+
+def roi_sums(block, lo, hi, dtype=None):
+    """
+    Sum a block of spectra over several energy windows
+
+    Parameters
+    ----------
+    block : ndarray
+        Spectra, energy along the last axis
+    lo, hi : ndarray
+        First and last (excluded) bin of each window, relative to block
+    dtype : numpy dtype, optional
+        Type of the sums, defaults to the type of np.sum(block)
+
+    Returns
+    -------
+    sums : ndarray
+        block.shape[:-1] + (number of windows,)
+    """
+
+    if dtype is None:
+        dtype = np.sum(block[..., :1]).dtype
+    # Floats are summed in float64, the difference of two large float32
+    #   prefix sums loses the counts of windows at the end of long spectra
+    acc_dtype = np.float64 if np.dtype(dtype).kind == 'f' else dtype
+    # Cumulative sum with a leading zero, window i is cs[hi[i]] - cs[lo[i]]
+    cs = np.zeros(block.shape[:-1] + (block.shape[-1] + 1,), dtype=acc_dtype)
+    np.cumsum(block, axis=-1, dtype=acc_dtype, out=cs[..., 1:])
+    return (cs[..., hi] - cs[..., lo]).astype(dtype, copy=False)
+
+
+def block_rows(data, bins=None, block_bytes=ROI_BLOCK_BYTES):
+    """
+    Number of rows per block for iter_row_blocks
+
+    Whole chunk rows of the dataset, and at least one, so every chunk is
+    decompressed by a single read.
+    """
+    num_rows, num_cols, num_bins = data.shape
+    if bins is not None:
+        num_bins = bins[1] - bins[0]
+    row_bytes = max(1, num_cols * num_bins * data.dtype.itemsize)
+    step = max(1, block_bytes // row_bytes)
+    chunks = getattr(data, 'chunks', None)
+    if chunks is not None:
+        step = max(step - step % chunks[0], chunks[0])
+    return min(step, max(1, num_rows))
+
+
+def iter_row_blocks(data, bins=None, block_bytes=ROI_BLOCK_BYTES):
+    """
+    Iterate over blocks of whole chunk rows of a map
+
+    Parameters
+    ----------
+    data : h5py.Dataset or ndarray
+        Spectra of the map, (rows, columns, bins)
+    bins : tuple, optional
+        Only read the bins from bins[0] to bins[1] (excluded)
+    block_bytes : int
+        Approximate size of the blocks, see block_rows
+
+    Yields
+    ------
+    i0 : int
+        First row of the block
+    block : ndarray
+        (rows, columns, bins) block
+    """
+    b0, b1 = (0, data.shape[2]) if bins is None else bins
+    step = block_rows(data, bins, block_bytes)
+    for i in range(0, data.shape[0], step):
+        yield i, data[i:i + step, :, b0:b1]
+
+
+def _prime_above(n):
+    n = int(n) | 1
+    while any(n % k == 0 for k in range(3, int(n**0.5) + 1, 2)):
+        n += 2
+    return n
+
+
+def open_tuned(f, path, bins=None, block_bytes=ROI_BLOCK_BYTES):
+    """
+    Open a spectra dataset with a chunk cache that holds one chunk row
+
+    The default HDF5 cache is 1 MB per dataset. Chunks larger than that,
+    or a block that starts in the middle of a chunk, are read and
+    decompressed again for every read that touches them.
+
+    Parameters
+    ----------
+    f : h5py.File
+        Open file
+    path : string
+        Dataset, e.g. 'xrfmap/detsum/counts'
+    bins : tuple, optional
+        Bins that will be read, the cache only needs their chunks
+    block_bytes : int
+        Block size of the reads, the cache is at most twice that
+
+    Returns
+    -------
+    ds : h5py.Dataset
+    """
+    ds = f[path]
+    if ds.chunks is None:
+        return ds
+    shape, chunks, itemsize, name = ds.shape, ds.chunks, ds.dtype.itemsize, ds.name
+    # The cache is set when the dataset is opened, an open one keeps its own
+    del ds
+    b0, b1 = (0, shape[2]) if bins is None else bins
+    chunks_per_row = -(-shape[1] // chunks[1]) * ((b1 - 1) // chunks[2] - b0 // chunks[2] + 1)
+    chunk_bytes = int(np.prod(chunks)) * itemsize
+    nbytes = int(min(max(2**20, chunks_per_row * chunk_bytes), 2 * block_bytes))
+    nslots = _prime_above(100 * max(1, nbytes // chunk_bytes))
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    # Chunks are read whole and in order, evict fully read chunks first
+    dapl.set_chunk_cache(nslots, nbytes, 1.0)
+    return h5py.Dataset(h5py.h5d.open(f.id, name.encode(), dapl=dapl))
+
+
+def roi_maps(data, rois, block_bytes=ROI_BLOCK_BYTES, snake=False, transpose=False):
+    """
+    Compute the map of each energy window in one pass over the data
+
+    Parameters
+    ----------
+    data : h5py.Dataset or ndarray
+        Spectra of the map, (rows, columns, bins)
+    rois : dict
+        First and last (excluded) bin of each window, e.g. {'Cu_k': [780, 820]}
+    block_bytes : int
+        Size of the blocks of rows read at once, in bytes, see block_rows
+    snake, transpose : bool
+        Reverse the odd rows and swap rows and columns of the maps, for
+        data still in the order it was measured
+
+    Returns
+    -------
+    maps : dict
+        (rows, columns) map of each window, with the type of np.sum(data)
+
+    Examples
+    --------
+    >>> with h5py.File('scan2D_1234_xs_sum8ch.h5', 'r') as f:
+    ...     maps = roi_maps(f['xrfmap/detsum/counts'], {'Cu_k': [780, 820], 'Fe_k': [620, 660]})
+    """
+
+    acc = RoiAccumulator(rois, *data.shape, dtype=data.dtype)
+    if np.any(acc.hi > acc.lo):
+        # Only the bins of the union of the windows are read
+        for i, block in iter_row_blocks(data, (acc.b0, acc.b1), block_bytes):
+            acc.add(i, block, cropped=True)
+    return acc.maps(snake=snake, transpose=transpose)
+
+
+def read_roi_maps(fname, rois, interpath='xrfmap', block_bytes=ROI_BLOCK_BYTES):
+    """
+    Compute the ROI maps and I0 of an HDF5 file in bounded memory
+
+    The detector sum is read in blocks of whole chunk rows through a
+    tuned chunk cache, and the I0 scaler with the same blocks, so only
+    one block of spectra is in memory at a time.
+
+    Parameters
+    ----------
+    fname : string
+        HDF5 file written by make_hdf or new_makehdf
+    rois : dict
+        First and last (excluded) bin of each window
+    interpath : string
+        Base group in the file
+    block_bytes : int
+        Size of the blocks of rows read at once, in bytes
+
+    Returns
+    -------
+    maps : dict
+        (rows, columns) map of each window
+    i0 : ndarray
+        (rows, columns) I0 scaler
+    """
+    with h5py.File(fname, 'r') as f:
+        sclr = f[interpath + '/scalers/val']
+        path = interpath + '/detsum/counts'
+        acc = RoiAccumulator(rois, *f[path].shape, dtype=f[path].dtype)
+        i0 = np.zeros(sclr.shape[:2], dtype=sclr.dtype)
+        bins = (acc.b0, max(acc.b1, acc.b0 + 1))
+        ds = open_tuned(f, path, bins=bins, block_bytes=block_bytes)
+        for i, block in iter_row_blocks(ds, bins, block_bytes):
+            acc.add(i, block[:, :, :acc.b1 - acc.b0], cropped=True)
+            i0[i:i + block.shape[0]] = sclr[i:i + block.shape[0], :, 0]
+    return acc.maps(), i0
+
+
+def store_maps(scanid, maps, i0):
+    """
+    Keep the ROI maps of a scan until autoroi_xrf takes them
+
+    Parameters
+    ----------
+    scanid : int
+        Scan ID
+    maps : dict
+        (rows, columns) map of each window, in the orientation of the file
+    i0 : ndarray
+        (rows, columns) I0 scaler
+    """
+    with _handoff_lock:
+        _handoff.pop(int(scanid), None)
+        _handoff[int(scanid)] = (maps, i0)
+        while len(_handoff) > ROI_HANDOFF_SCANS:
+            _handoff.pop(next(iter(_handoff)))
+
+
+def take_maps(scanid, rois=None):
+    """
+    Return and forget the stored maps of a scan
+
+    Returns
+    -------
+    maps, i0 : dict, ndarray
+        Stored maps and I0, or (None, None) if the scan was not stored or
+        does not have a map for every window in rois
+    """
+    with _handoff_lock:
+        maps, i0 = _handoff.pop(int(scanid), (None, None))
+    if maps is None or any(x not in maps for x in (rois or ())):
+        return None, None
+    return maps, i0
+
+
+def energy_to_bin(energy, calibration=DEFAULT_CALIBRATION):
+    """
+    Return the (fractional) bin of an energy in keV
+    """
+    e_offset, e_linear, e_quadratic = calibration
+    e = energy - e_offset
+    if e_quadratic == 0:
+        return e / e_linear
+    return (-e_linear + np.sqrt(e_linear**2 + 4 * e_quadratic * e)) / (2 * e_quadratic)
+
+
+@functools.lru_cache(maxsize=32)
+def _bin_windows(windows, calibration, incident_energy):
+    rois = {}
+    for name, lo, hi in windows:
+        if incident_energy is not None and (lo + hi) / 2 > incident_energy:
+            print(f'Skipping ROI {name}, above the incident energy of {incident_energy} keV.')
+            continue
+        rois[name] = [int(np.rint(energy_to_bin(lo, calibration))),
+                      int(np.rint(energy_to_bin(hi, calibration)))]
+    return rois
+
+
+class RoiTable(object):
+    """
+    ROI windows in keV, converted to bins for each incident energy
+
+    Parameters
+    ----------
+    rois : dict
+        First and last energy of each window in keV, e.g. {'Cu_k': [7.8, 8.2]}
+    calibration : tuple
+        (e_offset, e_linear, e_quadratic) of the detector, in keV
+
+    Examples
+    --------
+    >>> table = load_roi_table('element_roi.json')
+    >>> table.bins(incident_energy=12.0)
+    {'K_k': [316, 346], 'Mn_k': [575, 605], ...}
+    """
+
+    def __init__(self, rois, calibration=DEFAULT_CALIBRATION):
+        self.windows = tuple((name, float(lo), float(hi)) for name, (lo, hi) in rois.items())
+        self.calibration = tuple(float(x) for x in calibration)
+
+    @classmethod
+    def from_file(cls, fname=ROI_CONFIG_FNAME):
+        """
+        Read the table from a JSON file, see the top of roi.py
+        """
+        with open(fname) as f:
+            config = json.load(f)
+        cal = config.get('calibration', {})
+        calibration = (cal.get('e_offset', DEFAULT_CALIBRATION[0]),
+                       cal.get('e_linear', DEFAULT_CALIBRATION[1]),
+                       cal.get('e_quadratic', DEFAULT_CALIBRATION[2]))
+        return cls(config['rois'], calibration)
+
+    def bins(self, incident_energy=None):
+        """
+        Return the windows in bins, without the lines above incident_energy (keV)
+
+        The conversion is cached for each calibration and incident energy
+        (to 1 eV), so it is only done once for a series of scans.
+        """
+        if incident_energy is not None:
+            incident_energy = round(float(incident_energy), 3)
+        return dict(_bin_windows(self.windows, self.calibration, incident_energy))
+
+
+@functools.lru_cache(maxsize=8)
+def _load_roi_table(fname, mtime):
+    return RoiTable.from_file(fname)
+
+
+def load_roi_table(fname=ROI_CONFIG_FNAME):
+    """
+    Return the RoiTable of a JSON file, read again only if the file changed
+    """
+    return _load_roi_table(os.path.abspath(fname), os.path.getmtime(fname))
+
+
+class RoiAccumulator(object):
+    """
+    ROI maps computed block by block while a map is written
+
+    Parameters
+    ----------
+    rois : dict
+        First and last (excluded) bin of each window
+    num_rows, num_cols, num_bins : int
+        Shape of the map, in the order the rows are measured
+    dtype : numpy dtype
+        Type of the summed spectra
+
+    Examples
+    --------
+    >>> acc = RoiAccumulator(rois, num_rows, c, N_bins, d.dtype)
+    >>> acc.add(i0, block)  # for each block of rows
+    >>> maps = acc.maps()
+    """
+
+    def __init__(self, rois, num_rows, num_cols, num_bins, dtype):
+        self.names, lo, hi = _windows(rois, num_bins)
+        self.b0 = int(lo.min()) if self.names else 0
+        self.lo, self.hi = lo - self.b0, hi - self.b0
+        self.b1 = int(hi.max()) if self.names else 0
+        self.dtype = np.sum(np.zeros(1, dtype=dtype)).dtype
+        self.out = np.zeros((num_rows, num_cols, len(self.names)), dtype=self.dtype)
+
+    def add(self, i0, block, cropped=False):
+        """
+        Add the windows of a block of summed spectra starting at row i0
+
+        block is (rows, columns, bins), or only the bins b0 to b1 of the
+        windows if cropped is True.
+        """
+        if self.names:
+            if not cropped:
+                block = block[:, :, self.b0:self.b1]
+            self.out[i0:i0 + block.shape[0]] = roi_sums(block, self.lo, self.hi,
+                                                        dtype=self.dtype)
+
+    def maps(self, snake=False, transpose=False):
+        """
+        Return the map of each window, in the orientation of the file
+        """
+        out = reorder_rows(self.out, 0, snake=snake, transpose=transpose)
+        return {x: out[:, :, i] for i, x in enumerate(self.names)}
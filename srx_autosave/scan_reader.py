@@ -0,0 +1,476 @@
+"""
+SRX Autosave scan reader
+
+Read event data from the databroker straight into preallocated arrays.
+np.array(list(h.data(...))) keeps every row as a separate array and
+then copies them all into a new array, so the peak memory is at least
+twice the size of the data. Here the destination is allocated once from
+the number of events and the shape of the first row, and each row is
+copied into place as it arrives.
+
+Andy Kiss
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# Detector data types, see policy_dtype
+DTYPE_POLICIES = ('native', 'uint32', 'float32')
+
+# Number of streams read at the same time, see fetch_concurrent
+FETCH_THREADS = 4
+
+
+def policy_dtype(policy):
+    """
+    Return the data type of a dtype policy
+
+    'native' keeps the type of the detector data (and numpy's wider type
+    for sums), and returns None. 'uint32' and 'float32' store the spectra
+    and sums with that type.
+    """
+    if policy not in DTYPE_POLICIES:
+        raise ValueError(f"Unknown dtype policy '{policy}'. Use one of {DTYPE_POLICIES}.")
+    if policy == 'native':
+        return None
+    return np.dtype(policy)
+
+
+def cast_checked(data, dtype):
+    """
+    Cast data to dtype, raising OverflowError if integers do not fit
+
+    Parameters
+    ----------
+    data : ndarray
+        Data, e.g. a sum over the detector channels
+    dtype : numpy dtype or None
+        Target type, None returns data unchanged
+
+    Returns
+    -------
+    data : ndarray
+    """
+    if dtype is None or data.dtype == dtype:
+        return data
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui' and data.size:
+        info = np.iinfo(dtype)
+        lo, hi = data.min(), data.max()
+        if lo < info.min or hi > info.max:
+            raise OverflowError(f'Values from {lo} to {hi} do not fit in {dtype}, '
+                                f"use the 'native' dtype policy.")
+    return data.astype(dtype, copy=False)
+
+
+def _num_events(h, stream_name):
+    try:
+        return h.stop['num_events'][stream_name]
+    except (KeyError, TypeError):
+        return None
+
+
+def _descriptor_shape(h, key, stream_name):
+    """
+    Return the shape of one event of a data key from the stream descriptor
+    """
+    for desc in h.descriptors:
+        if desc.get('name', 'primary') != stream_name:
+            continue
+        try:
+            return tuple(desc['data_keys'][key]['shape'])
+        except (KeyError, TypeError):
+            return None
+    return None
+
+
+def fill_rows(rows, num_rows, row_shape=None, dtype=None, out=None, sum_axis=None, add=False):
+    """
+    Copy an iterable of rows into a preallocated array
+
+    Parameters
+    ----------
+    rows : iterable
+        Rows of data, e.g. from h.data(key, fill=True)
+    num_rows : int
+        Expected number of rows
+    row_shape : tuple, optional
+        Shape of one row. The shape of the first row is used if it does
+        not match.
+    dtype : numpy dtype, optional
+        Data type of the destination, defaults to the type of the first row
+    out : ndarray, optional
+        Destination array with shape (num_rows,) + row_shape
+    sum_axis : int, optional
+        Sum each row over this axis (of the row) before storing it, so only
+        the reduced data is kept in memory
+    add : bool
+        Add the rows to out instead of overwriting it
+
+    Returns
+    -------
+    out : ndarray
+        Filled array. Truncated if there were fewer rows than expected.
+    """
+
+    n = 0
+    for row in rows:
+        row = np.asarray(row)
+        if sum_axis is not None:
+            row = np.sum(row, axis=sum_axis)
+        if out is None:
+            if row_shape is None or tuple(row_shape) != row.shape:
+                row_shape = row.shape
+            if dtype is None:
+                dtype = row.dtype
+            out = np.empty((num_rows,) + tuple(row_shape), dtype=dtype)
+        if n >= out.shape[0]:
+            print(f'Warning: more than {num_rows} rows, ignoring the rest.')
+            break
+        if add:
+            out[n] += row
+        else:
+            out[n] = cast_checked(row, out.dtype)
+        n += 1
+
+    if out is None:
+        return np.empty((0,) + tuple(row_shape or ()), dtype=dtype or np.float64)
+    if n < out.shape[0]:
+        out = out[:n]
+    return out
+
+
+def read_data(h, key, stream_name='primary', dtype=None, out=None, add=False, resources=None):
+    """
+    Read a data key of a scan into a preallocated array
+
+    Drop-in replacement for np.array(list(h.data(key, stream_name=stream_name, fill=True)))
+
+    Parameters
+    ----------
+    h : Header
+        Scan header
+    key : string
+        Data key, e.g. 'fluor' or 'enc1'
+    stream_name : string
+        Event stream
+    dtype : numpy dtype, optional
+        Data type of the result, defaults to the type of the data
+    out : ndarray, optional
+        Destination array
+    add : bool
+        Add the data to out instead of overwriting it
+    resources : ResourceReader, optional
+        Read the data straight from the resource files if possible
+
+    Returns
+    -------
+    data : ndarray
+        Array of shape (num_events,) + shape of one event
+    """
+
+    if resources is not None and not add:
+        data = resources.read_data(key, stream_name=stream_name, dtype=dtype, out=out)
+        if data is not None:
+            return data
+
+    num_rows = _num_events(h, stream_name)
+    if num_rows is None:
+        if out is None:
+            # Running scan, the number of events is not known yet
+            return np.array(list(h.data(key, stream_name=stream_name, fill=True)), dtype=dtype)
+        num_rows = out.shape[0]
+    row_shape = _descriptor_shape(h, key, stream_name)
+    return fill_rows(h.data(key, stream_name=stream_name, fill=True), num_rows,
+                     row_shape=row_shape, dtype=dtype, out=out, add=add)
+
+
+def read_sum(h, key, axis, stream_name='primary', dtype=None, resources=None):
+    """
+    Read a data key of a scan, summing each event over one axis on the fly
+
+    Memory use is the size of the summed data plus one event, the full
+    data is never held in memory.
+
+    Parameters
+    ----------
+    h : Header
+        Scan header
+    key : string
+        Data key, e.g. 'fluor'
+    axis : int
+        Axis of one event to sum over, e.g. 1 for the detector channels
+        of a fly scan row with shape (columns, channels, bins)
+    stream_name : string
+        Event stream
+    dtype : numpy dtype, optional
+        Data type of the result
+    resources : ResourceReader, optional
+        Read the data straight from the resource files if possible
+
+    Returns
+    -------
+    data : ndarray
+        Summed data, shape (num_events,) + shape of one event without axis
+    row_shape : tuple
+        Shape of one event before summing
+    """
+
+    if resources is not None:
+        data = resources.read_data(key, stream_name=stream_name, dtype=dtype, sum_axis=axis)
+        if data is not None:
+            return data, tuple(resources.event_shapes[key])
+
+    row_shape = []
+
+    def _rows():
+        for row in h.data(key, stream_name=stream_name, fill=True):
+            row = np.asarray(row)
+            if not row_shape:
+                row_shape.extend(row.shape)
+            yield row
+
+    num_rows = _num_events(h, stream_name)
+    if num_rows is None:
+        rows = list(_rows())
+        num_rows = len(rows)
+    else:
+        rows = _rows()
+    data = fill_rows(rows, num_rows, dtype=dtype, sum_axis=axis)
+    return data, tuple(row_shape)
+
+
+def stream_keys(h, stream_name='primary'):
+    """
+    Return the data keys of a stream from its descriptors
+
+    Cheaper than h.table(stream_name).keys(), which loads (and fills)
+    the whole table just to list the column names.
+    """
+    keys = []
+    for desc in h.descriptors:
+        if desc.get('name', 'primary') == stream_name:
+            keys.extend(k for k in desc['data_keys'] if k not in keys)
+    return keys
+
+
+def read_columns(h, keys, stream_name='primary', dtype=None):
+    """
+    Read a few data keys of a scan in one pass over the events
+
+    Only the requested columns are loaded (and filled), e.g. the scalers
+    and encoders of a fly scan without the detector data.
+
+    Parameters
+    ----------
+    h : Header
+        Scan header
+    keys : list
+        Data keys, e.g. ['i0', 'im', 'it']
+    stream_name : string
+        Event stream
+    dtype : numpy dtype, optional
+        Data type of the results, defaults to the type of each key
+
+    Returns
+    -------
+    data : dict
+        Array (num_events,) + shape of one event for each key
+
+    Examples
+    --------
+    >>> keys = stream_keys(h, 'stream0')
+    >>> cols = read_columns(h, [k for k in ['i0', 'im', 'it'] if k in keys], 'stream0')
+    """
+
+    keys = list(keys)
+    if not keys:
+        return {}
+    num_rows = _num_events(h, stream_name)
+    events = h.events(stream_name=stream_name, fields=keys, fill=True)
+    if num_rows is None:
+        # Running scan, the number of events is not known yet
+        events = list(events)
+        num_rows = len(events)
+
+    out = None
+    n = 0
+    for ev in events:
+        if n >= num_rows:
+            print(f'Warning: more than {num_rows} events, ignoring the rest.')
+            break
+        data = ev['data']
+        if out is None:
+            out = {}
+            for key in keys:
+                first = np.asarray(data[key])
+                out[key] = np.empty((num_rows,) + first.shape, dtype=dtype or first.dtype)
+        for key in keys:
+            out[key][n] = data[key]
+        n += 1
+
+    if out is None:
+        return {key: np.empty((0,), dtype=dtype or np.float64) for key in keys}
+    return {key: v[:n] for key, v in out.items()}
+
+
+def read_channels(h, keys, stream_name='primary', dtype=None, sum_channels=False, resources=None):
+    """
+    Read several data keys of a scan in one pass over the events
+
+    Each event is filled once and all keys are copied from it, instead of
+    one h.data call (and one pass over the events) per key.
+
+    Parameters
+    ----------
+    h : Header
+        Scan header
+    keys : list
+        Data keys, e.g. ['xs_channel1', 'xs_channel2']
+    stream_name : string
+        Event stream
+    dtype : numpy dtype, optional
+        Data type of the result, defaults to the type of the data
+    sum_channels : bool
+        Return the sum over the keys instead of each key
+    resources : ResourceReader, optional
+        Read the data straight from the resource files if possible
+
+    Returns
+    -------
+    data : ndarray
+        Array (len(keys), num_events) + shape of one event, or
+        (num_events,) + shape of one event with sum_channels
+    """
+
+    if resources is not None:
+        data = resources.read_channels(keys, stream_name=stream_name, dtype=dtype,
+                                       sum_channels=sum_channels)
+        if data is not None:
+            return data
+
+    num_rows = _num_events(h, stream_name)
+    events = h.events(stream_name=stream_name, fields=list(keys), fill=True)
+    if num_rows is None:
+        # Running scan, the number of events is not known yet
+        events = list(events)
+        num_rows = len(events)
+
+    out = None
+    n = 0
+    for ev in events:
+        if n >= num_rows:
+            print(f'Warning: more than {num_rows} events, ignoring the rest.')
+            break
+        data = ev['data']
+        if out is None:
+            first = np.asarray(data[keys[0]])
+            if dtype is None:
+                dtype = np.sum(first[:1]).dtype if sum_channels else first.dtype
+            if sum_channels:
+                out = np.empty((num_rows,) + first.shape, dtype=dtype)
+            else:
+                out = np.empty((len(keys), num_rows) + first.shape, dtype=dtype)
+        if sum_channels:
+            # Sum in the wide type, then check that it fits the result
+            row = np.sum([np.asarray(data[key]) for key in keys], axis=0)
+            out[n] = cast_checked(row, dtype)
+        else:
+            for i, key in enumerate(keys):
+                out[i, n] = data[key]
+        n += 1
+
+    if out is None:
+        shape = (0,) if sum_channels else (len(keys), 0)
+        return np.empty(shape, dtype=dtype or np.float64)
+    if n < num_rows:
+        out = out[:n] if sum_channels else out[:, :n]
+    return out
+
+
+def fetch_concurrent(tasks, num_threads=FETCH_THREADS):
+    """
+    Run independent reads at the same time and collect their results
+
+    Most of the time of a read is spent waiting on the database and the
+    file system, so a few threads overlap the reads of the positions,
+    scalers and detectors and the total time is close to the slowest one.
+
+    Parameters
+    ----------
+    tasks : dict
+        Name and function without arguments of each read
+    num_threads : int
+        Maximum number of reads at the same time, 1 reads one after another
+
+    Returns
+    -------
+    results : dict
+        Result of each read, by name. The first exception of a read is
+        raised once all reads are done.
+    """
+
+    if num_threads is None or num_threads <= 1 or len(tasks) <= 1:
+        return {name: func() for name, func in tasks.items()}
+    with ThreadPoolExecutor(max_workers=min(num_threads, len(tasks))) as pool:
+        futures = {name: pool.submit(func) for name, func in tasks.items()}
+    return {name: fut.result() for name, fut in futures.items()}
+
+
+def reshape_to_map(data, c, num_rows=None, axis=0, fill_value=0):
+    """
+    Reshape a list of scan points into a map, padding incomplete rows
+
+    Aborted or partial step scans have fewer points than rows * columns.
+    The missing points are filled with fill_value and marked in the mask,
+    without any Python loops over the points.
+
+    Parameters
+    ----------
+    data : ndarray
+        Data with one entry per scan point along axis
+    c : int
+        Number of columns (points per row)
+    num_rows : int, optional
+        Number of rows of the map, defaults to the rows needed for the data.
+        Points beyond num_rows * c are dropped.
+    axis : int
+        Axis of the scan points
+    fill_value : scalar
+        Value of the missing points
+
+    Returns
+    -------
+    out : ndarray
+        Data with the point axis replaced by (num_rows, c)
+    mask : ndarray
+        Boolean array (num_rows, c), True for measured points
+
+    Examples
+    --------
+    >>> out, mask = reshape_to_map(np.arange(5), 3)
+    >>> out
+    array([[0, 1, 2],
+           [3, 4, 0]])
+    >>> mask
+    array([[ True,  True,  True],
+           [ True,  True, False]])
+    """
+
+    data = np.moveaxis(np.asarray(data), axis, 0)
+    n = data.shape[0]
+    if num_rows is None:
+        num_rows = max(1, -(-n // c))
+    n_pts = num_rows * c
+    m = min(n, n_pts)
+    if n == n_pts:
+        out = data
+    else:
+        out = np.full((n_pts,) + data.shape[1:], fill_value, dtype=data.dtype)
+        out[:m] = data[:m]
+    out = np.reshape(out, (num_rows, c) + data.shape[1:])
+    out = np.moveaxis(out, (0, 1), (axis, axis + 1))
+
+    mask = np.zeros(n_pts, dtype=bool)
+    mask[:m] = True
+    return out, np.reshape(mask, (num_rows, c))
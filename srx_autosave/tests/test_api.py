@@ -0,0 +1,250 @@
+import queue
+import threading
+import time
+import types
+
+import api
+from docstream import DocumentSource
+from ledger import ScanLedger, ScanCursor
+
+
+class _Header(object):
+    start = {'scan': {'shape': [10, 10]}}
+
+
+class _FlyHeader(object):
+    start = {'scan_id': 5, 'scan': {'type': 'XRF_FLY', 'shape': [10, 10]}}
+    stop = {'time': 1}
+
+
+class _Broker(object):
+    _catalog = types.SimpleNamespace(_entries=types.SimpleNamespace(cache_clear=lambda: None))
+
+    def __getitem__(self, scanid):
+        return _FlyHeader()
+
+
+def _worker_settings(scanid, auto_dir, report):
+    # Stands in for _convert_scan in the worker processes
+    return sorted(api._settings().items())
+
+
+def test_parallel_workers_get_settings(monkeypatch):
+    flags = {'auto_roi_flag': False, 'use_new_makehdf': True, 'roi_config': 'other_roi.json',
+             'roi_export_threads': 1, 'roi_stack_tiff': True, 'hdf_write_profile': 'fast-lzf',
+             'hdf_archive_profile': 'gzip-4', 'hdf_chunk_layout': 'roi', 'hdf_dtype_policy': 'uint32',
+             'hdf_each_det': True, 'hdf_virtual_det': True, 'hdf_direct_read': True,
+             'hdf_fetch_threads': 1}
+    for k, v in flags.items():
+        monkeypatch.setattr(api, k, v)
+    monkeypatch.setattr(api, '_convert_scan', _worker_settings)
+
+    results = api.convert_scans_parallel([(1, _Header()), (2, _Header())], num_workers=2)
+    assert results == {1: sorted(flags.items()), 2: sorted(flags.items())}
+
+
+def test_skipped_conversion_fails(monkeypatch):
+    # new_makehdf only prints why it skips a scan, e.g. no detectors
+    monkeypatch.setattr(api, 'use_new_makehdf', True)
+    monkeypatch.setattr(api, 'auto_roi_flag', False)
+    monkeypatch.setattr(api, 'new_makehdf', lambda scanid, rois=None, **kwargs: [])
+    assert api._convert_scan(1, 'auto_rois/') == 'failed'
+    assert api._hdf_stage(1) == 'failed'
+
+    monkeypatch.setattr(api, 'new_makehdf',
+                        lambda scanid, rois=None, **kwargs: ['scan2D_1_xs_sum8ch.h5'])
+    assert api._convert_scan(1, 'auto_rois/') == 'converted'
+    assert api._hdf_stage(1) == 'converted'
+
+
+def test_new_makehdf_gets_run_settings(monkeypatch):
+    calls = []
+    monkeypatch.setattr(api, 'use_new_makehdf', True)
+    monkeypatch.setattr(api, 'auto_roi_flag', False)
+    monkeypatch.setattr(api, 'hdf_write_profile', 'fast-lzf')
+    monkeypatch.setattr(api, 'hdf_archive_profile', 'gzip-4')
+    monkeypatch.setattr(api, 'hdf_virtual_det', True)
+    monkeypatch.setattr(api, 'new_makehdf', lambda scanid, **kwargs: calls.append(kwargs) or ['f.h5'])
+    assert api._make_hdf(1)
+    assert calls[0]['write_profile'] == 'fast-lzf'
+    assert calls[0]['archive_profile'] == 'gzip-4'
+    assert calls[0]['virtual_det'] is True
+    assert calls[0]['dtype_policy'] == 'native'
+    assert calls[0]['rois'] is None
+
+
+def test_failed_scan_converts_on_retry(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api, 'db', _Broker())
+    monkeypatch.setattr(api, 'get_current_scanid', lambda: 5)
+    monkeypatch.setattr(api, 'auto_roi_flag', False)
+    calls = []
+
+    def _convert(scanid, auto_dir, report=True):
+        # The resource files are not flushed yet on the first try
+        calls.append(scanid)
+        if len(calls) == 1:
+            return 'failed'
+        open(f'scan2D_{scanid}_xs_sum8ch.h5', 'w').close()
+        return 'converted'
+
+    monkeypatch.setattr(api, '_convert_scan', _convert)
+    ledger = ScanLedger(str(tmp_path / 'ledger.db'), retry_delay=0.5)
+    cursor = ScanCursor(5, ledger=ledger)
+    api.xrf_loop(5, 0, ledger=ledger, cursor=cursor)
+    assert ledger.get(5) == ('failed', None)
+    assert cursor.pending() == [5]
+
+    # Not tried again before the delay
+    api.xrf_loop(5, 0, ledger=ledger, cursor=cursor)
+    assert calls == [5]
+    time.sleep(0.6)
+    api.xrf_loop(5, 0, ledger=ledger, cursor=cursor)
+    assert calls == [5, 5]
+    assert ledger.get(5) == ('converted', 'scan2D_5_xs_sum8ch.h5')
+    assert cursor.pending() == []
+
+
+class _Signal(object):
+    def emit(self, *args):
+        pass
+
+
+class _Gui(object):
+    DT = 0.02
+    isRunning = True
+    signal_update_status = _Signal()
+    signal_update_progressBar = _Signal()
+
+
+class _Source(DocumentSource):
+    def _run(self):
+        self._stop_event.wait()
+
+
+def test_slow_live_map_does_not_block_listener(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api, 'auto_roi_flag', False)
+    monkeypatch.setattr(api, 'LIVE_FINISH_TIMEOUT', 0.5)
+    monkeypatch.setattr(api, 'xrf_loop', lambda *args, **kwargs: None)
+    live_ended = threading.Event()
+    converted = []
+
+    def _follow(scanid, docs=None, stop_event=None):
+        if scanid == 8:
+            open('scan2D_8_xs_sum8ch.h5', 'w').close()
+            return 'scan2D_8_xs_sum8ch.h5'
+        # Scan 7 never finishes its live map, it is busy until stopped
+        stop_event.wait()
+        time.sleep(0.1)
+        live_ended.set()
+        return None
+
+    def _process(scanid, auto_dir=None, ledger=None):
+        converted.append((scanid, live_ended.is_set()))
+        return 'converted'
+
+    monkeypatch.setattr(api, 'follow_scan', _follow)
+    monkeypatch.setattr(api, 'process_scan', _process)
+    ledger = ScanLedger(str(tmp_path / 'ledger.db'))
+    source, gui = _Source(), _Gui()
+    th = threading.Thread(target=api.xrf_listen, args=(source, 1, 0, 1000),
+                          kwargs={'gui': gui, 'ledger': ledger, 'live': True})
+    th.start()
+    try:
+        time.sleep(0.1)
+        for scanid in (7, 8):
+            source.emit('start', {'uid': f'u{scanid}', 'scan_id': scanid,
+                                  'scan': {'type': 'XRF_FLY'}})
+        time.sleep(0.1)
+        t0 = time.monotonic()
+        source.emit('stop', {'run_start': 'u7'})
+        source.emit('stop', {'run_start': 'u8'})
+        while ledger.get(8) is None and time.monotonic() - t0 < 5:
+            time.sleep(0.01)
+        # Scan 8 is finished while the live map of scan 7 is still running
+        assert time.monotonic() - t0 < 0.3
+        assert ledger.get(8) == ('converted', 'scan2D_8_xs_sum8ch.h5')
+        assert converted == []
+
+        while not converted and time.monotonic() - t0 < 5:
+            time.sleep(0.01)
+        # Scan 7 is only converted once its live map thread is done
+        assert converted == [(7, True)]
+    finally:
+        gui.isRunning = False
+        th.join()
+
+
+class _Pipeline(object):
+    # The first try of each scan comes out 'incomplete' a little later
+    def __init__(self):
+        self.results = queue.Queue()
+        self.submitted = []
+
+    def submit(self, scanid, stage=None):
+        status = 'incomplete' if scanid not in self.submitted else 'converted'
+        self.submitted.append(scanid)
+        threading.Timer(0.01, self.results.put, ((scanid, status),)).start()
+        return True
+
+    def in_flight(self):
+        return set()
+
+    def stage_names(self):
+        return ['fetch', 'hdf5']
+
+
+def test_listener_gets_results_drained_by_polling(monkeypatch):
+    monkeypatch.setattr(api, 'get_current_scanid', lambda: 0)
+    monkeypatch.setattr(api, 'STOP_RETRY_DELAY', 0.01)
+    monkeypatch.setattr(_Gui, 'DT', 0.05)
+    pipeline = _Pipeline()
+    source, gui = _Source(), _Gui()
+    # Polling on every idle wait, while the result of scan 9 is on its way
+    th = threading.Thread(target=api.xrf_listen, args=(source, 1, 0, 0),
+                          kwargs={'gui': gui, 'pipeline': pipeline})
+    th.start()
+    try:
+        time.sleep(0.1)
+        source.emit('start', {'uid': 'u9', 'scan_id': 9, 'scan': {'type': 'XRF_FLY'}})
+        source.emit('stop', {'run_start': 'u9'})
+        t0 = time.monotonic()
+        while len(pipeline.submitted) < 2 and time.monotonic() - t0 < 2:
+            time.sleep(0.01)
+        assert pipeline.submitted == [9, 9]
+    finally:
+        gui.isRunning = False
+        th.join()
+
+
+class _BusyPipeline(_Pipeline):
+    # Scan 9 is still in the pipeline from polling on the first try
+    def submit(self, scanid, stage=None):
+        if not self.submitted:
+            self.submitted.append(None)
+            return False
+        self.submitted.append(scanid)
+        self.results.put((scanid, 'converted'))
+        return True
+
+
+def test_listener_retries_scans_the_pipeline_rejects(monkeypatch):
+    monkeypatch.setattr(api, 'get_current_scanid', lambda: 0)
+    monkeypatch.setattr(api, 'STOP_RETRY_DELAY', 0.01)
+    pipeline = _BusyPipeline()
+    source, gui = _Source(), _Gui()
+    th = threading.Thread(target=api.xrf_listen, args=(source, 1, 0, 1000),
+                          kwargs={'gui': gui, 'pipeline': pipeline})
+    th.start()
+    try:
+        time.sleep(0.1)
+        source.emit('start', {'uid': 'u9', 'scan_id': 9, 'scan': {'type': 'XRF_FLY'}})
+        source.emit('stop', {'run_start': 'u9'})
+        t0 = time.monotonic()
+        while len(pipeline.submitted) < 2 and time.monotonic() - t0 < 2:
+            time.sleep(0.01)
+        assert pipeline.submitted == [None, 9]
+    finally:
+        gui.isRunning = False
+        th.join()
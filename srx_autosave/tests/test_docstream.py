@@ -0,0 +1,90 @@
+import json
+import queue
+import time
+
+from docstream import FileDocumentPublisher, FileDocumentSource, ScanStopWatcher
+
+
+def _run_docs(scanid, scan_type='XRF_FLY'):
+    start = {'uid': f'u{scanid}', 'scan_id': scanid, 'scan': {'type': scan_type}}
+    stop = {'uid': f's{scanid}', 'run_start': f'u{scanid}', 'exit_status': 'success'}
+    return [('start', start), ('stop', stop)]
+
+
+def test_publisher_writes_json_lines(tmp_path):
+    fname = tmp_path / 'docs.jsonl'
+    pub = FileDocumentPublisher(str(fname))
+    for name, doc in _run_docs(1):
+        pub(name, doc)
+    lines = fname.read_text().splitlines()
+    assert [json.loads(line)[0] for line in lines] == ['start', 'stop']
+    assert json.loads(lines[0])[1]['scan_id'] == 1
+
+
+def test_watcher_queues_stopped_xrf_scans():
+    scans, starts = queue.Queue(), queue.Queue()
+    watcher = ScanStopWatcher(scans, min_id=2, start_queue=starts)
+    for name, doc in _run_docs(1) + _run_docs(2) + _run_docs(3, 'XRF_STEP') + _run_docs(4):
+        watcher(name, doc)
+    # Stop document without its start document
+    watcher('stop', {'uid': 's5', 'run_start': 'u5'})
+    assert [scans.get_nowait()[0] for i in range(scans.qsize())] == [2, 4]
+    assert [starts.get_nowait()[0] for i in range(starts.qsize())] == [2, 4]
+
+
+def test_watcher_forwards_documents_of_started_scans():
+    scans, starts = queue.Queue(), queue.Queue()
+    watcher = ScanStopWatcher(scans, start_queue=starts)
+    (_, start), (_, stop) = _run_docs(2)
+    watcher('start', start)
+    watcher('descriptor', {'uid': 'd2', 'run_start': 'u2', 'name': 'stream0'})
+    watcher('event', {'descriptor': 'd2', 'seq_num': 1, 'data': {'fluor': 'a'}})
+    watcher('event_page', {'descriptor': 'd2', 'seq_num': [2, 3], 'uid': ['e2', 'e3'],
+                           'time': [0, 0], 'data': {'fluor': ['b', 'c']},
+                           'timestamps': {'fluor': [0, 0]}})
+    watcher('stop', stop)
+    watcher('event', {'descriptor': 'd2', 'seq_num': 4, 'data': {'fluor': 'd'}})
+
+    docs = watcher.run_docs[2]
+    received = [docs.get_nowait() for i in range(docs.qsize())]
+    assert [name for name, doc in received] == ['descriptor', 'event', 'event', 'event']
+    assert [doc['data']['fluor'] for name, doc in received[1:]] == ['a', 'b', 'c']
+
+
+def test_file_source_follows_the_file(tmp_path):
+    fname = str(tmp_path / 'docs.jsonl')
+    pub = FileDocumentPublisher(fname)
+    for name, doc in _run_docs(1):
+        pub(name, doc)
+
+    scans = queue.Queue()
+    watcher = ScanStopWatcher(scans)
+    source = FileDocumentSource(fname, from_start=True)
+    source.subscribe(watcher)
+    source.start()
+    try:
+        assert scans.get(timeout=5)[0] == 1
+        for name, doc in _run_docs(2):
+            pub(name, doc)
+        assert scans.get(timeout=5)[0] == 2
+        # A line is only read once it is complete
+        start, stop = _run_docs(3)
+        pub(*start)
+        line = json.dumps(stop)
+        with open(fname, 'a') as f:
+            f.write(line[:10])
+            f.flush()
+            time.sleep(0.05)
+            assert scans.empty()
+            f.write(line[10:] + '\n')
+        assert scans.get(timeout=5)[0] == 3
+        # No documents after unsubscribing
+        seen = queue.Queue()
+        source.subscribe(lambda name, doc: seen.put(name))
+        source.unsubscribe(watcher)
+        for name, doc in _run_docs(4):
+            pub(name, doc)
+        assert [seen.get(timeout=5), seen.get(timeout=5)] == ['start', 'stop']
+    finally:
+        source.stop()
+    assert scans.empty()
@@ -0,0 +1,38 @@
+import h5py
+import numpy as np
+
+from hdf_writer import create_map_dataset, dataset_options, write_chunks, write_map
+
+
+def test_write_chunks_matches_data(tmp_path):
+    data = np.random.default_rng(0).poisson(5, (13, 17, 300)).astype(np.uint64)
+    fname = str(tmp_path / "chunks.h5")
+    with h5py.File(fname, 'w') as f:
+        for profile, layout in [('default', None), ('gzip-1', None), ('gzip-1', 'roi')]:
+            kw = dataset_options(profile, data.shape, data.dtype, spectra=True, layout=layout)
+            ds = f.create_dataset(f'{profile}_{layout}', shape=data.shape, dtype=data.dtype, **kw)
+            # Blocks that do not line up with the chunks
+            write_chunks(ds, data[:5], num_threads=3)
+            write_chunks(ds, data[5:], offset=(5, 0, 0), num_threads=3)
+
+    with h5py.File(fname, 'r') as f:
+        for name in f:
+            assert np.array_equal(f[name][()], data)
+
+
+def test_write_map_snake_transpose(tmp_path, monkeypatch):
+    import hdf_writer
+    data = np.arange(7 * 5 * 3).reshape(7, 5, 3)
+    expected = data.copy()
+    expected[1::2] = expected[1::2, ::-1]
+    expected = np.swapaxes(expected, 0, 1)
+
+    # Blocks of 2 rows, so blocks start on odd rows too
+    monkeypatch.setattr(hdf_writer, 'WRITE_BLOCK_BYTES', 2 * data[:1].nbytes)
+    fname = str(tmp_path / "map.h5")
+    with h5py.File(fname, 'w') as f:
+        ds = create_map_dataset(f, 'counts', data.shape, data.dtype, transpose=True,
+                                write_profile='uncompressed')
+        write_map(ds, data[:3], snake=True, transpose=True)
+        write_map(ds, data[3:], i0=3, snake=True, transpose=True)
+        assert np.array_equal(ds[()], expected)
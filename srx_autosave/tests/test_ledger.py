@@ -0,0 +1,63 @@
+import time
+
+from ledger import ScanLedger, ScanCursor
+
+
+def test_ledger_persists_states(tmp_path):
+    fname = str(tmp_path / "ledger.db")
+    ledger = ScanLedger(fname)
+    ledger.record(100, 'converted', 'scan2D_100_xs_sum8ch.h5')
+    ledger.record(101, 'incomplete')
+    ledger.record(102, 'non-xrf')
+    ledger.record(103, 'failed')
+    ledger.close()
+
+    ledger = ScanLedger(fname)
+    assert ledger.get(100) == ('converted', 'scan2D_100_xs_sum8ch.h5')
+    assert ledger.get(104) is None
+    assert not ledger.is_finished(101)
+    # Failed scans are tried again
+    assert not ledger.is_finished(103)
+    assert ledger.finished_ids(100, 110) == {100, 102}
+
+    ledger.forget(103)
+    assert ledger.get(103) is None
+
+
+def test_failed_scans_finish_after_max_attempts(tmp_path):
+    ledger = ScanLedger(str(tmp_path / "ledger.db"), max_attempts=2, retry_delay=10)
+    t0 = time.time()
+    ledger.record(100, 'failed')
+    assert 10 <= ledger.next_try(100) - t0 < 11
+    assert not ledger.is_finished(100)
+    # An incomplete lookup in between keeps the count
+    ledger.record(100, 'incomplete')
+    assert ledger.next_try(100) is None
+    ledger.record(100, 'failed')
+    assert 20 <= ledger.next_try(100) - t0 < 21
+    assert ledger.is_finished(100)
+    assert ledger.finished_ids(100, 110) == {100}
+
+
+def test_cursor_only_returns_unfinished_scans(tmp_path):
+    ledger = ScanLedger(str(tmp_path / "ledger.db"))
+    ledger.record(100, 'converted')
+    ledger.record(101, 'non-xrf')
+    ledger.record(103, 'converted')
+    ledger.record(104, 'incomplete')
+
+    cursor = ScanCursor(100, ledger=ledger)
+    assert cursor.low == 102
+    cursor.update(106)
+    assert cursor.pending() == [102, 104, 105, 106]
+
+    cursor.mark_finished(102)
+    assert cursor.low == 104
+    cursor.mark_finished(104)
+    assert cursor.pending() == [105, 106]
+
+
+def test_cursor_limit(tmp_path):
+    cursor = ScanCursor(10, N=3)
+    cursor.update(100)
+    assert cursor.pending() == [10, 11, 12]
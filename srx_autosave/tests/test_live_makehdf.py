@@ -0,0 +1,119 @@
+import os
+import queue
+import threading
+
+import h5py
+import numpy as np
+
+import live_makehdf
+from live_makehdf import LiveXRFMap
+
+
+class _Header(object):
+    def __init__(self, rows, stop=None):
+        c = rows.shape[1]
+        self.start = {'scan_id': 7, 'uid': 'u7',
+                      'scan': {'type': 'XRF_FLY', 'detectors': ['xs'], 'shape': [c, len(rows)],
+                               'snake': 1, 'fast_axis': {'motor_name': 'nano_stage_sx'},
+                               'slow_axis': {'motor_name': 'nano_stage_sy'}}}
+        self.stop = stop or {}
+        self.events_read = 0
+        self.all_events = [_event(n, c) for n in range(len(rows))]
+
+    def events(self, stream_name='primary', fields=None, fill=False):
+        self.events_read += 1
+        if stream_name == 'stream0':
+            return iter([dict(ev, data=dict(ev['data'])) for ev in self.all_events])
+        return iter([])
+
+
+class _Broker(object):
+    def __init__(self, h, rows):
+        self.h = h
+        self.rows = rows
+
+    def __getitem__(self, key):
+        return self.h
+
+    def fill_event(self, ev, inplace=True):
+        ev['data']['fluor'] = self.rows[int(ev['data']['fluor'])]
+
+
+def _event(n, c):
+    data = {'fluor': str(n), 'enc1': np.arange(c) + 0.5, 'enc2': np.full(c, n * 1.0),
+            'i0': np.arange(c) + 10.0 * n}
+    return {'descriptor': 'd0', 'seq_num': n + 1, 'data': data}
+
+
+def test_live_map_reads_new_documents(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rows = np.random.default_rng(0).integers(0, 100, (4, 5, 2, 8)).astype(np.uint32)
+    h = _Header(rows)
+    monkeypatch.setattr(live_makehdf, 'db', _Broker(h, rows))
+    monkeypatch.setattr(live_makehdf, '_extract_metadata_from_header', lambda h: {})
+
+    docs = queue.Queue()
+    live = LiveXRFMap(7, docs=docs)
+    docs.put(('descriptor', {'uid': 'd0', 'name': 'stream0'}))
+    # Rows that arrive out of order are only appended once the gap is filled
+    for n in (0, 2):
+        docs.put(('event', h.all_events[n]))
+    assert live.update() == 1
+    docs.put(('event', h.all_events[1]))
+    assert live.update() == 2
+    assert h.events_read == 0
+
+    # The last row is only in the databroker when the scan stops
+    h.stop = {'time': 1, 'num_events': {'stream0': 4}}
+    fn = live.finalize()
+    assert fn == 'scan2D_7_xs_sum2ch.h5'
+    assert live.rows_written == 4
+
+    expected = np.sum(rows, axis=2)
+    expected[1::2] = expected[1::2, ::-1]
+    with h5py.File(fn, 'r') as f:
+        assert np.array_equal(f['xrfmap/detsum/counts'][()], expected)
+        assert f['xrfmap/scalers/val'].shape == (4, 5, 1)
+        assert np.array_equal(f['xrfmap/positions/pos'][1, :, 0], np.arange(4))
+
+
+class _LateBroker(_Broker):
+    # The start document arrives before the databroker has the scan
+    def __init__(self, h, rows, misses):
+        super().__init__(h, rows)
+        self.misses = misses
+
+    def __getitem__(self, key):
+        if self.misses > 0:
+            self.misses -= 1
+            raise KeyError(key)
+        return self.h
+
+
+def test_live_map_waits_for_header(monkeypatch):
+    rows = np.zeros((2, 3, 2, 8), dtype=np.uint32)
+    broker = _LateBroker(_Header(rows), rows, misses=2)
+    monkeypatch.setattr(live_makehdf, 'db', broker)
+    monkeypatch.setattr(live_makehdf, 'HEADER_RETRY_DELAY', 0.01)
+    assert LiveXRFMap(7).scanid == 7
+    assert broker.misses == 0
+
+
+def test_stopped_live_map_keeps_converted_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rows = np.random.default_rng(0).integers(0, 100, (2, 5, 2, 8)).astype(np.uint32)
+    h = _Header(rows, stop={'time': 1, 'num_events': {'stream0': 2}})
+    monkeypatch.setattr(live_makehdf, 'db', _Broker(h, rows))
+    monkeypatch.setattr(live_makehdf, '_extract_metadata_from_header', lambda h: {})
+
+    live = LiveXRFMap(7)
+    live.update()
+    # The scan was converted the usual way while the map was being finished
+    with open(live.fn, 'w') as f:
+        f.write('converted')
+    stop = threading.Event()
+    stop.set()
+    assert live.finalize(stop_event=stop) is None
+    assert os.listdir(tmp_path) == [live.fn]
+    with open(live.fn) as f:
+        assert f.read() == 'converted'
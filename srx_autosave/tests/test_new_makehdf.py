@@ -0,0 +1,71 @@
+import h5py
+import numpy as np
+
+import new_makehdf as nm
+
+
+class _Header(object):
+    # y fly scan with snake, (rows, columns, channels, bins) of detector data
+    def __init__(self, fluor):
+        r, c = fluor.shape[:2]
+        self.fluor = fluor
+        self.start = {'scan_id': 5, 'uid': 'u5', 'md_version': 1, 'time': 0,
+                      'scan': {'type': 'XRF_FLY', 'detectors': ['xs'], 'shape': [c, r],
+                               'snake': 1, 'energy': 12.0,
+                               'fast_axis': {'motor_name': 'nano_stage_sy'},
+                               'slow_axis': {'motor_name': 'nano_stage_sx'}}}
+        self.stop = {'time': 1, 'exit_status': 'success', 'num_events': {'stream0': r}}
+        self.descriptors = [{'name': 'stream0',
+                             'data_keys': {k: {} for k in ['fluor', 'enc1', 'enc2', 'i0', 'im']}}]
+
+    def _row(self, key, n):
+        c = self.fluor.shape[1]
+        if key == 'fluor':
+            return self.fluor[n].copy()
+        return np.arange(c) * 0.5 + 100 * n + len(key)
+
+    def data(self, key, stream_name='primary', fill=True):
+        for n in range(len(self.fluor)):
+            yield self._row(key, n)
+
+    def events(self, stream_name='primary', fields=None, fill=False):
+        for n in range(len(self.fluor)):
+            yield {'seq_num': n + 1, 'data': {k: self._row(k, n) for k in fields}}
+
+
+class _Broker(object):
+    def __init__(self, h):
+        self.h = h
+
+    def __getitem__(self, scanid):
+        return self.h
+
+
+def _datasets(fname):
+    out = {}
+    with h5py.File(fname, 'r') as f:
+        f.visititems(lambda name, obj: out.update({name: obj[()]})
+                     if isinstance(obj, h5py.Dataset) else None)
+    return out
+
+
+def test_row_blocks_match_in_memory(tmp_path, monkeypatch):
+    fluor = np.random.default_rng(0).integers(0, 1000, (5, 6, 3, 16)).astype(np.uint32)
+    monkeypatch.setattr(nm, 'db', _Broker(_Header(fluor)))
+
+    files = {}
+    for name, max_memory in [('memory', None), ('blocks', 1e-6)]:
+        (tmp_path / name).mkdir()
+        monkeypatch.chdir(tmp_path / name)
+        assert nm.new_makehdf(5, create_each_det=True, max_memory=max_memory) == ['scan2D_5_xs_3ch.h5']
+        files[name] = _datasets('scan2D_5_xs_3ch.h5')
+
+    assert sorted(files['memory']) == sorted(files['blocks'])
+    for name, data in files['memory'].items():
+        other = files['blocks'][name]
+        assert data.dtype == other.dtype, name
+        assert np.array_equal(data, other), name
+    # Snake rows flipped, then transposed for the y scan
+    expected = np.sum(fluor, axis=2)
+    expected[1::2] = expected[1::2, ::-1]
+    assert np.array_equal(files['blocks']['xrfmap/detsum/counts'], np.swapaxes(expected, 0, 1))
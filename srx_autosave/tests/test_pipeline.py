@@ -0,0 +1,50 @@
+import threading
+import time
+
+from pipeline import Stage, ScanPipeline
+
+
+def _results(pipeline, n):
+    return dict(pipeline.results.get(timeout=5) for i in range(n))
+
+
+def test_stages_overlap():
+    # Scan 1 can only leave the second stage once scan 2 is in the first one
+    second_started = threading.Event()
+
+    def first(scanid):
+        if scanid == 2:
+            second_started.set()
+
+    def second(scanid):
+        if scanid == 1 and not second_started.wait(timeout=5):
+            return 'serial'
+
+    p = ScanPipeline([Stage('first', first), Stage('second', second)])
+    p.start()
+    try:
+        p.submit(1)
+        time.sleep(0.05)
+        p.submit(2)
+        assert _results(p, 2) == {1: 'converted', 2: 'converted'}
+    finally:
+        p.stop()
+
+
+def test_stop_drains_all_stages():
+    def slow(scanid):
+        time.sleep(0.05)
+
+    seen = []
+    p = ScanPipeline([Stage('slow', slow, 2), Stage('last', seen.append)])
+    p.start()
+    for scanid in range(6):
+        assert p.submit(scanid)
+    assert not p.submit(0)
+    # The scans still in the first stage go through the last one
+    p.stop()
+    assert sorted(seen) == list(range(6))
+    assert _results(p, 6) == {scanid: 'converted' for scanid in range(6)}
+    assert p.in_flight() == set()
+    # Nothing is taken once the pipeline is stopped
+    assert not p.submit(7)
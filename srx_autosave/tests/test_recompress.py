@@ -0,0 +1,73 @@
+import os
+
+import h5py
+import numpy as np
+
+import recompress
+from recompress import recompress_file
+from vds import XSP3_DATA_PATH, write_virtual_det
+
+
+def _write_map(fname, res_files):
+    rng = np.random.default_rng(0)
+    with h5py.File(fname, 'w') as f:
+        f.attrs['scan_id'] = 5
+        f['xrfmap/detsum/counts'] = rng.integers(0, 100, (4, 6, 32)).astype(np.uint32)
+        f['xrfmap/positions/pos'] = rng.random((2, 4, 6))
+        f['xrfmap/positions/name'] = [b'x_pos', b'y_pos']
+        f['xrfmap/scalers/val'] = rng.random((4, 6, 2))
+        f['xrfmap/scalers/val'].attrs['units'] = 'counts'
+        write_virtual_det(f['xrfmap'], res_files, 6)
+
+
+def _read_all(fname):
+    out = {}
+    with h5py.File(fname, 'r') as f:
+        f.visititems(lambda name, obj: out.update({name: (obj[()], obj.is_virtual)})
+                     if isinstance(obj, h5py.Dataset) else None)
+    return out
+
+
+def test_recompress_keeps_data(tmp_path):
+    res_files = []
+    for i in range(4):
+        res_files.append(str(tmp_path / f'row{i}.h5'))
+        with h5py.File(res_files[-1], 'w') as f:
+            f[XSP3_DATA_PATH] = np.full((6, 2, 32), i, dtype=np.uint32)
+    fname = str(tmp_path / 'scan2D_5_xs_2ch.h5')
+    _write_map(fname, res_files)
+    before = _read_all(fname)
+
+    assert recompress_file(fname, profile='gzip-4')
+    after = _read_all(fname)
+    assert sorted(before) == sorted(after)
+    for name, (data, virtual) in before.items():
+        assert np.array_equal(data, after[name][0]), name
+        assert virtual == after[name][1], name
+    assert after['xrfmap/det2/counts'][1]
+    assert np.array_equal(after['xrfmap/det2/counts'][0][:, 0, 0], np.arange(4))
+    with h5py.File(fname, 'r') as f:
+        assert f['xrfmap/detsum/counts'].compression == 'gzip'
+        assert f['xrfmap/scalers/val'].attrs['units'] == 'counts'
+    # No temporary file left
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(fname)]
+                                                  + [f'row{i}.h5' for i in range(4)])
+
+
+def test_recompress_keeps_modified_file(tmp_path, monkeypatch):
+    fname = str(tmp_path / 'scan2D_5_xs_sum2ch.h5')
+    with h5py.File(fname, 'w') as f:
+        f['xrfmap/detsum/counts'] = np.ones((4, 6, 32), dtype=np.uint32)
+    copy = recompress._copy_dataset
+
+    def _copy_and_touch(*args):
+        # The file is written to while it is being copied
+        copy(*args)
+        st = os.stat(fname)
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    monkeypatch.setattr(recompress, '_copy_dataset', _copy_and_touch)
+    assert not recompress_file(fname, profile='gzip-4')
+    assert os.listdir(tmp_path) == [os.path.basename(fname)]
+    with h5py.File(fname, 'r') as f:
+        assert f['xrfmap/detsum/counts'].compression is None
@@ -0,0 +1,86 @@
+import h5py
+import numpy as np
+
+from resource_reader import ResourceReader
+from scan_reader import read_channels, read_data
+from vds import XSP3_DATA_PATH
+
+
+class _Header(object):
+    # Events holding only datum ids, like h.events(fill=False)
+    def __init__(self, datums):
+        self.datums = datums
+
+    def events(self, stream_name='primary', fields=None, fill=False):
+        for n, ev in enumerate(self.datums):
+            yield {'seq_num': n + 1, 'data': {k: ev[k] for k in fields}}
+
+
+class _Registry(object):
+    def __init__(self, resources, datums):
+        # resources: {uid: resource}, datums: {datum_id: (resource uid, kwargs)}
+        self.resources = resources
+        self.datums = datums
+        self.queries = 0
+
+    def resource_given_datum_id(self, datum_id):
+        self.queries += 1
+        return self.resources[self.datums[datum_id][0]]
+
+    def datum_gen_given_resource(self, res):
+        self.queries += 1
+        for datum_id, (uid, kwargs) in self.datums.items():
+            if uid == res['uid']:
+                yield {'datum_id': datum_id, 'datum_kwargs': kwargs}
+
+
+def test_fly_rows_read_into_buffer(tmp_path):
+    # One resource file per row with (points, channels, bins)
+    rows = np.random.default_rng(0).integers(0, 100, (3, 5, 2, 8)).astype(np.uint32)
+    resources, datums, events = {}, {}, []
+    for i, row in enumerate(rows):
+        with h5py.File(tmp_path / f'row{i}.h5', 'w') as f:
+            f[XSP3_DATA_PATH] = row
+        resources[f'r{i}'] = {'uid': f'r{i}', 'spec': 'XSP3_FLY', 'root': str(tmp_path),
+                              'resource_path': f'row{i}.h5'}
+        datums[f'd{i}'] = (f'r{i}', {})
+        events.append({'fluor': f'd{i}'})
+    res = ResourceReader(_Header(events), _Registry(resources, datums))
+
+    assert np.array_equal(read_data(None, 'fluor', 'stream0', resources=res), rows)
+    out = np.zeros(rows.shape, dtype=np.uint32)
+    assert read_data(None, 'fluor', 'stream0', out=out, resources=res) is out
+    assert np.array_equal(out, rows)
+    assert np.array_equal(res.read_data('fluor', sum_axis=1), np.sum(rows, axis=2))
+    assert res.event_shapes['fluor'] == (5, 2, 8)
+
+
+def test_step_channels_one_resource(tmp_path):
+    # 6 points of 3 channels in one file, one datum per point and channel
+    spectra = np.random.default_rng(1).integers(0, 100, (6, 3, 8)).astype(np.uint32)
+    with h5py.File(tmp_path / 'step.h5', 'w') as f:
+        f.create_dataset(XSP3_DATA_PATH, data=spectra, chunks=(1, 3, 8))
+    keys = [f'xs_channel{i+1}' for i in range(3)]
+    resources = {'r': {'uid': 'r', 'spec': 'XSP3_STEP', 'root': '',
+                       'resource_path': str(tmp_path / 'step.h5')}}
+    datums = {f'{k}/{p}': ('r', {'frame': p, 'channel': i + 1})
+              for i, k in enumerate(keys) for p in range(6)}
+    events = [{k: f'{k}/{p}' for k in keys} for p in range(6)]
+    reg = _Registry(resources, datums)
+    res = ResourceReader(_Header(events), reg)
+
+    data = read_channels(None, keys, resources=res)
+    assert np.array_equal(data, np.moveaxis(spectra, 1, 0))
+    # The resource and its datums are only looked up once
+    assert reg.queries == 2
+    total = read_channels(None, keys, dtype=np.uint32, sum_channels=True, resources=res)
+    assert total.dtype == np.uint32
+    assert np.array_equal(total, np.sum(spectra, axis=1))
+    assert np.array_equal(res.read_data('xs_channel2'), spectra[:, 1])
+
+
+def test_unknown_spec_returns_none():
+    resources = {'r': {'uid': 'r', 'spec': 'AD_TIFF', 'root': '', 'resource_path': 'x'}}
+    res = ResourceReader(_Header([{'fluor': 'd'}]), _Registry(resources, {'d': ('r', {})}))
+    assert res.read_data('fluor') is None
+    assert res.read_channels(['fluor']) is None
@@ -0,0 +1,90 @@
+import h5py
+import numpy as np
+
+from roi import (RoiAccumulator, RoiTable, energy_to_bin, iter_row_blocks, load_roi_table,
+                 open_tuned, read_roi_maps, roi_maps, store_maps, take_maps)
+
+
+def test_roi_maps_match_slices(tmp_path):
+    data = np.random.default_rng(0).integers(0, 100, (7, 5, 64)).astype(np.uint32)
+    # Overlapping, nested, empty and clipped windows
+    rois = {'a': [10, 20], 'b': [15, 30], 'c': [12, 14], 'd': [40, 40], 'e': [60, 80]}
+    expected = {x: np.sum(data[:, :, max(lo, 0):hi], axis=2) for x, (lo, hi) in rois.items()}
+
+    with h5py.File(tmp_path / 'detsum.h5', 'w') as f:
+        ds = f.create_dataset('counts', data=data, chunks=(2, 5, 64), compression='gzip')
+        # Blocks of 2 rows, the last one partial
+        maps = roi_maps(ds, rois, block_bytes=2 * 5 * 70 * 4)
+    for x in rois:
+        assert maps[x].dtype == np.uint64
+        assert np.array_equal(maps[x], expected[x])
+
+    # float32 spectra, windows at the end of long spectra with large prefix sums
+    data = np.random.default_rng(1).integers(0, 20000, (3, 4, 4096)).astype(np.float32)
+    rois = {'low': [10, 20], 'high': [4000, 4003]}
+    maps = roi_maps(data, rois)
+    for x, (lo, hi) in rois.items():
+        expected = np.sum(data[:, :, lo:hi].astype(np.float64), axis=2).astype(np.float32)
+        assert maps[x].dtype == np.float32
+        assert np.array_equal(maps[x], expected)
+
+
+def test_accumulator_handoff():
+    # Rows as measured, maps in the orientation of the file
+    data = np.random.default_rng(1).integers(0, 100, (4, 3, 32)).astype(np.uint32)
+    rois = {'a': [1, 9], 'b': [20, 31]}
+    acc = RoiAccumulator(rois, 4, 3, 32, data.dtype)
+    acc.add(0, data[:3])
+    acc.add(3, data[3:])
+    maps = acc.maps(snake=True, transpose=True)
+
+    expected = data.copy()
+    expected[1::2] = expected[1::2, ::-1]
+    expected = np.swapaxes(expected, 0, 1)
+    assert np.array_equal(maps['b'], np.sum(expected[:, :, 20:31], axis=2))
+    assert np.array_equal(roi_maps(data, rois, snake=True, transpose=True)['a'],
+                          np.sum(expected[:, :, 1:9], axis=2))
+
+    store_maps(7, maps, np.ones((3, 4)))
+    assert take_maps(7, {'c': [0, 1]}) == (None, None)
+    store_maps(7, maps, np.ones((3, 4)))
+    stored, i0 = take_maps(7, rois)
+    assert stored is maps and i0.shape == (3, 4)
+    assert take_maps(7, rois) == (None, None)
+
+
+def test_roi_table_bins(tmp_path):
+    fname = tmp_path / 'rois.json'
+    fname.write_text('{"calibration": {"e_offset": 0.1, "e_linear": 0.01},'
+                     ' "rois": {"Cu_k": [7.8, 8.2], "Pb_l": [10.4, 10.7]}}')
+    table = load_roi_table(str(fname))
+    assert load_roi_table(str(fname)) is table
+    assert table.bins() == {'Cu_k': [770, 810], 'Pb_l': [1030, 1060]}
+    # Lines above the incident energy are left out, the result is cached
+    assert table.bins(9.0) == {'Cu_k': [770, 810]}
+    assert table.bins(9.0004) == table.bins(9.0)
+
+    quad = RoiTable({'Cu_k': [7.8, 8.2]}, calibration=(0.0, 0.01, 1e-6))
+    lo, hi = quad.bins()['Cu_k']
+    assert abs(0.01 * lo + 1e-6 * lo**2 - 7.8) < 0.01
+    assert abs(energy_to_bin(8.2, quad.calibration) - hi) <= 0.5
+
+
+def test_read_roi_maps_chunk_rows(tmp_path):
+    data = np.random.default_rng(2).integers(0, 100, (10, 6, 96)).astype(np.uint32)
+    fname = str(tmp_path / 'scan2D_1_xs_sum4ch.h5')
+    with h5py.File(fname, 'w') as f:
+        f.create_dataset('xrfmap/detsum/counts', data=data, chunks=(3, 6, 32), compression='gzip')
+        f['xrfmap/scalers/val'] = np.arange(10 * 6 * 4.0).reshape(10, 6, 4)
+
+    with h5py.File(fname, 'r') as f:
+        ds = open_tuned(f, 'xrfmap/detsum/counts', bins=(40, 70), block_bytes=2**20)
+        assert ds.id.get_access_plist().get_chunk_cache()[1] == 2**20
+        # Blocks of whole chunk rows, even if smaller blocks were asked for
+        starts = [i for i, block in iter_row_blocks(ds, (40, 70), block_bytes=1)]
+        assert starts == [0, 3, 6, 9]
+
+    rois = {'a': [40, 50], 'b': [45, 70]}
+    maps, i0 = read_roi_maps(fname, rois, block_bytes=1)
+    assert np.array_equal(maps['b'], np.sum(data[:, :, 45:70], axis=2))
+    assert np.array_equal(i0, np.arange(10 * 6 * 4.0).reshape(10, 6, 4)[:, :, 0])
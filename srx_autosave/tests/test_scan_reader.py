@@ -0,0 +1,114 @@
+import threading
+import numpy as np
+import pytest
+
+from scan_reader import (cast_checked, fetch_concurrent, fill_rows, policy_dtype, read_channels,
+                         read_columns, reshape_to_map, stream_keys)
+
+
+def test_fill_rows_truncated():
+    rows = (np.full((3, 4), i) for i in range(5))
+    out = fill_rows(rows, 8)
+    assert out.shape == (5, 3, 4)
+    assert np.array_equal(out[:, 0, 0], np.arange(5))
+
+
+class _StepHeader(object):
+    # Events of a step scan with one spectrum per channel and point
+    def __init__(self, spectra):
+        self.spectra = spectra
+        self.stop = {'num_events': {'primary': spectra.shape[1]}}
+        self.passes = 0
+        self.descriptors = [{'name': 'primary',
+                             'data_keys': {f'xs_channel{i+1}': {} for i in range(len(spectra))}},
+                            {'name': 'baseline', 'data_keys': {'energy': {}}}]
+
+    def events(self, stream_name='primary', fields=None, fill=False):
+        self.passes += 1
+        self.fields = fields
+        for n in range(self.spectra.shape[1]):
+            yield {'data': {k: self.spectra[int(k[10:]) - 1, n] for k in fields}}
+
+
+def test_read_channels_single_pass():
+    spectra = np.random.default_rng(0).integers(0, 100, (3, 10, 32)).astype(np.uint32)
+    keys = [f'xs_channel{i+1}' for i in range(3)]
+
+    h = _StepHeader(spectra)
+    out = read_channels(h, keys)
+    assert h.passes == 1
+    assert out.dtype == np.uint32
+    assert np.array_equal(out, spectra)
+
+    out = read_channels(h, keys, sum_channels=True)
+    assert np.array_equal(out, spectra.sum(axis=0))
+    assert out.dtype == spectra.sum(axis=0).dtype
+
+
+def test_read_columns_projected():
+    spectra = np.arange(2 * 5 * 4).reshape(2, 5, 4)
+    h = _StepHeader(spectra)
+    assert stream_keys(h) == ['xs_channel1', 'xs_channel2']
+    cols = read_columns(h, ['xs_channel2'])
+    assert h.fields == ['xs_channel2']
+    assert list(cols) == ['xs_channel2']
+    assert np.array_equal(cols['xs_channel2'], spectra[1])
+    assert read_columns(h, []) == {}
+
+
+def test_reshape_to_map_truncated_step_scan():
+    # 4x3 step scan aborted after 7 points, 2 channels of 16 bins
+    r, c = 4, 3
+    spectra = np.random.default_rng(0).integers(0, 100, (2, 7, 16))
+    out, mask = reshape_to_map(spectra, c, axis=1)
+    assert out.shape == (2, 3, c, 16)
+    assert mask.sum() == 7 and not mask[2, 1:].any()
+    assert np.array_equal(out[:, mask], spectra)
+    assert not out[:, ~mask].any()
+
+    # Scalers, (points, scalers), padded to the full map
+    sclr = np.arange(14.0).reshape(7, 2)
+    out, mask = reshape_to_map(sclr, c, num_rows=r, fill_value=np.nan)
+    assert out.shape == (r, c, 2)
+    assert np.array_equal(out[mask], sclr)
+    assert np.isnan(out[~mask]).all()
+
+
+def test_reshape_to_map_complete_scan():
+    pos = np.arange(12.0)
+    out, mask = reshape_to_map(pos, 3)
+    assert mask.all()
+    assert np.array_equal(out, pos.reshape(4, 3))
+
+
+def test_dtype_policy_overflow():
+    assert policy_dtype('native') is None
+    with pytest.raises(ValueError):
+        policy_dtype('int8')
+
+    # 8 channels of uint32 counts, the sum no longer fits in uint32
+    rows = [np.full((8, 16), 2**30, dtype=np.uint32)] * 3
+    out = fill_rows(rows, 3, sum_axis=0)
+    assert out.dtype == np.uint64
+    with pytest.raises(OverflowError):
+        fill_rows(rows, 3, dtype=policy_dtype('uint32'), sum_axis=0)
+    assert cast_checked(out, np.float32).dtype == np.float32
+
+
+def test_fetch_concurrent():
+    # All three reads must be running at the same time to pass the barrier
+    barrier = threading.Barrier(3, timeout=5)
+
+    def _read(value):
+        barrier.wait()
+        return value
+
+    tasks = {name: (lambda v=i: _read(v)) for i, name in enumerate(['cols', 'xs', 'xs2'])}
+    assert fetch_concurrent(tasks, num_threads=3) == {'cols': 0, 'xs': 1, 'xs2': 2}
+    assert fetch_concurrent({'a': lambda: 1}, num_threads=1) == {'a': 1}
+
+    def _fail():
+        raise KeyError('fluor')
+
+    with pytest.raises(KeyError):
+        fetch_concurrent({'cols': lambda: 0, 'xs': _fail}, num_threads=2)
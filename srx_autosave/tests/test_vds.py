@@ -0,0 +1,52 @@
+import h5py
+import numpy as np
+
+from vds import XSP3_DATA_PATH, write_virtual_det
+
+
+def test_virtual_det_matches_resource_files(tmp_path):
+    # 4 rows of 5 points, 2 channels of 8 bins, one resource file per row
+    rows = np.random.default_rng(0).integers(0, 100, (4, 5, 2, 8)).astype(np.uint32)
+    files = []
+    for i, row in enumerate(rows):
+        fn = str(tmp_path / f"xs_row{i}.h5")
+        with h5py.File(fn, 'w') as f:
+            f[XSP3_DATA_PATH] = row
+        files.append(fn)
+
+    expected = rows.copy()
+    expected[1::2] = expected[1::2, ::-1]
+    expected = np.swapaxes(expected, 0, 1)
+
+    fname = str(tmp_path / "scan2D_1_xs_2ch.h5")
+    with h5py.File(fname, 'w') as f:
+        N = write_virtual_det(f.create_group('xrfmap'), files, 5, snake=True, transpose=True)
+    assert N == 2
+
+    with h5py.File(fname, 'r') as f:
+        for ch in range(N):
+            ds = f[f'xrfmap/det{ch+1}/counts']
+            assert ds.is_virtual
+            assert np.array_equal(ds[()], expected[:, :, ch, :])
+
+
+def test_virtual_det_short_last_row(tmp_path):
+    # The last file of an aborted scan only has 3 of the 5 points
+    rows = np.random.default_rng(1).integers(1, 100, (4, 5, 2, 8)).astype(np.uint32)
+    files = []
+    for i, row in enumerate(rows):
+        fn = str(tmp_path / f"xs_row{i}.h5")
+        with h5py.File(fn, 'w') as f:
+            f[XSP3_DATA_PATH] = row[:3] if i == 3 else row
+        files.append(fn)
+    rows[3, 3:] = 0
+    expected = rows.copy()
+    expected[1::2] = expected[1::2, ::-1]
+
+    fname = str(tmp_path / "scan2D_2_xs_2ch.h5")
+    with h5py.File(fname, 'w') as f:
+        write_virtual_det(f.create_group('xrfmap'), files, 5, snake=True)
+
+    with h5py.File(fname, 'r') as f:
+        for ch in range(2):
+            assert np.array_equal(f[f'xrfmap/det{ch+1}/counts'][()], expected[:, :, ch, :])
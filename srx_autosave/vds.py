@@ -0,0 +1,143 @@
+"""
+SRX Autosave virtual detector datasets
+
+The spectra of a fly scan are already on disk, one Xspress3 HDF5
+resource file per row. Instead of reading them through the databroker
+handlers and writing a compressed copy of every channel, the
+xrfmap/det*/counts datasets can be HDF5 virtual datasets that map each
+row of the map onto the raw resource file. Creating them is nearly
+instant and uses almost no disk, and h5py/pyxrf read them like normal
+datasets as long as the resource files stay where they are.
+
+Andy Kiss
+"""
+import os
+import h5py
+import numpy as np
+
+
+# Spectra in the Xspress3 resource files, (frames, channels, bins)
+XSP3_DATA_PATH = 'entry/instrument/detector/data'
+
+
+def fly_row_files(h, key, reg, stream_name='stream0'):
+    """
+    Return the resource file of each row of a fly scan
+
+    Parameters
+    ----------
+    h : Header
+        Scan header
+    key : string
+        Detector data key, e.g. 'fluor'
+    reg : Registry
+        Resource registry of the databroker, db.reg
+    stream_name : string
+        Event stream with one event per row
+
+    Returns
+    -------
+    files : list
+        Absolute path of the resource file of each row
+    """
+
+    files = []
+    for ev in h.events(stream_name=stream_name, fields=[key], fill=False):
+        res = reg.resource_given_datum_id(ev['data'][key])
+        fn = os.path.join(res.get('root', '') or '', res['resource_path'])
+        files.append(os.path.abspath(fn))
+    return files
+
+
+def _source_info(fn, data_path):
+    """
+    Return the shape and type of the spectra in a resource file, or None
+    """
+    try:
+        with h5py.File(fn, 'r') as f:
+            return f[data_path].shape, f[data_path].dtype
+    except (OSError, KeyError) as ex:
+        print(f'Cannot read {fn} ({ex}), its row is left empty.')
+        return None
+
+
+def _select_row(vspace, row, col, num_cols, num_bins, transpose):
+    if transpose:
+        vspace.select_hyperslab((col, row, 0), (num_cols, 1, num_bins))
+    else:
+        vspace.select_hyperslab((row, col, 0), (1, num_cols, num_bins))
+
+
+def write_virtual_det(grp, files, num_cols, snake=False, transpose=False,
+                      data_path=XSP3_DATA_PATH):
+    """
+    Create det{i}/counts virtual datasets pointing at the resource files
+
+    Each row is mapped onto the frames its file actually has. Points
+    missing from short files, e.g. the last row of an aborted scan, and
+    rows whose file cannot be read are 0.
+
+    Parameters
+    ----------
+    grp : h5py.Group
+        Parent group, e.g. f['xrfmap']
+    files : list
+        Resource file of each row, in the order of the rows
+    num_cols : int
+        Number of points per row
+    snake : bool
+        Reverse the odd rows. HDF5 has no reversed selections, so each
+        point of those rows is mapped on its own, about rows * columns / 2
+        mappings per channel instead of one per row. For a 200 x 200 map
+        this adds about 2.7 MB of mappings per channel to the file, opening
+        a dataset takes about 80 ms instead of 2 ms and reading the whole
+        map is several times slower than for a map without snake.
+    transpose : bool
+        Swap rows and columns (y fly scans)
+    data_path : string
+        Dataset of the spectra in the resource files, (frames, channels, bins)
+
+    Returns
+    -------
+    N : int
+        Number of detector channels
+    """
+
+    sources = [_source_info(fn, data_path) for fn in files]
+    known = [info for info in sources if info is not None]
+    if not known:
+        raise OSError('None of the resource files can be read.')
+    (_, N, N_bins), dtype = known[0]
+    num_rows = len(files)
+    c = num_cols
+    if transpose:
+        shape = (c, num_rows, N_bins)
+    else:
+        shape = (num_rows, c, N_bins)
+    path = data_path.encode()
+
+    for ch in range(N):
+        dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+        dcpl.set_fill_value(np.zeros((), dtype=dtype))
+        vspace = h5py.h5s.create_simple(shape)
+        for i, (fn, info) in enumerate(zip(files, sources)):
+            if info is None or ch >= info[0][1]:
+                continue
+            src_shape = info[0]
+            n = min(c, src_shape[0])
+            nb = min(N_bins, src_shape[2])
+            src = h5py.h5s.create_simple(src_shape)
+            fn = fn.encode()
+            if snake and i % 2 == 1:
+                for j in range(n):
+                    _select_row(vspace, i, c - 1 - j, 1, nb, transpose)
+                    src.select_hyperslab((j, ch, 0), (1, 1, nb))
+                    dcpl.set_virtual(vspace, fn, path, src)
+            elif n > 0:
+                _select_row(vspace, i, 0, n, nb, transpose)
+                src.select_hyperslab((0, ch, 0), (n, 1, nb))
+                dcpl.set_virtual(vspace, fn, path, src)
+        det = grp.require_group(f'det{ch+1}')
+        h5py.h5d.create(det.id, b'counts', h5py.h5t.py_create(dtype), h5py.h5s.create_simple(shape),
+                        dcpl=dcpl)
+    return N